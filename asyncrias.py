@@ -0,0 +1,58 @@
+## asyncrias - Await the waiter's status waits, and run blocking helpers, from an asyncio event loop.
+##
+
+import time, asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from tracing import carry
+
+
+class AsyncRiasClient(object):
+    ################################################
+    ## Coroutine versions of the waiter's calls,
+    ## not of the API: requests still go through
+    ## the blocking RiasClient.  Waits are
+    ## registered with the waiter's shared
+    ## StatusMonitor, so every resource of a type is
+    ## still polled with one list call, and are
+    ## awaited without holding a thread.  Blocking
+    ## helpers run on a bounded executor.  The event
+    ## loop is the one running the coroutine, so the
+    ## client can be made before there is one.
+    ################################################
+
+    def __init__(self, rias, waiter, concurrency=32):
+        self.rias = rias
+        self.waiter = waiter
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def wait(self, resource_type, params, id, done, description):
+        ################################################
+        ## Wait until done(obj) is true for id, where obj
+        ## is None once the resource no longer exists.
+        ## Returns (True, obj), or (False, obj) if the
+        ## deadline passed first.
+        ################################################
+
+        loop = asyncio.get_running_loop()
+        result = loop.create_future()
+        start = time.time()
+        print("Waiting for %s." % description)
+        # the monitor's poller thread hands the result back to the loop
+        self.waiter.monitor(resource_type, params).watch(
+            id, done, lambda found: loop.call_soon_threadsafe(result.set_result, found))
+        finished, obj = await result
+        if not finished:
+            print("Timed out waiting for %s." % description)
+        self.waiter.traced(resource_type, start, description, finished)
+        return finished, obj
+
+    async def call(self, func, *args):
+        ################################################
+        ## Run a blocking helper on the executor
+        ################################################
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, carry(partial(func, *args)))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
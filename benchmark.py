@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+## benchmark - Time provision-vpc.py and destroy-vpc.py end to end against the local RIAS mock.
+##
+
+import os, sys, json, time, yaml, argparse, tempfile, subprocess
+from mockrias import MockRias, serve
+from gentopology import generate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def runscript(rias, script, topology_file, workdir, extra):
+    ################################################
+    ## Run a script against the mock and measure it
+    ################################################
+
+    rias.reset()
+    command = [sys.executable, os.path.join(HERE, script), "-y", topology_file, "-e", rias.endpoint] + extra
+    if script == "provision-vpc.py":
+        command += ["--resource-controller", rias.endpoint]
+    start = time.time()
+    result = subprocess.run(command, cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    elapsed = time.time() - start
+    if result.returncode != 0:
+        print(result.stdout.decode()[-2000:])
+    return {"script": script, "seconds": round(elapsed, 2), "requests": rias.requests, "peak": rias.peak,
+            "status": result.returncode}
+
+
+def benchmark(sizes, args):
+    ################################################
+    ## Provision, re-run and destroy each size
+    ################################################
+
+    results = []
+    for size in sizes:
+        rias = MockRias(latency=args.latency, delay=args.delay, page_limit=args.page_limit,
+                        error_rate=args.error_rate)
+        server = serve(rias)
+        workdir = tempfile.mkdtemp(prefix="bench-")
+        with open(os.path.join(workdir, "iam_token"), 'w') as stream:
+            stream.write("Bearer mock\n")
+        topology_file = os.path.join(workdir, "topology.yaml")
+        with open(topology_file, 'w') as stream:
+            yaml.safe_dump(generate(zones=3, subnets=args.subnets, instances=size,
+                                    cloud_init=os.path.join(HERE, "cloud-init-web.txt")), stream)
+
+        extra = ["-w", str(args.workers), "-r", str(args.rate)]
+        for phase, script in (("provision", "provision-vpc.py"), ("rerun", "provision-vpc.py"),
+                              ("destroy", "destroy-vpc.py")):
+            result = runscript(rias, script, topology_file, workdir, extra)
+            result.update({"instances": size, "phase": phase})
+            results.append(result)
+            print("%6d instances  %-9s  %8.2fs  %7d requests  peak %3d%s" % (
+                size, phase, result["seconds"], result["requests"], result["peak"],
+                "" if result["status"] == 0 else "  FAILED (%s)" % result["status"]))
+        server.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark provisioning against the local RIAS mock.")
+    parser.add_argument("-s", "--sizes", default="1,10,100,1000", help="Comma separated instance counts")
+    parser.add_argument("-m", "--subnets", type=int, default=2, help="Subnets per zone in each topology")
+    parser.add_argument("-w", "--workers", type=int, default=32, help="Workers passed to the scripts")
+    parser.add_argument("-r", "--rate", type=float, default=100.0, help="Request rate passed to the scripts")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds of latency added to every request")
+    parser.add_argument("--delay", type=float, default=2.0, help="Seconds before a resource becomes available")
+    parser.add_argument("--page-limit", type=int, default=50, help="Maximum page size for list calls")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("-o", "--output", help="Write the results to this file as JSON")
+    args = parser.parse_args()
+
+    results = benchmark([int(size) for size in args.sizes.split(",")], args)
+    if args.output is not None:
+        with open(args.output, 'w') as stream:
+            json.dump(results, stream, indent=2)
@@ -3,16 +3,30 @@
 ## Author: Jon Hall
 ##
 
-import requests, json, time, yaml, argparse
+import json, sys, yaml, argparse
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from scheduler import Scheduler
+from progress import Reporter
+from tracing import Tracer
+from riasclient import RiasClient
+from iamtoken import tokenprovider, IAM_ENDPOINT
+from governor import Governor
+from inventory import Inventory
+from waiter import Waiter
+from statefile import StateFile, statepath
 
 
 def main(region):
     #######################################################################
     # Work backwards to remove objects
+    # Build a teardown graph where each resource is deleted only after
+    # everything that depends on it is gone:
+    # LB/instance/floating IP/VPN -> subnet -> gateway/prefix -> security group -> VPC -> ACLs/keys
     #######################################################################
 
+    sched = Scheduler(workers=args.workers, tracer=tracer, keep_going=args.keep_going)
+
     # Get VPC_ID
     vpc_name = topology["vpc"]
     vpc_id = getvpcid(vpc_name)
@@ -22,79 +36,165 @@ def main(region):
         #######################################################################
         # Delete load balancers
         #######################################################################
-        print("- Deleting Load Balancers -")
         if "load_balancers" in topology:
             for lb in topology["load_balancers"]:
-                deleteloadbalancer(lb)
+                sched.add("lb:" + lb["lbInstance"], lambda r, l=lb: deleteloadbalancer(l))
 
         #######################################################################
         # Detach Floating IPs & gateways & delete instance
         #######################################################################
 
+        instance_nodes = []
         for zone in topology["zones"]:
-
-            print("-- zone %s --" % zone["name"])
+            subnet_nodes = []
             for subnet in zone["subnets"]:
-                print("--- subnet %s ---" % subnet["name"])
-                if subnet["publicGateway"]:
-                    detachpublicgateway(subnet["name"])
+                deps = []
+                if subnet.get("publicGateway"):
+                    deps.append(sched.add("detach:" + subnet["name"],
+                                          lambda r, s=subnet["name"]: detachpublicgateway(s)))
 
                 if "vpn" in subnet:
                     ## delete VPN
                     for vpn in subnet["vpn"]:
                         # delete each vpn instance
-                        vpn_id = getvpnid(vpn["name"])
-                        deletevpn(vpn_id, vpn["name"])
+                        deps.append(sched.add("vpn:" + vpn["name"],
+                                              lambda r, v=vpn["name"]: deletevpn(getvpnid(v), v)))
 
-                for instance in subnet["instances"]:
+                subnet_instances = []
+                for instance in subnet.get("instances", []):
+                    # instances can't be removed until the load balancers using them are gone
+                    lbs = nodes(sched, *["lb:" + pool["lb_name"] for pool in instance.get("in_lb_pool", [])])
                     for q in range(1, instance["quantity"] + 1):
-                        instance_name = (instance["name"] % q)
-                        print("---- instance %s ----" % instance_name)
-
-                        # check if floating ip's exist
-                        id = detachfloatingip(instance_name, subnet["name"])
-                        if id is not None:
-                            # if floating ip is detached release it
-                            releasefloatingip(id)
-
-                        # now that ip is detached and deleted or didn't exist delete instance
-                        deleteinstance(instance_name, subnet["name"])
-
-                # now that instances are deleted delete subnet
-                deletesubnet(subnet["name"])
-            deletepublicgateway(zone["name"], vpc_name, vpc_id)
+                        instance_name = (instance["name"] % q) + "-" + zone["name"]
+                        subnet_instances.append(sched.add(
+                            "instance:" + instance_name,
+                            lambda r, i=instance_name, s=subnet["name"]: destroyinstance(i, s), deps=lbs))
+
+                if len(subnet_instances) > 0:
+                    # every deletion in the subnet is sent, then one node waits for them all
+                    gone = sched.add("deleted:" + subnet["name"],
+                                     lambda r, s=subnet["name"], n=subnet_instances: waitinstances(
+                                         s, vpc_id, [r[name] for name in n]),
+                                     deps=subnet_instances)
+                    deps.append(gone)
+                    instance_nodes.append(gone)
+
+                # now that instances are deleted delete subnet, after any load balancers placed in it
+                lbs = nodes(sched, *["lb:" + lb["lbInstance"] for lb in topology.get("load_balancers", [])
+                                     if subnet["name"] in lb["subnets"]])
+                subnet_nodes.append(sched.add("subnet:" + subnet["name"],
+                                              lambda r, s=subnet["name"]: deletesubnet(s),
+                                              deps=deps + lbs))
+
+            sched.add("gateway:" + zone["name"],
+                      lambda r, z=zone["name"]: deletepublicgateway(z, vpc_name, vpc_id),
+                      deps=subnet_nodes)
 
             if "address_prefix_cidr" in zone:
                 name = zone["name"] + "-address-prefix"
-                deleteaddressprefix(vpc_id, name, zone["name"])
-
+                sched.add("prefix:" + zone["name"],
+                          lambda r, n=name, z=zone["name"]: deleteaddressprefix(vpc_id, n, z),
+                          deps=subnet_nodes)
 
         #######################################################################
-        # Delete Security Groups
+        # Delete Security Groups once no instance uses them, and before
+        # any security group their rules reference
         #######################################################################
-        print("- Deleting Security Groups -")
         for security_group in topology["security_groups"]:
-            deletesecuritygroup(security_group["security_group"], vpc_id)
+            referenced_by = ["sg:" + sg["security_group"] for sg in topology["security_groups"]
+                             if security_group["security_group"] in
+                             [rule["remote"].get("security_group") for rule in sg["rules"]]]
+            sched.add("sg:" + security_group["security_group"],
+                      lambda r, sg=security_group["security_group"]: deletesecuritygroup(sg, vpc_id),
+                      deps=instance_nodes + referenced_by)
 
         #######################################################################
         # Delete VPC
         #######################################################################
-        print("- Deleting VPC -")
-        deletevpc(vpc_id, vpc_name, topology["region"])
+        sched.add("vpc", lambda r: deletevpc(vpc_id, vpc_name, topology["region"]),
+                  deps=[name for name in sched.order if not name.startswith("instance:")])
 
     #######################################################################
     # Delete Network ACLS
     #######################################################################
-    print("- Deleting Network Acls -")
     for network_acl in topology["network_acls"]:
-        deletenetworkacls(network_acl["network_acl"])
+        sched.add("acl:" + network_acl["network_acl"],
+                  lambda r, acl=network_acl["network_acl"]: deletenetworkacls(acl),
+                  deps=nodes(sched, "vpc"))
 
     #######################################################################
     # Delete Keys
     #######################################################################
-    print("- Deleting sshkeys -")
     for sshkey in topology["sshkeys"]:
-        deletesshkey(sshkey["sshkey"])
+        sched.add("key:" + sshkey["sshkey"], lambda r, key=sshkey["sshkey"]: deletesshkey(key),
+                  deps=nodes(sched, "vpc"))
+
+    # Drop each resource from the state file as it is removed
+    sched.listen(lambda name, result: forgetnode(name))
+    reporter.track(sched, sched.order)
+    try:
+        sched.run()
+        if len(sched.failures) > 0:
+            reporter.failures(sched, "Run destroy-vpc.py again to retry them.")
+            sys.exit(1)
+    finally:
+        state.save()
+    return
+
+
+def forgetnode(name):
+    ################################################
+    ## Remove a deleted resource from the state file
+    ################################################
+
+    state.forget(name)
+    if name.startswith("instance:"):
+        state.forget("fip:" + name.split(":", 1)[1])
+
+
+def nodes(sched, *names):
+    ################################################
+    ## Return the names that are nodes in the graph
+    ################################################
+
+    return [name for name in names if name in sched]
+
+
+def destroyinstance(instance_name, subnet_name):
+    ################################################
+    ## Release floating ip and request the instance's
+    ## deletion.  Returns the id being deleted, or
+    ## None if there was no instance.
+    ################################################
+
+    print("---- instance %s ----" % instance_name)
+
+    # check if floating ip's exist
+    id = detachfloatingip(instance_name, subnet_name)
+    if id is not None:
+        # if floating ip is detached release it
+        releasefloatingip(id)
+
+    # now that ip is detached and deleted or didn't exist delete instance
+    return deleteinstance(instance_name, subnet_name)
+
+
+def waitinstances(subnet_name, vpc_id, instance_ids):
+    ################################################
+    ## Wait for a subnet's instance deletions to
+    ## complete, all watched by one list call
+    ################################################
+
+    instance_ids = [id for id in instance_ids if id is not None]
+    if len(instance_ids) == 0:
+        return
+    results = waiter.monitor("instances", {"vpc.id": vpc_id}).waitall(
+        instance_ids, lambda i: i is None, "deletion of %s instances in subnet %s to complete" % (
+            len(instance_ids), subnet_name))
+    remaining = [id for id, (deleted, instance) in zip(instance_ids, results) if not deleted]
+    if len(remaining) > 0:
+        print("Instances %s in subnet %s were not deleted." % (", ".join(remaining), subnet_name))
+        quit()
     return
 
 
@@ -103,16 +203,11 @@ def getvpnid(vpn_name):
     ## LLookup VPN by name
     ################################################
 
-    resp = requests.get(rias_endpoint + '/v1/vpn_gateways' + version, headers=headers)
-    if resp.status_code == 200:
-        vpn_gateways = json.loads(resp.content)["vpn_gateways"]
-        vpn_gateway = \
-            list(filter(lambda vpn_gateway: vpn_gateway["name"] == vpn_name, vpn_gateways))
-
-        if len(vpn_gateway) > 0:
-            vpn_gateway_id = vpn_gateway[0]['id']
-        else:
-            vpn_gateway_id = None
+    if state.id("vpn:" + vpn_name) is not None:
+        return state.id("vpn:" + vpn_name)
+    vpn_gateway = inventory.find("vpn_gateways", vpn_name)
+    if vpn_gateway is not None:
+        vpn_gateway_id = vpn_gateway['id']
     else:
         vpn_gateway_id = None
 
@@ -123,7 +218,7 @@ def getregionavailability(region):
     # Get Region Availability
     #############################
 
-    resp = requests.get(rias_endpoint + '/v1/regions/' + region + version, headers=headers)
+    resp = rias.get('/v1/regions/' + region)
 
     if resp.status_code == 200:
         region = json.loads(resp.content)
@@ -146,20 +241,13 @@ def getnetworkaclid(network_acl_name):
     ## Lookup network acl id by name
     ################################################
 
-    resp = requests.get(rias_endpoint + '/v1/network_acls/' + version, headers=headers)
-    if resp.status_code == 200:
-        acls = json.loads(resp.content)["network_acls"]
-        default_network_acl = \
-            list(filter(lambda acl: acl['name'] == network_acl_name, acls))
-
-        if len(default_network_acl) > 0:
-            network_acl_id = default_network_acl[0]['id']
-        else:
-            return
-    else:
+    if state.id("acl:" + network_acl_name) is not None:
+        return state.id("acl:" + network_acl_name)
+    network_acl = inventory.find("network_acls", network_acl_name)
+    if network_acl is None:
         return
 
-    return network_acl_id
+    return network_acl['id']
 
 
 def getsecuritygroupid(security_group, vpc_id):
@@ -167,20 +255,13 @@ def getsecuritygroupid(security_group, vpc_id):
     ## Lookup security group id by name
     ################################################
 
-    resp = requests.get(rias_endpoint + '/v1/security_groups/' + version + "&vpc.if=" + vpc_id, headers=headers)
-    if resp.status_code == 200:
-        sgs = json.loads(resp.content)["security_groups"]
-        default_security_group = \
-            list(filter(lambda acl: acl['name'] == security_group, sgs))
-
-        if len(default_security_group) > 0:
-            security_group_id = default_security_group[0]['id']
-        else:
-            return
-    else:
+    if state.id("sg:" + security_group) is not None:
+        return state.id("sg:" + security_group)
+    sg = inventory.find("security_groups", security_group, lambda sg: sg['vpc']['id'] == vpc_id)
+    if sg is None:
         return
 
-    return security_group_id
+    return sg['id']
 
 
 def deletenetworkacls(network_acl_name):
@@ -193,10 +274,14 @@ def deletenetworkacls(network_acl_name):
     if network_acl_id is not None:
         # Delete network ACL
 
-        resp = requests.delete(rias_endpoint + '/v1/network_acls/' + network_acl_id + version, headers=headers)
+        resp = rias.delete('/v1/network_acls/' + network_acl_id)
 
         if resp.status_code == 204:
+            inventory.remove("network_acls", network_acl_id)
             print("Network ACL %s deleted successfully." % (network_acl_name))
+        elif resp.status_code == 404 and state.forget("acl:" + network_acl_name):
+            # the recorded id is stale, look it up by name instead
+            return deletenetworkacls(network_acl_name)
         elif resp.status_code == 409:
             print("Network ACL %s cannot be deleted. It is the default security group for this VPC." % network_acl_name)
             #             # continue default acl will be deleted when VPC is deleted
@@ -224,10 +309,14 @@ def deletesecuritygroup(security_group, vpc_id):
     if security_group_id is not None:
         # Delete Security Group
 
-        resp = requests.delete(rias_endpoint + '/v1/security_groups/' + security_group_id + version, headers=headers)
+        resp = rias.delete('/v1/security_groups/' + security_group_id)
 
         if resp.status_code == 204:
+            inventory.remove("security_groups", security_group_id)
             print("Security Group %s deleted successfully." % (security_group))
+        elif resp.status_code == 404 and state.forget("sg:" + security_group):
+            # the recorded id is stale, look it up by name instead
+            return deletesecuritygroup(security_group, vpc_id)
         elif resp.status_code == 400:
             print(
                 "Security group %s cannot be deleted. It is the default security group for a virtual private cloud." % security_group)
@@ -246,19 +335,13 @@ def deletesecuritygroup(security_group, vpc_id):
     return
 
 
-def getpublicgatewayid(name, vpc_id):
-    # A gateway is needed check if Public Gateway already exists in zone, if not create.
-    resp = requests.get(rias_endpoint + '/v1/public_gateways' + version, headers=headers)
-    if resp.status_code == 200:
-        public_gateways = json.loads(resp.content)["public_gateways"]
-        # Determine if gateway exists and use it.  First get Gateways for this VPC
-        public_gateway = list(filter(lambda gw: gw['vpc']['id'] == vpc_id, public_gateways))
-        # Determine if gateway exists in this vpc for this zone
-        public_gateway = list(filter(lambda gw: gw['name'] == name, public_gateway))
-
-        if len(public_gateway) > 0:
-            # gateway already exists, get it's ID and attach to subnet.
-            return public_gateway[0]["id"]
+def getpublicgatewayid(name, zone_name, vpc_id):
+    if state.id("gateway:" + zone_name) is not None:
+        return state.id("gateway:" + zone_name)
+    # Determine if gateway exists in this vpc
+    public_gateway = inventory.find("public_gateways", name, lambda gw: gw['vpc']['id'] == vpc_id)
+    if public_gateway is not None:
+        return public_gateway["id"]
     return
 
 
@@ -269,15 +352,18 @@ def deletepublicgateway(zone_name, vpc_name, vpc_id):
 
     gateway_name = vpc_name + "-" + zone_name + "-gw"
 
-    public_gateway_id = getpublicgatewayid(gateway_name, vpc_id)
+    public_gateway_id = getpublicgatewayid(gateway_name, zone_name, vpc_id)
 
     if public_gateway_id is not None:
         # gateway already exists, delete it
-        resp = requests.delete(rias_endpoint + '/v1/public_gateways/' + public_gateway_id + version,
-                               headers=headers)
+        resp = rias.delete('/v1/public_gateways/' + public_gateway_id)
 
         if resp.status_code == 204:
+            inventory.remove("public_gateways", public_gateway_id)
             print("Public Gateway %s deleted successfully." % (gateway_name))
+        elif resp.status_code == 404 and state.forget("gateway:" + zone_name):
+            # the recorded id is stale, look it up by name instead
+            return deletepublicgateway(zone_name, vpc_name, vpc_id)
         elif resp.status_code == 404:
             print("Public Gateway not found.")
             print("Error Data:  %s" % json.loads(resp.content)['errors'])
@@ -302,47 +388,42 @@ def detachpublicgateway(subnet_name):
     # Detach a public gateway
     #################################
 
-    subnet_id = getsubnetid(subnet_name)
+    subnet = inventory.find("subnets", subnet_name)
 
-    if subnet_id != None:
-        resp = requests.get(rias_endpoint + '/v1/subnets/' + subnet_id + version, headers=headers)
-        if resp.status_code == 200:
-            subnet = json.loads(resp.content)
-            if "public_gateway" in subnet:
-                resp = requests.delete(rias_endpoint + '/v1/subnets/' + subnet_id + '/public_gateway' + version,
-                                       headers=headers)
-                if resp.status_code == 204:
-                    print("Public gateway detached successfully from subnet %s." % subnet_name)
-                    return
-                elif resp.status_code == 404:
-                    print("A subnet with the specified identifier could not be found.")
-                    print("Response:  %s" % json.loads(resp.content))
-                    quit()
-                else:
-                    # error stop execution
-                    print("%s Error detaching pubic gateway from subnet %s." % (resp.status_code, subnet_name))
-                    print("Error Data:  %s" % json.loads(resp.content)['errors'])
-                    quit()
+    if subnet is not None:
+        subnet_id = subnet["id"]
+        if "public_gateway" in subnet:
+            resp = rias.delete('/v1/subnets/' + subnet_id + '/public_gateway')
+            if resp.status_code == 204:
+                subnet.pop("public_gateway")
+                print("Public gateway detached successfully from subnet %s." % subnet_name)
+                return
+            elif resp.status_code == 404:
+                print("A subnet with the specified identifier could not be found.")
+                print("Response:  %s" % json.loads(resp.content))
+                quit()
             else:
-                print("No public Gateway exists for subnet %s" % subnet_name)
+                # error stop execution
+                print("%s Error detaching pubic gateway from subnet %s." % (resp.status_code, subnet_name))
+                print("Error Data:  %s" % json.loads(resp.content)['errors'])
+                quit()
         else:
-            print("%s Error getting public gateway from subnet %s." % (resp.status_code, subnet_name))
-            print("template=%s" % parms)
-            print("Error Data:  %s" % json.loads(resp.content)['errors'])
-            quit()
+            print("No public Gateway exists for subnet %s" % subnet_name)
     return
 
 
 def getvpcid(vpc_name):
-    resp = requests.get(rias_endpoint + '/v1/vpcs/' + version, headers=headers)
-    if resp.status_code == 200:
-        vpcs = json.loads(resp.content)["vpcs"]
-        # Determine if network_acl name already exists and retreive id.
-        vpc = list(filter(lambda vpc: vpc['name'] == vpc_name, vpcs))
-        if len(vpc) > 0:
-            return (vpc[0]['id'])
-        else:
-            return
+    # everything in the VPC is found through its id, so check a recorded one is still current
+    vpc_id = state.id("vpc")
+    if vpc_id is not None:
+        if waiter.fetch('/v1/vpcs/' + vpc_id) is not None:
+            return vpc_id
+        state.forget("vpc")
+    vpc = inventory.find("vpcs", vpc_name)
+    if vpc is not None:
+        return (vpc['id'])
+    else:
+        return
 
 
 def deletevpc(vpc_id, vpc_name, region):
@@ -350,9 +431,10 @@ def deletevpc(vpc_id, vpc_name, region):
     # Delete VPC in desired region
     ##################################
 
-    resp = requests.delete(rias_endpoint + '/v1/vpcs/' + vpc_id + version, headers=headers)
+    resp = rias.delete('/v1/vpcs/' + vpc_id)
 
     if resp.status_code == 204:
+        inventory.remove("vpcs", vpc_id)
         print("Deleted VPC named %s (%s) in region %s." % (vpc_name, vpc_id, region))
     elif resp.status_code == 400:
         print("VPC named %s (%s) in region %s could not be deleted." % (vpc_name, vpc_id, region))
@@ -373,15 +455,13 @@ def deletevpc(vpc_id, vpc_name, region):
     return
 
 
-def getaddressprefixid(vpc_id, name):
+def getaddressprefixid(vpc_id, name, zone):
+    if state.id("prefix:" + zone) is not None:
+        return state.id("prefix:" + zone)
     # get list of prefixes in VPC to check if prefix already exists
-    resp = requests.get(rias_endpoint + '/v1/vpcs/' + vpc_id + '/address_prefixes' + version, headers=headers)
-    if resp.status_code == 200:
-        prefixlist = json.loads(resp.content)["address_prefixes"]
-        prefix_id = list(filter(lambda p: p['name'] == name, prefixlist))
-        if len(prefix_id) > 0:
-            if prefix_id[0]["id"] != 0:
-                return prefix_id[0]["id"]
+    prefix = rias.find('/v1/vpcs/' + vpc_id + '/address_prefixes', "address_prefixes", name)
+    if prefix is not None:
+        return prefix["id"]
     return
 
 
@@ -390,16 +470,18 @@ def deleteaddressprefix(vpc_id, name, zone):
     ## Deletes Prefix in VPC
     ################################################
 
-    addressprefix_id = getaddressprefixid(vpc_id, name)
+    addressprefix_id = getaddressprefixid(vpc_id, name, zone)
 
     if addressprefix_id is not None:
-        resp = requests.delete(rias_endpoint + '/v1/vpcs/' + vpc_id + '/address_prefixes/' + addressprefix_id + version,
-                               headers=headers)
+        resp = rias.delete('/v1/vpcs/' + vpc_id + '/address_prefixes/' + addressprefix_id)
 
         if resp.status_code == 204:
             print("vpc-address-prefix %s deleted successfully in zone %s." % (
                 name, zone))
             return
+        elif resp.status_code == 404 and state.forget("prefix:" + zone):
+            # the recorded id is stale, look it up by name instead
+            return deleteaddressprefix(vpc_id, name, zone)
         elif resp.status_code == 404:
             print("Prefix id %s could not be found." % addressprefix_id)
             quit()
@@ -419,15 +501,14 @@ def getsubnetid(subnet_name):
     ## get subnet id from name
     ################################################
 
-    # get list of subnets in region to find id
-    resp = requests.get(rias_endpoint + '/v1/subnets/' + version, headers=headers)
-    if resp.status_code == 200:
-        subnetlist = json.loads(resp.content)["subnets"]
-        subnet_id = list(filter(lambda s: s['name'] == subnet_name, subnetlist))
-        if len(subnet_id) > 0:
-            return subnet_id[0]["id"]
-        else:
-            return
+    if state.id("subnet:" + subnet_name) is not None:
+        return state.id("subnet:" + subnet_name)
+    # lookup subnet in region to find id
+    subnet = inventory.find("subnets", subnet_name)
+    if subnet is not None:
+        return subnet["id"]
+    else:
+        return
 
 
 def deletesubnet(subnet_name):
@@ -438,15 +519,19 @@ def deletesubnet(subnet_name):
     subnet_id = getsubnetid(subnet_name)
 
     if subnet_id != None:
-        resp = requests.delete(rias_endpoint + '/v1/subnets/' + subnet_id + version, headers=headers)
+        resp = rias.delete('/v1/subnets/' + subnet_id)
 
         if resp.status_code == 204:
+            inventory.remove("subnets", subnet_id)
             print("Subnet named %s deleted." % (subnet_name))
-            while True:
-                print("Waiting for deletion of subnet %s to complete.  Sleeping 10 seconds." % subnet_name)
-                time.sleep(10)
-                if getsubnetid(subnet_name) is None:
-                    break
+            deleted, subnet = waiter.wait("subnets", '/v1/subnets/' + subnet_id, lambda s: s is None,
+                                          "deletion of subnet %s to complete" % subnet_name)
+            if not deleted:
+                print("Subnet %s was not deleted." % subnet_name)
+                quit()
+        elif resp.status_code == 404 and state.forget("subnet:" + subnet_name):
+            # the recorded id is stale, look it up by name instead
+            return deletesubnet(subnet_name)
         elif resp.status_code == 409:
             print("Subnet %s is in use and can not be deleted." % subnet_name)
             print("Error Data:  %s" % json.loads(resp.content)['errors'])
@@ -469,9 +554,7 @@ def detachfloatingip(instance_name, subnet_name):
 
     if instance_id is not None:
         # get network interfaces
-        resp = requests.get(
-            rias_endpoint + '/v1/instances/' + instance_id + "/network_interfaces" + version,
-            headers=headers)
+        resp = rias.get('/v1/instances/' + instance_id + "/network_interfaces")
 
         if resp.status_code == 200:
             network_interfaces = json.loads(resp.content)["network_interfaces"]
@@ -479,10 +562,8 @@ def detachfloatingip(instance_name, subnet_name):
             if len(network_interfaces) > 0:
                 for network_interface in network_interfaces:
                     # for each network interface get floating ips
-                    resp = requests.get(
-                        rias_endpoint + '/v1/instances/' + instance_id + "/network_interfaces/" + network_interface[
-                            "id"] + "/floating_ips" + version,
-                        headers=headers)
+                    resp = rias.get('/v1/instances/' + instance_id + "/network_interfaces/" + network_interface["id"] +
+                                    "/floating_ips")
 
                     if resp.status_code == 200:
                         response = json.loads(resp.content)
@@ -490,10 +571,8 @@ def detachfloatingip(instance_name, subnet_name):
                             floating_ips = response["floating_ips"]
                             for floating_ip in floating_ips:
                                 # For each floating Ip detach it.
-                                resp = requests.delete(
-                                    rias_endpoint + '/v1/instances/' + instance_id + "/network_interfaces/" +
-                                    network_interface["id"] + "/" + "floating_ips/" + floating_ip["id"] + version,
-                                    headers=headers)
+                                resp = rias.delete('/v1/instances/' + instance_id + "/network_interfaces/" +
+                                                   network_interface["id"] + "/" + "floating_ips/" + floating_ip["id"])
 
                                 if resp.status_code == 204:
                                     print(
@@ -511,6 +590,9 @@ def detachfloatingip(instance_name, subnet_name):
                         print("Error retrieving floating IPs for instance %s." % instance_name)
             else:
                 print("No network interfaces found for instance %s." % instance_name)
+        elif resp.status_code == 404 and state.forget("instance:" + instance_name):
+            # the recorded id is stale, look it up by name instead
+            return detachfloatingip(instance_name, subnet_name)
         else:
             print("Error returning network interface for instance %s." % instance_name)
 
@@ -522,18 +604,14 @@ def releasefloatingip(id):
     ## rrelease floating ip
     ################################################
 
-    while True:
-        resp = requests.get(rias_endpoint + '/v1/floating_ips/' + id + version, headers=headers)
-        if resp.status_code == 200:
-            if "status" in json.loads(resp.content):
-                status = json.loads(resp.content)["status"]
-                if status == "available":
-                    break
-                else:
-                    print("Waiting for floating ip %s to detach.  Sleeping 10 seconds." % id)
-                    time.sleep(10)
+    detached, floating_ip = waiter.wait("floating_ips", '/v1/floating_ips/' + id,
+                                        lambda f: f is None or f.get("status") == "available",
+                                        "floating ip %s to detach" % id)
+    if not detached:
+        print("Floating IP %s was not detached." % id)
+        quit()
 
-    resp = requests.delete(rias_endpoint + '/v1/floating_ips/' + id + version, headers=headers)
+    resp = rias.delete('/v1/floating_ips/' + id)
 
     if resp.status_code == 204:
         print("Floating IP %s deleted." % (id))
@@ -557,15 +635,13 @@ def getinstanceid(instance_name, subnet_name):
     # get instance id from name
     ##############################################
 
-    # get list of instances to check if instance already exists
-    resp = requests.get(rias_endpoint + '/v1/instances/' + version + "&network_interfaces.subnet.name=" + subnet_name,
-                        headers=headers)
-    if resp.status_code == 200:
-        instancelist = json.loads(resp.content)["instances"]
-        if len(instancelist) > 0:
-            instancelist = list(filter(lambda i: i['name'] == instance_name, instancelist))
-            if len(instancelist) > 0:
-                return instancelist[0]["id"]
+    if state.id("instance:" + instance_name) is not None:
+        return state.id("instance:" + instance_name)
+    # check instances to see if instance exists in subnet
+    instance = inventory.find("instances", instance_name,
+                              lambda i: i["primary_network_interface"]["subnet"]["name"] == subnet_name)
+    if instance is not None:
+        return instance["id"]
     else:
         return
 
@@ -576,16 +652,19 @@ def deletevpn(vpn_id, vpn_name):
     ##############################################
 
     if vpn_id != None:
-        resp = requests.delete(rias_endpoint + '/v1/vpn_gateways/' + vpn_id + version, headers=headers)
+        resp = rias.delete('/v1/vpn_gateways/' + vpn_id)
 
         if resp.status_code == 204:
+            inventory.remove("vpn_gateways", vpn_id)
             print("vpn %s (%s) deleted successfully." % (vpn_name, vpn_id))
-            while True:
-                print("Waiting for deletion of instance %s to complete.  Sleeping 30 seconds." % vpn_name)
-                time.sleep(30)
-                if getvpnid(vpn_name) is None:
-                    break
-
+            deleted, vpn = waiter.wait("vpn_gateways", '/v1/vpn_gateways/' + vpn_id, lambda v: v is None,
+                                       "deletion of vpn %s to complete" % vpn_name)
+            if not deleted:
+                print("VPN %s was not deleted." % vpn_name)
+                quit()
+        elif resp.status_code == 404 and state.forget("vpn:" + vpn_name):
+            # the recorded id is stale, look it up by name instead
+            return deletevpn(getvpnid(vpn_name), vpn_name)
         elif resp.status_code == 404:
             print("An vpn with the specified identifier %s could not be found." % vpn_id)
             print("Error Data:  %s" % json.loads(resp.content)['errors'])
@@ -601,22 +680,22 @@ def deletevpn(vpn_id, vpn_name):
 
 def deleteinstance(instance_name, subnet_name):
     ##############################################
-    # delete instance
+    # request deletion of instance, returning its
+    # id for waitinstances
     ##############################################
 
     instance_id = getinstanceid(instance_name, subnet_name)
 
     if instance_id != None:
-        resp = requests.delete(rias_endpoint + '/v1/instances/' + instance_id + version, headers=headers)
+        resp = rias.delete('/v1/instances/' + instance_id)
 
         if resp.status_code == 204:
-            print("Instance %s (%s) deleted successfully." % (instance_name, instance_id))
-            while True:
-                print("Waiting for deletion of instance %s to complete.  Sleeping 30 seconds." % instance_name)
-                time.sleep(30)
-                if getinstanceid(instance_name, subnet_name) is None:
-                    break
-
+            inventory.remove("instances", instance_id)
+            print("Instance %s (%s) deletion requested." % (instance_name, instance_id))
+            return instance_id
+        elif resp.status_code == 404 and state.forget("instance:" + instance_name):
+            # the recorded id is stale, look it up by name instead
+            return deleteinstance(instance_name, subnet_name)
         elif resp.status_code == 404:
             print("An instance with the specified identifier %s could not be found." % instance_id)
             print("Error Data:  %s" % json.loads(resp.content)['errors'])
@@ -640,23 +719,13 @@ def getloadbalancerid(lbname):
     ## get LB instance id
     ################################################
 
-    # get list of load balancers and return information
-    resp = requests.get(rias_endpoint + '/v1/load_balancers/' + version,
-                        headers=headers)
-    if resp.status_code == 200:
-        lblist = json.loads(resp.content)["load_balancers"]
-        if len(lblist) > 0:
-            lblist = list(filter(lambda i: i['name'] == lbname, lblist))
-            if len(lblist) > 0:
-                if lblist[0]["operating_status"] == "online":
-                    return lblist[0]["id"]
-            else:
-                return
-    else:
-        # error stop execution
-        print("%s Error." % resp.status_code)
-        print("Error Data:  %s" % json.loads(resp.content)['errors'])
-        quit()
+    if state.id("lb:" + lbname) is not None:
+        return state.id("lb:" + lbname)
+    # lookup load balancer and return information
+    lb = inventory.find("load_balancers", lbname)
+    if lb is not None:
+        if lb["operating_status"] == "online":
+            return lb["id"]
     return
 
 
@@ -669,15 +738,19 @@ def deleteloadbalancer(lb):
 
     if lb_id is not None:
 
-        resp = requests.delete(rias_endpoint + '/v1/load_balancers/' + lb_id + version, headers=headers)
+        resp = rias.delete('/v1/load_balancers/' + lb_id)
 
         if resp.status_code == 204:
+            inventory.remove("load_balancers", lb_id)
             print("Deleted %s (%s) load balancer successfully." % (lb["lbInstance"], lb_id))
-            while True:
-                print("Waiting for deletion of load balancer %s to complete.  Sleeping 30 seconds." % lb["lbInstance"])
-                time.sleep(30)
-                if getloadbalancerid(lb["lbInstance"]) is None:
-                    break
+            deleted, load_balancer = waiter.wait("load_balancers", '/v1/load_balancers/' + lb_id, lambda l: l is None,
+                                                 "deletion of load balancer %s to complete" % lb["lbInstance"])
+            if not deleted:
+                print("Load balancer %s was not deleted." % lb["lbInstance"])
+                quit()
+        elif resp.status_code == 404 and state.forget("lb:" + lb["lbInstance"]):
+            # the recorded id is stale, look it up by name instead
+            return deleteloadbalancer(lb)
         elif resp.status_code == 404:
             print("A load balancer with that id cloud not be found.")
             print("Error Data:  %s" % json.loads(resp.content)['errors'])
@@ -699,14 +772,13 @@ def getsshkeyid(sshkey_name):
     ## Return the sshkey_id of an sshkey name
     ################################################
 
-    resp = requests.get(rias_endpoint + '/v1/keys/' + version, headers=headers)
-    if resp.status_code == 200:
-        keylist = json.loads(resp.content)["keys"]
-        sshkey_id = list(filter(lambda k: k['name'] == sshkey_name, keylist))
-        if len(sshkey_id) > 0:
-            return sshkey_id[0]["id"]
-        else:
-            return
+    if state.id("key:" + sshkey_name) is not None:
+        return state.id("key:" + sshkey_name)
+    sshkey = inventory.find("keys", sshkey_name)
+    if sshkey is not None:
+        return sshkey["id"]
+    else:
+        return
 
 
 def deletesshkey(sshkey_name):
@@ -717,11 +789,15 @@ def deletesshkey(sshkey_name):
 
     if sshkey_id is not None:
 
-        resp = requests.delete(rias_endpoint + '/v1/keys/' + sshkey_id + version, headers=headers)
+        resp = rias.delete('/v1/keys/' + sshkey_id)
 
         if resp.status_code == 204:
+            inventory.remove("keys", sshkey_id)
             print("SSH Key named %s deleted." % (sshkey_name))
             return
+        elif resp.status_code == 404 and state.forget("key:" + sshkey_name):
+            # the recorded id is stale, look it up by name instead
+            return deletesshkey(sshkey_name)
         elif resp.status_code == 400:
             print("SSH Key %s (%s) could not be deleted." % (sshkey_name, sshkey_id))
             print("Error Data:  %s" % json.loads(resp.content)['errors'])
@@ -746,13 +822,9 @@ def deletesshkey(sshkey_name):
 #####################################
 
 
-# Create iam_token file by running gettoken.sh
-iam_file = open("iam_token", 'r')
-iam_token = iam_file.read()
-iam_token = iam_token[:-1]
 rias_endpoint = "https://us-south.iaas.cloud.ibm.com"
-version = "?version=2019-01-01"
-headers = {"Authorization": iam_token}
+version = "2019-01-01"
+headers = {}
 
 #####################################
 # Read desired topology YAML file
@@ -760,6 +832,24 @@ headers = {"Authorization": iam_token}
 
 parser = argparse.ArgumentParser(description="Destroy VPC topology.")
 parser.add_argument("-y", "--yaml", help="YAML based topology file to destroy")
+parser.add_argument("-i", "--index", type=int, default=0, help="Entry of the YAML file's topology list to use")
+parser.add_argument("-e", "--endpoint", default=rias_endpoint, help="RIAS API endpoint used to look up the region")
+parser.add_argument("--apikey", help="IBM Cloud API key to exchange for IAM tokens (default IBMCLOUD_API_KEY, or else "
+                                     "the token in iam_token written by gettoken)")
+parser.add_argument("--iam-endpoint", default=IAM_ENDPOINT, help="IAM endpoint the API key is exchanged with")
+parser.add_argument("-w", "--workers", type=int, default=8, help="Number of resources to delete concurrently")
+parser.add_argument("-s", "--state", help="State file of provisioned resource ids (default <yaml>.state.json)")
+parser.add_argument("-r", "--rate", type=float, default=10.0,
+                    help="Maximum API requests per second to each resource type")
+parser.add_argument("-k", "--keep-going", action="store_true",
+                    help="When a resource fails, carry on with everything that doesn't depend on it and report "
+                         "the failures at the end")
+parser.add_argument("--events", metavar="FILE",
+                    help="Write a JSON lines stream of messages, resource states and progress to FILE")
+parser.add_argument("--progress", action="store_true",
+                    help="Show a progress summary every few seconds in place of the individual messages")
+parser.add_argument("--trace", metavar="FILE",
+                    help="Write a Chrome trace of every request, wait and resource to FILE and print a summary")
 args = parser.parse_args()
 if args.yaml is None:
     filename = "topology.yaml"
@@ -767,14 +857,42 @@ else:
     filename = args.yaml
 
 with open(filename, 'r') as stream:
-    topology = yaml.load(stream)[0]
-
-# Determine if region identified is available and get endpoint
-region = getregionavailability(topology["region"])
-
-if region["status"] == "available":
-    rias_endpoint = region["endpoint"]
-    main(region["name"])
-else:
-    print("Region %s is not currently available." % region["name"])
-    quit()
+    topology = yaml.safe_load(stream)[args.index]
+
+# Time every request and wait when tracing
+tracer = Tracer() if args.trace is not None else None
+# Every API call shares one pooled keep-alive session, sized for the worker threads
+# Requests are paced per resource type, and rate limited or transient errors are retried with backoff
+# Tokens are exchanged from the API key and refreshed before they expire, once for all the workers
+auth = tokenprovider(args.apikey, args.iam_endpoint)
+rias = RiasClient(args.endpoint, headers, version=version, pool_size=args.workers,
+                  governor=Governor(rate=args.rate, burst=2 * args.rate, tracer=tracer), auth=auth)
+# Each resource collection is listed once per run and kept up to date from delete responses
+inventory = Inventory(rias)
+waiter = Waiter(rias, tracer=tracer)
+# All output is written from one thread so printing never holds up a worker
+reporter = Reporter(open(args.events, 'w') if args.events is not None else None, live=args.progress,
+                    states=("pending", "deleting", "deleted", "failed"), governor=rias.governor)
+reporter.capture()
+state = StateFile(args.state or statepath(filename, args.index))
+
+try:
+    # Determine if region identified is available and get endpoint
+    region = getregionavailability(topology["region"])
+
+    if region["status"] == "available":
+        rias.endpoint = region["endpoint"]
+        main(region["name"])
+    else:
+        print("Region %s is not currently available." % region["name"])
+        quit()
+except SystemExit as e:
+    # quit() exits with status 0, but it only ever ends a failed run
+    if e.code is None:
+        sys.exit(1)
+    raise
+finally:
+    reporter.close(failed=sys.exc_info()[0] is not None)
+    if tracer is not None:
+        tracer.export(args.trace)
+        tracer.report()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+## gentopology - Generate topology yaml files of arbitrary size for scale testing.
+##
+
+import sys, math, yaml, argparse, ipaddress
+from validate import RESERVED
+# smallest subnet that can be created
+MIN_PREFIX = 28
+
+
+class CidrAllocator(object):
+    ################################################
+    ## Carve aligned, non-overlapping blocks out of
+    ## a network in allocation order
+    ################################################
+
+    def __init__(self, cidr):
+        self.network = ipaddress.ip_network(cidr)
+        self.next = int(self.network.network_address)
+
+    def allocate(self, prefixlen):
+        size = 2 ** (self.network.max_prefixlen - prefixlen)
+        # round up to the block size so the block is aligned
+        start = -(-self.next // size) * size
+        if start + size > int(self.network.broadcast_address) + 1:
+            raise ValueError("No room for a /%s in %s." % (prefixlen, self.network))
+        self.next = start + size
+        return ipaddress.ip_network((start, prefixlen))
+
+
+def subnetprefix(hosts):
+    ################################################
+    ## Smallest prefix length holding hosts addresses
+    ################################################
+
+    return min(MIN_PREFIX, 32 - int(math.ceil(math.log(hosts + RESERVED, 2))))
+
+
+def spread(total, buckets):
+    ################################################
+    ## Split total into buckets as evenly as possible
+    ################################################
+
+    return [total // buckets + (1 if n < total % buckets else 0) for n in range(buckets)]
+
+
+def generate(zones=3, subnets=1, groups=1, quantity=1, instances=None, load_balancers=1, pools=1,
+             vpc="scale-vpc", region="us-south", cidr="10.0.0.0/8", zone_prefix=18, floating_ip=False,
+             cloud_init="cloud-init-web.txt"):
+    ################################################
+    ## Build a topology with zones x subnets x groups
+    ## instance groups of quantity instances each (or
+    ## instances spread evenly over the groups) with
+    ## each group a member of one load balancer pool
+    ################################################
+
+    group_count = zones * subnets * groups
+    if instances is None:
+        quantities = [quantity] * group_count
+    else:
+        quantities = spread(instances, group_count)
+
+    prefixes = CidrAllocator(cidr)
+    lb_subnets = dict(("%s-lb-%d" % (vpc, l + 1), []) for l in range(load_balancers))
+    zone_list = []
+    g = 0
+    for z in range(zones):
+        zone_name = "%s-%d" % (region, z + 1)
+        address_prefix = prefixes.allocate(zone_prefix)
+        allocator = CidrAllocator(str(address_prefix))
+        subnet_list = []
+        for s in range(subnets):
+            subnet_name = "%s-%s-subnet-%d" % (vpc, zone_name, s + 1)
+            instance_groups = []
+            for k in range(groups):
+                if quantities[g] > 0:
+                    group = {"name": "vsi-s%dg%d-%%04d" % (s + 1, k + 1),
+                             "quantity": quantities[g],
+                             "template": "%s-template" % vpc,
+                             "floating_ip": floating_ip,
+                             "security_group": "%s-sg" % vpc}
+                    if load_balancers > 0:
+                        # deal groups out across every load balancer and pool in turn
+                        lb = g % load_balancers
+                        pool = (g // load_balancers) % pools
+                        group["in_lb_pool"] = [{"lb_name": "%s-lb-%d" % (vpc, lb + 1),
+                                                "lb_pool": "pool-%d" % (pool + 1),
+                                                "listen_port": 80 + pool}]
+                    instance_groups.append(group)
+                g += 1
+
+            hosts = sum([group["quantity"] for group in instance_groups])
+            subnet = {"name": subnet_name,
+                      "ipv4_cidr_block": str(allocator.allocate(subnetprefix(hosts))),
+                      "network_acl": "%s-acl" % vpc,
+                      "publicGateway": True}
+            if len(instance_groups) > 0:
+                subnet["instances"] = instance_groups
+            subnet_list.append(subnet)
+
+        # load balancers are placed in the first subnet of each zone
+        for name in lb_subnets:
+            lb_subnets[name].append(subnet_list[0]["name"])
+        zone_list.append({"name": zone_name, "address_prefix_cidr": str(address_prefix), "subnets": subnet_list})
+
+    lb_list = []
+    for name in sorted(lb_subnets):
+        lb_list.append({
+            "lbInstance": name,
+            "is_public": True,
+            "subnets": lb_subnets[name],
+            "listeners": [{"protocol": "http", "port": 80 + p, "connection_limit": 100,
+                           "default_pool_name": "pool-%d" % (p + 1)} for p in range(pools)],
+            "pools": [{"name": "pool-%d" % (p + 1), "protocol": "http", "algorithm": "round_robin",
+                       "health_monitor": {"type": "http", "delay": 5, "max_retries": 2, "timeout": 2,
+                                          "url_path": "/"}} for p in range(pools)]})
+
+    acl_rules = [{"name": "allow-all-in", "direction": "inbound", "action": "allow",
+                  "source": "0.0.0.0/0", "destination": "0.0.0.0/0"},
+                 {"name": "allow-all-out", "direction": "outbound", "action": "allow",
+                  "source": "0.0.0.0/0", "destination": "0.0.0.0/0"}]
+
+    return [{
+        "vpc": vpc,
+        "region": region,
+        "classic_access": False,
+        "resource_group": "default",
+        "default_network_acl": "%s-acl" % vpc,
+        "instanceTemplates": [{"template": "%s-template" % vpc, "image": "ubuntu-16.04-amd64",
+                               "profile_name": "c-2x4", "sshkey": "%s-key" % vpc, "cloud-init-file": cloud_init}],
+        "zones": zone_list,
+        "load_balancers": lb_list,
+        "security_groups": [{"security_group": "%s-sg" % vpc,
+                             "rules": [{"direction": "inbound", "ip_version": "ipv4", "protocol": "all",
+                                        "remote": {"cidr_block": cidr}},
+                                       {"direction": "outbound", "ip_version": "ipv4", "protocol": "all",
+                                        "remote": {"cidr_block": "0.0.0.0/0"}}]}],
+        "network_acls": [{"network_acl": "%s-acl" % vpc, "rules": acl_rules}],
+        "sshkeys": [{"sshkey": "%s-key" % vpc, "public_key": "ssh-rsa AAAAB3NzaC1yc2E %s" % vpc}],
+    }]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a VPC topology yaml file for scale testing.")
+    parser.add_argument("-z", "--zones", type=int, default=3, help="Number of zones")
+    parser.add_argument("-m", "--subnets", type=int, default=1, help="Subnets per zone")
+    parser.add_argument("-k", "--groups", type=int, default=1, help="Instance groups per subnet")
+    parser.add_argument("-q", "--quantity", type=int, default=1, help="Instances per group")
+    parser.add_argument("-n", "--instances", type=int, help="Total instances, spread over the groups (overrides -q)")
+    parser.add_argument("-l", "--load-balancers", type=int, default=1, help="Number of load balancers")
+    parser.add_argument("-p", "--pools", type=int, default=1, help="Pools per load balancer")
+    parser.add_argument("--vpc", default="scale-vpc", help="VPC name, also used to prefix resource names")
+    parser.add_argument("--region", default="us-south", help="Region")
+    parser.add_argument("--cidr", default="10.0.0.0/8", help="Block the zone address prefixes are carved from")
+    parser.add_argument("--zone-prefix", type=int, default=18, help="Prefix length of each zone's address prefix")
+    parser.add_argument("--floating-ip", action="store_true", help="Assign every instance a floating ip")
+    parser.add_argument("--cloud-init", default="cloud-init-web.txt", help="cloud-init file for the template")
+    parser.add_argument("-o", "--output", help="File to write (default stdout)")
+    args = parser.parse_args()
+
+    try:
+        topology = generate(args.zones, args.subnets, args.groups, args.quantity, args.instances, args.load_balancers,
+                            args.pools, args.vpc, args.region, args.cidr, args.zone_prefix, args.floating_ip,
+                            args.cloud_init)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    if args.output is None:
+        yaml.safe_dump(topology, sys.stdout, default_flow_style=False, sort_keys=False)
+    else:
+        with open(args.output, 'w') as stream:
+            yaml.safe_dump(topology, stream, default_flow_style=False, sort_keys=False)
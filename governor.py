@@ -0,0 +1,178 @@
+## governor - Client side rate limiting and retry policy for RIAS requests.
+##
+
+import time, random, threading, requests
+from email.utils import parsedate_to_datetime
+from tracing import endpoint
+
+# statuses that mean the request was not processed and is safe to resend
+RETRY_ALWAYS = (429, 503)
+# transient errors that are only retried for idempotent methods
+RETRY_IDEMPOTENT = (500, 502, 504)
+IDEMPOTENT = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+
+class TokenBucket(object):
+    ################################################
+    ## Allow rate requests per second with bursts of
+    ## up to capacity.  The rate is halved when the
+    ## server pushes back and recovers gradually on
+    ## success, so it settles near the allowed rate.
+    ################################################
+
+    def __init__(self, rate, capacity):
+        self.limit = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.paused = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        ################################################
+        ## Block until a token is available
+        ################################################
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.paused - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    def throttle(self, delay):
+        ################################################
+        ## Hold every caller for delay seconds and slow
+        ## down after a rate limit response
+        ################################################
+
+        with self.lock:
+            self.paused = max(self.paused, time.time() + delay)
+            self.rate = max(self.rate / 2, self.limit / 16)
+            self.tokens = 0
+
+    def succeed(self):
+        with self.lock:
+            self.rate = min(self.limit, self.rate + self.limit / 20)
+
+
+class Governor(object):
+    ################################################
+    ## Route requests through a token bucket per
+    ## resource collection and retry rate limited or
+    ## transient failures with jittered exponential
+    ## backoff, honouring Retry-After.
+    ################################################
+
+    def __init__(self, rate=10.0, burst=20, budgets=None, retries=6, initial=1.0, maximum=30.0, tracer=None):
+        self.rate = rate
+        self.burst = burst
+        # collection -> (rate, burst) overriding the default budget
+        self.budgets = dict(budgets or {})
+        self.retries = retries
+        self.initial = initial
+        self.maximum = maximum
+        # records every attempt, throttle delay and backoff when set
+        self.tracer = tracer
+        self.lock = threading.Lock()
+        self.buckets = {}
+        # requests sent, including retries
+        self.sent = 0
+
+    def bucket(self, path):
+        ################################################
+        ## Return the bucket for a request path, keyed by
+        ## its top level collection (/v1/instances/... ->
+        ## instances)
+        ################################################
+
+        parts = [part for part in path.split("/") if part]
+        key = parts[1] if len(parts) > 1 else path
+        with self.lock:
+            if key not in self.buckets:
+                rate, burst = self.budgets.get(key, (self.rate, self.burst))
+                self.buckets[key] = TokenBucket(rate, burst)
+            return self.buckets[key]
+
+    def send(self, method, path, func):
+        ################################################
+        ## Call func() to send the request, retrying
+        ## until it succeeds or retries run out.  The
+        ## last response is returned either way so
+        ## callers handle errors as before.
+        ################################################
+
+        bucket = self.bucket(path)
+        name = endpoint(method, path)
+        attempt = 0
+        while True:
+            start = time.time()
+            bucket.acquire()
+            sent = time.time()
+            with self.lock:
+                self.sent += 1
+            if self.tracer is not None and sent - start > 0.001:
+                self.tracer.record("throttle", name, start, sent)
+            try:
+                resp = func()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if self.tracer is not None:
+                    self.tracer.record("request", name, sent, time.time(), status=type(e).__name__, attempt=attempt)
+                if method not in IDEMPOTENT or attempt >= self.retries:
+                    raise
+                delay = self.backoff(attempt)
+                print("%s %s failed (%s).  Retrying in %.1f seconds..." % (method, path, e, delay))
+            else:
+                if self.tracer is not None:
+                    self.tracer.record("request", name, sent, time.time(), status=resp.status_code, attempt=attempt,
+                                       bytes=len(resp.content))
+                if resp.status_code == 429 and attempt < self.retries:
+                    delay = retryafter(resp)
+                    if delay is None:
+                        delay = self.backoff(attempt)
+                    bucket.throttle(delay)
+                    print("Rate limited on %s.  Retrying in %.1f seconds..." % (path, delay))
+                elif attempt < self.retries and (resp.status_code in RETRY_ALWAYS or
+                                                 (resp.status_code in RETRY_IDEMPOTENT and method in IDEMPOTENT)):
+                    delay = retryafter(resp)
+                    if delay is None:
+                        delay = self.backoff(attempt)
+                    print("%s Error on %s %s.  Retrying in %.1f seconds..." % (resp.status_code, method, path,
+                                                                              delay))
+                else:
+                    if resp.status_code < 400:
+                        bucket.succeed()
+                    return resp
+            attempt += 1
+            start = time.time()
+            time.sleep(delay)
+            if self.tracer is not None:
+                self.tracer.record("backoff", name, start, time.time(), attempt=attempt)
+
+    def backoff(self, attempt):
+        delay = min(self.initial * (2 ** attempt), self.maximum)
+        return delay * (0.5 + random.random() / 2)
+
+
+def retryafter(resp):
+    ################################################
+    ## Seconds to wait from a Retry-After header,
+    ## given either as seconds or an HTTP date
+    ################################################
+
+    value = resp.headers.get("Retry-After")
+    if value is None:
+        return
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return
@@ -0,0 +1,151 @@
+## iamtoken - IAM access tokens for the API clients, exchanged from an API key and refreshed before they expire.
+##
+
+import os, sys, json, time, requests, threading
+
+IAM_ENDPOINT = "https://iam.cloud.ibm.com"
+APIKEY_GRANT = "urn:ibm:params:oauth:grant-type:apikey"
+
+
+class TokenProvider(object):
+    ################################################
+    ## Exchange an API key for an access token and
+    ## cache it.  Once most of its lifetime has
+    ## passed, the first caller to notice refreshes
+    ## it while every other worker keeps using the
+    ## current token, so a refresh never holds up
+    ## requests.  Callers only wait on the refresh
+    ## in flight when there is no usable token.
+    ################################################
+
+    def __init__(self, apikey, endpoint=IAM_ENDPOINT, refresh=0.8, timeout=30, retries=3, session=None):
+        self.apikey = apikey
+        self.endpoint = endpoint
+        # fraction of the token's lifetime after which it is refreshed
+        self.refresh = refresh
+        self.timeout = timeout
+        self.retries = retries
+        self.session = session or requests.Session()
+        self.condition = threading.Condition()
+        self.token = None
+        self.expires = 0
+        self.renew = 0
+        self.refreshing = False
+
+    def authorization(self):
+        ################################################
+        ## Return the Authorization header value,
+        ## refreshing the token when it is due
+        ################################################
+
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.token is not None and now < self.renew:
+                    return self.token
+                if not self.refreshing:
+                    # this caller refreshes, everyone else uses the current token or waits for it
+                    self.refreshing = True
+                    break
+                if self.token is not None and now < self.expires:
+                    return self.token
+                self.condition.wait()
+
+        try:
+            token, expires, renew = self.exchange()
+        except Exception:
+            with self.condition:
+                self.refreshing = False
+                self.condition.notify_all()
+                if self.token is not None and time.time() < self.expires:
+                    # still valid, try again on a later request
+                    print("IAM token refresh failed, using the current token until it expires.")
+                    return self.token
+            raise
+
+        with self.condition:
+            self.token, self.expires, self.renew = token, expires, renew
+            self.refreshing = False
+            self.condition.notify_all()
+            return self.token
+
+    def invalidate(self, token):
+        ################################################
+        ## Drop a token the API rejected (401) so the
+        ## next caller refreshes it, unless it was
+        ## already replaced
+        ################################################
+
+        with self.condition:
+            if token == self.token:
+                self.renew = 0
+                self.expires = 0
+
+    def exchange(self):
+        ################################################
+        ## Request a token for the API key.  Returns
+        ## (header value, expiry time, refresh time).
+        ################################################
+
+        attempt = 0
+        while True:
+            try:
+                resp = self.session.post(self.endpoint + "/identity/token", timeout=self.timeout,
+                                         data={"grant_type": APIKEY_GRANT, "apikey": self.apikey},
+                                         headers={"Accept": "application/json"})
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries:
+                    raise
+                print("IAM token request failed (%s).  Retrying..." % e)
+            else:
+                if resp.status_code == 200:
+                    break
+                if (resp.status_code < 500 and resp.status_code != 429) or attempt >= self.retries:
+                    raise TokenError("%s Error getting an IAM token: %s" % (resp.status_code, resp.text))
+                print("%s Error getting an IAM token.  Retrying..." % resp.status_code)
+            attempt += 1
+            time.sleep(2 ** attempt)
+
+        token = json.loads(resp.content)
+        now = time.time()
+        expires = token.get("expiration", now + token["expires_in"])
+        lifetime = token.get("expires_in", expires - now)
+        return ("%s %s" % (token.get("token_type", "Bearer"), token["access_token"]), expires,
+                expires - lifetime * (1 - self.refresh))
+
+
+class StaticToken(object):
+    ################################################
+    ## A fixed Authorization header, as written to
+    ## the iam_token file by gettoken
+    ################################################
+
+    def __init__(self, token):
+        self.token = token
+
+    def authorization(self):
+        return self.token
+
+    def invalidate(self, token):
+        pass
+
+
+class TokenError(Exception):
+    pass
+
+
+def tokenprovider(apikey=None, endpoint=IAM_ENDPOINT, token_file="iam_token"):
+    ################################################
+    ## Return a provider for the API key, from the
+    ## argument or IBMCLOUD_API_KEY, or else for the
+    ## token in token_file
+    ################################################
+
+    apikey = apikey or os.environ.get("IBMCLOUD_API_KEY")
+    if apikey:
+        return TokenProvider(apikey, endpoint=endpoint)
+    if not os.path.exists(token_file):
+        print("Set IBMCLOUD_API_KEY, pass --apikey or create %s by running gettoken." % token_file)
+        sys.exit(1)
+    with open(token_file, 'r') as stream:
+        return StaticToken(stream.read().strip())
@@ -0,0 +1,142 @@
+## inventory - Per-run cache of RIAS resource collections indexed by name and id.
+##
+
+import threading
+
+
+class Inventory(object):
+    ################################################
+    ## List each collection once per run and keep
+    ## name->ids and id->object indexes, updated from
+    ## create/delete responses instead of re-querying.
+    ## Collections are streamed page by page, so a
+    ## name lookup only reads as far as its match.
+    ################################################
+
+    def __init__(self, rias):
+        self.rias = rias
+        self.lock = threading.Lock()
+        self.loading = {}
+        self.streams = {}
+        self.ids = {}
+        self.names = {}
+        self.removed = {}
+
+    def open(self, collection):
+        ################################################
+        ## Start streaming a collection the first time
+        ## it is used
+        ################################################
+
+        with self.lock:
+            if collection not in self.ids:
+                self.ids[collection] = {}
+                self.names[collection] = {}
+                self.removed[collection] = set()
+                self.streams[collection] = self.rias.collection('/v1/' + collection, collection)
+                self.loading[collection] = threading.Lock()
+            return self.loading[collection]
+
+    def pull(self, collection, found=None):
+        ################################################
+        ## Index items from the stream until found(obj)
+        ## is true or the collection is exhausted.
+        ## Returns the item found.
+        ################################################
+
+        # only one thread reads a stream, others wait for its result
+        with self.open(collection):
+            while self.streams[collection] is not None:
+                try:
+                    obj = next(self.streams[collection], None)
+                except BaseException:
+                    # a failed page (or quit()) closes the generator; start the listing over rather
+                    # than let the next caller take what was read so far as the whole collection
+                    self.streams[collection] = self.rias.collection('/v1/' + collection, collection)
+                    raise
+                if obj is None:
+                    self.streams[collection] = None
+                    break
+                with self.lock:
+                    if obj["id"] in self.ids[collection] or obj["id"] in self.removed[collection]:
+                        # already recorded from a create or delete response
+                        continue
+                    self.ids[collection][obj["id"]] = obj
+                    self.names[collection].setdefault(obj.get("name"), []).append(obj["id"])
+                if found is not None and found(obj):
+                    return obj
+        return
+
+    def load(self, collection):
+        ################################################
+        ## Read the whole collection
+        ################################################
+
+        self.pull(collection)
+
+    def lookup(self, collection, name, match):
+        with self.lock:
+            for id in self.names[collection].get(name, []):
+                obj = self.ids[collection][id]
+                if match is None or match(obj):
+                    return obj
+        return
+
+    def find(self, collection, name, match=None):
+        ################################################
+        ## Return the first object with name (and
+        ## matching match(obj) if given) or None
+        ################################################
+
+        self.open(collection)
+        obj = self.lookup(collection, name, match)
+        if obj is None:
+            obj = self.pull(collection, lambda o: o.get("name") == name and (match is None or match(o)))
+        if obj is None:
+            # another thread may have indexed it while we waited for the stream
+            obj = self.lookup(collection, name, match)
+        return obj
+
+    def filter(self, collection, match):
+        ################################################
+        ## Return every object where match(obj) is true
+        ################################################
+
+        self.load(collection)
+        with self.lock:
+            return [obj for obj in self.ids[collection].values() if match(obj)]
+
+    def get(self, collection, id):
+        self.open(collection)
+        with self.lock:
+            obj = self.ids[collection].get(id)
+        if obj is None:
+            obj = self.pull(collection, lambda o: o["id"] == id)
+        return obj
+
+    def add(self, collection, obj):
+        ################################################
+        ## Record a created (or refreshed) object
+        ################################################
+
+        self.open(collection)
+        with self.lock:
+            previous = self.ids[collection].get(obj["id"])
+            if previous is not None:
+                self.names[collection][previous.get("name")].remove(obj["id"])
+            self.ids[collection][obj["id"]] = obj
+            self.names[collection].setdefault(obj.get("name"), []).append(obj["id"])
+        return obj
+
+    def remove(self, collection, id):
+        ################################################
+        ## Forget a deleted object
+        ################################################
+
+        self.open(collection)
+        with self.lock:
+            self.removed[collection].add(id)
+            obj = self.ids[collection].pop(id, None)
+            if obj is not None:
+                self.names[collection][obj.get("name")].remove(id)
+        return
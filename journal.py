@@ -0,0 +1,137 @@
+## journal - Write-ahead log of the graph nodes a run started and completed, so an interrupted run can resume.
+##
+
+import os, json, hashlib, threading
+
+
+class Journal(object):
+    ################################################
+    ## Append a line when a node starts and another
+    ## with its result when it completes, flushed as
+    ## they happen.  Each result is stored with the
+    ## node's fingerprint, so after the topology is
+    ## edited only the results of the nodes whose
+    ## part of it is unchanged are resumed.
+    ################################################
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stream = None
+        # node -> fingerprint for this run
+        self.fingerprints = {}
+
+    def begin(self, fingerprints):
+        ################################################
+        ## Start a new journal for a run
+        ################################################
+
+        with self.lock:
+            self.fingerprints = fingerprints
+            self.stream = open(self.path, 'w')
+            self.write({"journal": 2})
+
+    def resume(self, fingerprints):
+        ################################################
+        ## Return (completed, started) from the journal,
+        ## where completed is node -> result for nodes
+        ## whose fingerprint still matches and started
+        ## the nodes that never completed, and keep
+        ## appending to it.  Returns None if there is no
+        ## journal.
+        ################################################
+
+        if not os.path.exists(self.path):
+            print("No journal found at %s, planning from the current state instead." % self.path)
+            return
+        completed = {}
+        started = set()
+        with open(self.path, 'r') as stream:
+            lines = stream.readlines()
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line may be partial if the run was killed mid write
+                continue
+            if entry["status"] == "start":
+                started.add(entry["node"])
+            else:
+                completed[entry["node"]] = entry
+        changed = [node for node in completed if completed[node].get("spec") != fingerprints.get(node)]
+        if len(changed) > 0:
+            print("%s completed steps have changed in the topology since %s was written and will run again." % (
+                len(changed), self.path))
+        with self.lock:
+            self.fingerprints = fingerprints
+            self.stream = open(self.path, 'a')
+        return (dict((node, entry["result"]) for node, entry in completed.items() if node not in changed),
+                started - set(completed))
+
+    def started(self, node, state):
+        ################################################
+        ## Scheduler observer: log nodes as they start
+        ################################################
+
+        if state == "start":
+            with self.lock:
+                self.write({"node": node, "status": "start"})
+
+    def finished(self, node, result):
+        ################################################
+        ## Scheduler listener: log a node's result
+        ################################################
+
+        with self.lock:
+            self.write({"node": node, "status": "done", "result": result, "spec": self.fingerprints.get(node)})
+
+    def write(self, entry):
+        if self.stream is not None:
+            self.stream.write(json.dumps(entry) + "\n")
+            self.stream.flush()
+
+    def remove(self):
+        ################################################
+        ## Drop the journal once a run has completed
+        ################################################
+
+        with self.lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def journalpath(topology_file, index=0):
+    ################################################
+    ## Default journal for an entry of a topology
+    ## file
+    ################################################
+
+    if index == 0:
+        return os.path.splitext(topology_file)[0] + ".journal"
+    return os.path.splitext(topology_file)[0] + ".%d.journal" % index
+
+
+def fingerprints(sched):
+    ################################################
+    ## Hash each node's spec together with the
+    ## fingerprints of its dependencies, so a change
+    ## to one part of the topology also changes every
+    ## node built on it
+    ################################################
+
+    found = {}
+
+    def fingerprint(name):
+        if name not in found:
+            node = sched.nodes[name]
+            text = json.dumps([name, node["spec"], [fingerprint(dep) for dep in sorted(set(node["deps"]))]],
+                              sort_keys=True, default=str)
+            found[name] = hashlib.sha256(text.encode()).hexdigest()
+        return found[name]
+
+    for name in sched.order:
+        fingerprint(name)
+    return found
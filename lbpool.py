@@ -0,0 +1,101 @@
+## lbpool - Reconcile load balancer pool members with the in_lb_pool entries of a topology.
+##
+
+import json, time
+
+
+def poolindex(topology):
+    ################################################
+    ## Map (lb_name, lb_pool) to the (instance name,
+    ## port) of every member, from in_lb_pool
+    ################################################
+
+    pools = {}
+    for zone in topology["zones"]:
+        for subnet in zone["subnets"]:
+            for instance in subnet.get("instances", []):
+                for in_lb_pool in instance.get("in_lb_pool", []):
+                    members = pools.setdefault((in_lb_pool["lb_name"], in_lb_pool["lb_pool"]), [])
+                    for count in range(1, instance["quantity"] + 1):
+                        members.append(((instance["name"] % count) + "-" + zone["name"], in_lb_pool["listen_port"]))
+    return pools
+
+
+def livemembers(rias, lb_id):
+    ################################################
+    ## Return pool name -> (pool id, {(address,
+    ## port): member id}) for a load balancer
+    ################################################
+
+    pools = {}
+    for pool in rias.collection('/v1/load_balancers/' + lb_id + '/pools', "pools", prefetch=False):
+        members = rias.collection('/v1/load_balancers/' + lb_id + '/pools/' + pool["id"] + '/members', "members",
+                                  prefetch=False)
+        pools[pool["name"]] = (pool["id"], dict(((member["target"]["address"], member["port"]), member["id"])
+                                                for member in members))
+    return pools
+
+
+def delta(desired, live):
+    ################################################
+    ## Members to add and remove.  desired is pool
+    ## name -> [(address, port)]; pools the load
+    ## balancer doesn't have are skipped.  Returns
+    ## ([(pool id, (address, port))],
+    ##  [(pool id, member id)]).
+    ################################################
+
+    adds = []
+    removes = []
+    for name in sorted(desired):
+        if name not in live:
+            continue
+        pool_id, members = live[name]
+        wanted = set(desired[name])
+        adds += [(pool_id, member) for member in sorted(wanted - set(members))]
+        removes += [(pool_id, members[member]) for member in sorted(set(members) - wanted)]
+    return adds, removes
+
+
+def reconcile(rias, waiter, lb_id, desired):
+    ################################################
+    ## Bring each pool whose members differ from
+    ## desired up to date with one PUT of its whole
+    ## member list.  Every change locks the load
+    ## balancer until it is applied, so the pools
+    ## are sent one after another.  Returns (added,
+    ## removed).
+    ################################################
+
+    live = livemembers(rias, lb_id)
+    adds, removes = delta(desired, live)
+    changed = set([pool_id for pool_id, member in adds + removes])
+    for name in sorted(desired):
+        if name not in live or live[name][0] not in changed:
+            continue
+        members = [{"port": port, "target": {"address": address}, "weight": 100}
+                   for address, port in sorted(set(desired[name]))]
+        change(rias, waiter, "PUT", '/v1/load_balancers/' + lb_id + '/pools/' + live[name][0] + '/members',
+               {"members": members})
+    return len(adds), len(removes)
+
+
+def change(rias, waiter, method, path, payload=None):
+    ################################################
+    ## Send one pool change.  A load balancer
+    ## refuses changes (409) while it applies an
+    ## earlier one, so back off and resend until the
+    ## load balancer deadline passes.
+    ################################################
+
+    intervals = waiter.intervals("load_balancers")
+    while True:
+        resp = rias.request(method, path, json=payload)
+        if resp.status_code < 400 or (method == "DELETE" and resp.status_code == 404):
+            return
+        delay = next(intervals, None)
+        if resp.status_code != 409 or delay is None:
+            print("%s Error on %s %s." % (resp.status_code, method, path))
+            print("Error Data:  %s" % json.loads(resp.content)['errors'])
+            quit()
+        time.sleep(delay)
@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+## mockrias - A local stand-in for the RIAS /v1 API used to exercise provision-vpc.py and destroy-vpc.py.
+##
+
+import json, time, uuid, random, threading, argparse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+# collections served under /v1/<collection> and the status each resource settles into
+COLLECTIONS = {
+    "vpcs": "available",
+    "subnets": "available",
+    "instances": "running",
+    "network_acls": None,
+    "security_groups": None,
+    "public_gateways": "available",
+    "floating_ips": "available",
+    "vpn_gateways": "available",
+    "load_balancers": "active",
+    "keys": None,
+    "images": "available",
+}
+
+
+class MockRias(object):
+    ################################################
+    ## In-memory RIAS resource store
+    ################################################
+
+    def __init__(self, region="us-south", latency=0.0, delay=0.0, page_limit=50, error_rate=0.0, token_lifetime=0,
+                 lb_update=0.0):
+        self.region = region
+        self.latency = latency
+        self.delay = delay
+        # seconds a load balancer stays update_pending, refusing further changes (409), after a member change
+        self.lb_update = lb_update
+        self.page_limit = page_limit
+        self.error_rate = error_rate
+        # seconds issued tokens are valid for; 0 accepts any Authorization header
+        self.token_lifetime = token_lifetime
+        # access token -> expiry time
+        self.tokens = {}
+        self.issued = 0
+        self.endpoint = None
+        self.lock = threading.Lock()
+        self.store = dict((name, {}) for name in COLLECTIONS)
+        self.prefixes = {}
+        self.pending = {}
+        self.deleting = {}
+        # load balancer id -> time its member change is applied
+        self.updating = {}
+        self.requests = 0
+        self.inflight = 0
+        self.peak = 0
+        self.addimage("ubuntu-16.04-amd64")
+
+    def reset(self):
+        ################################################
+        ## Zero the request counters
+        ################################################
+
+        with self.lock:
+            self.requests = 0
+            self.peak = self.inflight
+
+    def issue(self):
+        ################################################
+        ## Return a new IAM token response
+        ################################################
+
+        lifetime = self.token_lifetime or 3600
+        token = "mock-" + self.newid()
+        self.tokens[token] = time.time() + lifetime
+        self.issued += 1
+        return {"access_token": token, "token_type": "Bearer", "expires_in": lifetime,
+                "expiration": int(time.time() + lifetime)}
+
+    def authorized(self, header):
+        ################################################
+        ## Whether an Authorization header holds a token
+        ## that hasn't expired
+        ################################################
+
+        if self.token_lifetime == 0:
+            return True
+        token = (header or "").split(" ")[-1]
+        return time.time() < self.tokens.get(token, 0)
+
+    def addimage(self, name):
+        image = {"id": self.newid(), "name": name, "status": "available"}
+        self.store["images"][image["id"]] = image
+        return image
+
+    def newid(self):
+        return str(uuid.uuid4())
+
+    def settle(self):
+        ################################################
+        ## Move pending/deleting resources along
+        ################################################
+
+        now = time.time()
+        for (collection, id), ready in list(self.pending.items()):
+            if ready <= now:
+                del self.pending[(collection, id)]
+                if id in self.store[collection]:
+                    self.store[collection][id]["status"] = COLLECTIONS[collection]
+                    if collection == "load_balancers":
+                        self.store[collection][id]["provisioning_status"] = "active"
+                        self.store[collection][id]["operating_status"] = "online"
+        for (collection, id), ready in list(self.deleting.items()):
+            if ready <= now:
+                del self.deleting[(collection, id)]
+                self.store[collection].pop(id, None)
+        for id, ready in list(self.updating.items()):
+            if ready <= now:
+                del self.updating[id]
+                if id in self.store["load_balancers"]:
+                    self.store["load_balancers"][id]["provisioning_status"] = "active"
+
+    def update(self, lb):
+        ################################################
+        ## Start applying a member change to a load
+        ## balancer.  Returns False if it is still
+        ## applying an earlier one.
+        ################################################
+
+        if lb["id"] in self.updating or lb.get("provisioning_status", "active") != "active":
+            return False
+        if self.lb_update > 0:
+            lb["provisioning_status"] = "update_pending"
+            self.updating[lb["id"]] = time.time() + self.lb_update
+        return True
+
+    def create(self, collection, obj):
+        obj["id"] = self.newid()
+        obj["href"] = "%s/v1/%s/%s" % (self.endpoint, collection, obj["id"])
+        obj["created_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        if COLLECTIONS[collection] is not None:
+            if self.delay > 0:
+                obj["status"] = "pending"
+                if collection == "load_balancers":
+                    obj["provisioning_status"] = "create_pending"
+                    obj["operating_status"] = "offline"
+                self.pending[(collection, obj["id"])] = time.time() + self.delay
+            else:
+                obj["status"] = COLLECTIONS[collection]
+                if collection == "load_balancers":
+                    obj["provisioning_status"] = "active"
+                    obj["operating_status"] = "online"
+        self.store[collection][obj["id"]] = obj
+        return obj
+
+    def delete(self, collection, id):
+        obj = self.store[collection].get(id)
+        if obj is None:
+            return False
+        if self.delay > 0 and COLLECTIONS[collection] is not None:
+            obj["status"] = "deleting"
+            self.deleting[(collection, id)] = time.time() + self.delay
+        else:
+            del self.store[collection][id]
+        return True
+
+    def findbyid(self, collection, id):
+        return self.store[collection].get(id)
+
+    def ref(self, collection, id):
+        obj = self.store[collection].get(id)
+        if obj is None:
+            return {"id": id}
+        return {"id": id, "name": obj.get("name"), "href": obj.get("href")}
+
+    def matches(self, obj, query):
+        ################################################
+        ## Apply the collection filters used by the scripts
+        ################################################
+
+        for key, values in query.items():
+            value = values[0]
+            if key in ("version", "start", "limit", "generation"):
+                continue
+            if key == "name" and obj.get("name") != value:
+                return False
+            if key == "vpc.id" and obj.get("vpc", {}).get("id") != value:
+                return False
+            if key in ("network_interfaces.subnet.id", "network_interfaces.subnet.name"):
+                field = key.split(".")[-1]
+                subnets = [nic["subnet"].get(field) for nic in obj.get("network_interfaces", [])]
+                if value not in subnets:
+                    return False
+        return True
+
+    def page(self, collection, query, items):
+        ################################################
+        ## Paginate a list response with start/limit
+        ################################################
+
+        limit = min(int(query.get("limit", [self.page_limit])[0]), self.page_limit)
+        start = int(query.get("start", ["0"])[0])
+        body = {collection: items[start:start + limit], "limit": limit, "total_count": len(items),
+                "first": {"href": "%s/v1/%s?limit=%d" % (self.endpoint, collection, limit)}}
+        if start + limit < len(items):
+            body["next"] = {"href": "%s/v1/%s?start=%d&limit=%d" % (self.endpoint, collection, start + limit, limit),
+                            "start": str(start + limit)}
+        return body
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        return
+
+    def reply(self, status, body=None, headers=None):
+        data = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def error(self, status, message):
+        self.reply(status, {"errors": [{"code": str(status), "message": message}]})
+
+    def body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length == 0:
+            return {}
+        data = self.rfile.read(length).decode()
+        if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            return dict((key, values[0]) for key, values in parse_qs(data).items())
+        return json.loads(data)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        rias = self.server.rias
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = [p for p in url.path.split("/") if p]
+        payload = self.body() if method in ("POST", "PUT", "PATCH") else {}
+
+        with rias.lock:
+            rias.requests += 1
+            rias.inflight += 1
+            rias.peak = max(rias.peak, rias.inflight)
+        try:
+            if rias.latency > 0:
+                time.sleep(rias.latency)
+            if rias.error_rate > 0 and random.random() < rias.error_rate:
+                self.reply(429, {"errors": [{"code": "too_many_requests", "message": "Rate limit exceeded"}]},
+                           {"Retry-After": "1"})
+                return
+            with rias.lock:
+                if parts[:2] != ["identity", "token"] and not rias.authorized(self.headers.get("Authorization")):
+                    status, body = 401, {"errors": [{"code": "not_authorized", "message": "Token expired"}]}
+                else:
+                    rias.settle()
+                    status, body = route(rias, method, parts, query, payload)
+            self.reply(status, body)
+        finally:
+            with rias.lock:
+                rias.inflight -= 1
+
+
+def route(rias, method, parts, query, payload):
+    ################################################
+    ## Route a request to its handler
+    ################################################
+
+    if parts[:2] == ["identity", "token"]:
+        if not payload.get("apikey"):
+            return 400, {"errors": [{"code": "BXNIM0415E", "message": "Provided API key could not be found"}]}
+        return 200, rias.issue()
+    if parts[:2] == ["v2", "resource_groups"]:
+        return 200, {"resources": [{"id": "mock-default-resource-group", "name": "default"}]}
+    if len(parts) < 2 or parts[0] != "v1":
+        return 404, {"errors": [{"code": "not_found", "message": "Unknown path"}]}
+
+    collection = parts[1]
+    if collection == "regions":
+        # any region asked for is served from this endpoint
+        name = parts[2] if len(parts) > 2 else rias.region
+        region = {"name": name, "status": "available", "endpoint": rias.endpoint}
+        if len(parts) == 3:
+            return 200, region
+        if len(parts) == 4 and parts[3] == "zones":
+            return 200, {"zones": [{"name": "%s-%d" % (name, n), "status": "available"} for n in (1, 2, 3)]}
+    if collection not in COLLECTIONS:
+        return 404, {"errors": [{"code": "not_found", "message": "Unknown collection"}]}
+
+    if len(parts) == 2:
+        if method == "GET":
+            items = [obj for obj in rias.store[collection].values() if rias.matches(obj, query)]
+            return 200, rias.page(collection, query, items)
+        if method == "POST":
+            return createresource(rias, collection, payload)
+
+    id = parts[2] if len(parts) > 2 else None
+    obj = rias.findbyid(collection, id)
+    if obj is None:
+        return 404, {"errors": [{"code": "not_found", "message": "%s %s not found" % (collection, id)}]}
+
+    if len(parts) == 3:
+        if method == "GET":
+            return 200, obj
+        if method == "DELETE":
+            return deleteresource(rias, collection, obj)
+
+    return subresource(rias, method, collection, obj, parts[3:], query, payload)
+
+
+def createresource(rias, collection, payload):
+    ################################################
+    ## POST /v1/<collection>
+    ################################################
+
+    for existing in rias.store[collection].values():
+        if collection != "floating_ips" and existing.get("name") == payload.get("name") and \
+                existing.get("vpc", {}).get("id") == payload.get("vpc", {}).get("id"):
+            return 409, {"errors": [{"code": "conflict", "message": "Name %s in use" % payload.get("name")}]}
+
+    obj = dict(payload)
+    if collection == "subnets":
+        obj["vpc"] = rias.ref("vpcs", payload["vpc"]["id"])
+        obj["available_ipv4_address_count"] = 251
+    if collection == "instances":
+        nic = dict(payload["primary_network_interface"])
+        nic["id"] = rias.newid()
+        nic["subnet"] = rias.ref("subnets", nic["subnet"]["id"])
+        nic["primary_ipv4_address"] = "10.%d.%d.%d" % (random.randint(0, 255), random.randint(0, 255),
+                                                       random.randint(1, 254))
+        nic["floating_ips"] = []
+        obj["primary_network_interface"] = nic
+        obj["network_interfaces"] = [nic]
+        obj["vpc"] = rias.ref("vpcs", payload["vpc"]["id"])
+        obj.pop("user_data", None)
+    if collection == "floating_ips":
+        obj["address"] = "169.%d.%d.%d" % (random.randint(0, 255), random.randint(0, 255), random.randint(1, 254))
+        obj["name"] = "fip-" + rias.newid()[:8]
+        for instance in rias.store["instances"].values():
+            for nic in instance["network_interfaces"]:
+                if nic["id"] == payload["target"]["id"]:
+                    nic["floating_ips"].append(obj)
+    if collection == "vpn_gateways":
+        obj["connections"] = []
+        obj["vpc"] = rias.store["subnets"].get(payload["subnet"]["id"], {}).get("vpc", {})
+    if collection == "load_balancers":
+        for pool in obj.get("pools", []):
+            pool["id"] = rias.newid()
+            for member in pool.get("members", []):
+                member["id"] = rias.newid()
+    obj = rias.create(collection, obj)
+    if collection == "vpcs":
+        rias.prefixes[obj["id"]] = {}
+        if "default_network_acl" not in payload:
+            obj["default_network_acl"] = {}
+    return 201, obj
+
+
+def deleteresource(rias, collection, obj):
+    ################################################
+    ## DELETE /v1/<collection>/<id>
+    ################################################
+
+    if collection == "subnets":
+        for instance in rias.store["instances"].values():
+            if obj["id"] in [nic["subnet"]["id"] for nic in instance["network_interfaces"]]:
+                return 409, {"errors": [{"code": "conflict", "message": "Subnet in use"}]}
+    if collection == "vpcs":
+        for subnet in rias.store["subnets"].values():
+            if subnet["vpc"]["id"] == obj["id"]:
+                return 409, {"errors": [{"code": "conflict", "message": "VPC in use"}]}
+    rias.delete(collection, obj["id"])
+    return 204, None
+
+
+def subresource(rias, method, collection, obj, rest, query, payload):
+    ################################################
+    ## Nested resources used by the scripts
+    ################################################
+
+    if collection == "vpcs" and rest[0] == "address_prefixes":
+        prefixes = rias.prefixes.setdefault(obj["id"], {})
+        if len(rest) == 1 and method == "GET":
+            return 200, rias.page("address_prefixes", query, list(prefixes.values()))
+        if len(rest) == 1 and method == "POST":
+            for prefix in prefixes.values():
+                if prefix["name"] == payload["name"] or prefix["cidr"] == payload["cidr"]:
+                    return 409, {"errors": [{"code": "conflict", "message": "Prefix conflict"}]}
+            prefix = dict(payload, id=rias.newid())
+            prefixes[prefix["id"]] = prefix
+            return 201, prefix
+        if len(rest) == 2 and method == "DELETE":
+            if prefixes.pop(rest[1], None) is None:
+                return 404, {"errors": [{"code": "not_found", "message": "Prefix not found"}]}
+            return 204, None
+
+    if collection == "subnets" and rest == ["public_gateway"]:
+        if method == "PUT":
+            obj["public_gateway"] = rias.ref("public_gateways", payload["id"])
+            return 201, obj
+        if method == "DELETE":
+            obj.pop("public_gateway", None)
+            return 204, None
+
+    if collection == "instances" and rest[0] == "network_interfaces":
+        if len(rest) == 1:
+            return 200, {"network_interfaces": obj["network_interfaces"]}
+        nic = [n for n in obj["network_interfaces"] if n["id"] == rest[1]]
+        if len(nic) == 0:
+            return 404, {"errors": [{"code": "not_found", "message": "Interface not found"}]}
+        nic = nic[0]
+        if rest[2:] == ["floating_ips"]:
+            return 200, {"floating_ips": nic["floating_ips"]}
+        if len(rest) == 4 and method == "DELETE":
+            nic["floating_ips"] = [f for f in nic["floating_ips"] if f["id"] != rest[3]]
+            fip = rias.findbyid("floating_ips", rest[3])
+            if fip is not None:
+                fip.pop("target", None)
+            return 204, None
+
+    if collection == "vpn_gateways" and rest == ["connections"] and method == "GET":
+        return 200, {"connections": obj["connections"]}
+    if collection == "vpn_gateways" and rest == ["connections"] and method == "POST":
+        connection = dict(payload, id=rias.newid(), status="down")
+        obj["connections"].append(connection)
+        return 201, connection
+
+    if collection == "load_balancers" and rest[0] == "pools":
+        if len(rest) == 1:
+            return 200, {"pools": obj.get("pools", [])}
+        pool = [p for p in obj.get("pools", []) if p["id"] == rest[1]]
+        if len(pool) == 0:
+            return 404, {"errors": [{"code": "not_found", "message": "Pool not found"}]}
+        pool = pool[0]
+        if rest[2:3] == ["members"] and method != "GET" and not rias.update(obj):
+            return 409, {"errors": [{"code": "load_balancer_update_conflict",
+                                     "message": "Load balancer %s is updating" % obj["id"]}]}
+        if rest[2:] == ["members"]:
+            if method == "GET":
+                return 200, {"members": pool.get("members", [])}
+            if method == "POST":
+                member = dict(payload, id=rias.newid())
+                pool.setdefault("members", []).append(member)
+                return 201, member
+            if method == "PUT":
+                pool["members"] = [dict(m, id=rias.newid()) for m in payload.get("members", [])]
+                return 202, {"members": pool["members"]}
+        if len(rest) == 4 and rest[2] == "members" and method == "DELETE":
+            pool["members"] = [m for m in pool.get("members", []) if m["id"] != rest[3]]
+            return 204, None
+
+    return 404, {"errors": [{"code": "not_found", "message": "Unknown path"}]}
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(rias, host="127.0.0.1", port=0):
+    ################################################
+    ## Start the mock server in a background thread
+    ################################################
+
+    server = ThreadingServer((host, port), Handler)
+    server.rias = rias
+    rias.endpoint = "http://%s:%d" % server.server_address
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the RIAS API.")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--region", default="us-south", help="Region name to report when none is asked for")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of latency added to every request")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds before a resource becomes available")
+    parser.add_argument("--page-limit", type=int, default=50, help="Maximum page size for list calls")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--token-lifetime", type=int, default=0,
+                        help="Seconds IAM tokens from /identity/token are valid for; other tokens are refused "
+                             "(default 0 accepts any token)")
+    parser.add_argument("--lb-update", type=float, default=0.0,
+                        help="Seconds a load balancer takes to apply a pool member change; changes sent "
+                             "meanwhile are refused with 409")
+    args = parser.parse_args()
+
+    rias = MockRias(args.region, args.latency, args.delay, args.page_limit, args.error_rate, args.token_lifetime,
+                    args.lb_update)
+    server = serve(rias, port=args.port)
+    print("Mock RIAS listening on %s" % rias.endpoint)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
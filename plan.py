@@ -0,0 +1,344 @@
+## plan - Compare a topology with the resources that already exist and list the changes needed to converge it.
+##
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from lbpool import poolindex, livemembers, delta
+from statefile import TYPES
+
+# every collection read in the bulk pass
+COLLECTIONS = ["network_acls", "vpcs", "security_groups", "keys", "images", "public_gateways", "subnets",
+               "vpn_gateways", "instances", "floating_ips", "load_balancers"]
+
+
+class Plan(object):
+    ################################################
+    ## The creates, updates and deletes needed to
+    ## converge a topology, and the results of the
+    ## graph nodes that need no work.
+    ################################################
+
+    def __init__(self):
+        self.changes = []
+        self.existing = {}
+
+    def add(self, action, resource_type, name, node=None, detail=None):
+        self.changes.append({"action": action, "type": resource_type, "name": name, "node": node,
+                             "detail": detail})
+
+    def keep(self, node, result):
+        ################################################
+        ## Record the result of a node already in place
+        ################################################
+
+        self.existing[node] = result
+
+    def count(self, action):
+        return len([change for change in self.changes if change["action"] == action])
+
+    def converged(self):
+        return len([change for change in self.changes if change["action"] != "delete"]) == 0
+
+    def show(self):
+        ################################################
+        ## Print the changes
+        ################################################
+
+        symbols = {"create": "+", "update": "~", "delete": "-"}
+        for change in self.changes:
+            line = "%s %s %s %s" % (symbols[change["action"]], change["action"], change["type"], change["name"])
+            if change["detail"] is not None:
+                line += " (%s)" % change["detail"]
+            print(line)
+        print("Plan: %s to create, %s to update, %s to delete." % (
+            self.count("create"), self.count("update"), self.count("delete")))
+
+    def dump(self, filename):
+        ################################################
+        ## Write the changes as JSON
+        ################################################
+
+        with open(filename, 'w') as stream:
+            json.dump({"changes": self.changes}, stream, indent=2)
+
+
+def snapshot(inventory, workers=8):
+    ################################################
+    ## Read every collection once, in parallel
+    ################################################
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(inventory.load, COLLECTIONS))
+
+
+def recorded(state, inventory, rias, workers=8):
+    ################################################
+    ## Read back the resources in a state file.
+    ## Every collection is listed in the bulk pass
+    ## and each recorded id is looked up in it; only
+    ## the ids missing from the listing are read
+    ## with a GET.  Returns node -> object for those
+    ## that still exist and drops the entries whose
+    ## ids have gone stale, so they are looked up by
+    ## name instead.  Address prefixes are left to
+    ## the VPC's prefix list.
+    ################################################
+
+    snapshot(inventory, workers)
+    entries = dict((node, entry) for node, entry in state.entries().items()
+                   if entry["type"] != "address_prefixes")
+    found = dict((node, inventory.get(entry["type"], entry["id"])) for node, entry in entries.items())
+
+    def read(node):
+        entry = entries[node]
+        resp = rias.get('/v1/' + entry["type"] + '/' + entry["id"])
+        if resp.status_code == 404:
+            return
+        if resp.status_code != 200:
+            print("%s Error getting %s %s." % (resp.status_code, entry["type"], entry["id"]))
+            print("Error Data:  %s" % json.loads(resp.content)['errors'])
+            quit()
+        return inventory.add(entry["type"], json.loads(resp.content))
+
+    missing = [node for node in entries if found[node] is None]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        found.update(zip(missing, executor.map(read, missing)))
+
+    known = {}
+    for node, obj in found.items():
+        if obj is None:
+            print("%s %s in the state file no longer exists, looking it up by name." % (
+                node, entries[node]["id"]))
+            state.forget(node)
+        else:
+            known[node] = obj
+    return known
+
+
+def diff(topology, inventory, rias, workers=8, state=None):
+    ################################################
+    ## Build the plan for a topology.  Every
+    ## collection is read in one bulk pass, then
+    ## resources in the state file are matched by
+    ## id and anything else is looked up by name.
+    ## Node names match the provisioning graph in
+    ## provision-vpc.py.
+    ################################################
+
+    known = None
+    if state is not None and len(state.entries()) > 0:
+        known = recorded(state, inventory, rias, workers)
+    else:
+        snapshot(inventory, workers)
+    plan = Plan()
+
+    def named(collection, name, match=None, node=None):
+        obj = (known or {}).get(node)
+        if obj is not None and obj.get("name") == name and (match is None or match(obj)):
+            return obj
+        return inventory.find(collection, name, match)
+
+    def matching(collection, match, node):
+        obj = (known or {}).get(node)
+        if obj is not None and match(obj):
+            return [obj]
+        return inventory.filter(collection, match)
+
+    for network_acl in topology["network_acls"]:
+        existing = named("network_acls", network_acl["network_acl"], node="acl:" + network_acl["network_acl"])
+        if existing is None:
+            plan.add("create", "network_acls", network_acl["network_acl"], "acl:" + network_acl["network_acl"])
+        else:
+            plan.keep("acl:" + network_acl["network_acl"], existing["id"])
+
+    for sshkey in topology["sshkeys"]:
+        existing = named("keys", sshkey["sshkey"], node="key:" + sshkey["sshkey"])
+        if existing is None:
+            plan.add("create", "keys", sshkey["sshkey"], "key:" + sshkey["sshkey"])
+        else:
+            plan.keep("key:" + sshkey["sshkey"], existing["id"])
+
+    vpc = named("vpcs", topology["vpc"], node="vpc")
+    if vpc is None:
+        plan.add("create", "vpcs", topology["vpc"], "vpc")
+        vpc_id = None
+        prefixes = {}
+    else:
+        plan.keep("vpc", vpc["id"])
+        vpc_id = vpc["id"]
+        prefixes = dict((prefix["name"], prefix) for prefix in
+                        rias.collection('/v1/vpcs/' + vpc_id + '/address_prefixes', "address_prefixes"))
+
+    def invpc(obj):
+        return vpc_id is not None and obj.get("vpc", {}).get("id") == vpc_id
+
+    for security_group in topology["security_groups"]:
+        node = "sg:" + security_group["security_group"]
+        existing = named("security_groups", security_group["security_group"], invpc, node)
+        if existing is None:
+            plan.add("create", "security_groups", security_group["security_group"], node)
+        else:
+            plan.keep(node, existing["id"])
+
+    subnets = {}
+    instances = {}
+    addresses = {}
+    vpns = {}
+    gateway_zones = set()
+    for zone in topology["zones"]:
+        zone_name = zone["name"]
+        if "address_prefix_cidr" in zone:
+            prefix = prefixes.get(zone_name + "-address-prefix")
+            if prefix is None:
+                plan.add("create", "address_prefixes", zone_name + "-address-prefix", "prefix:" + zone_name,
+                         zone["address_prefix_cidr"])
+            else:
+                plan.keep("prefix:" + zone_name, prefix["id"])
+
+        if len([subnet for subnet in zone["subnets"] if subnet.get("publicGateway")]) > 0:
+            gateway_zones.add(zone_name)
+            gateway = matching("public_gateways", lambda gw, z=zone_name: invpc(gw) and gw['zone']['name'] == z,
+                               "gateway:" + zone_name)
+            if len(gateway) == 0:
+                plan.add("create", "public_gateways", topology["vpc"] + "-" + zone_name + "-gw",
+                         "gateway:" + zone_name)
+            else:
+                plan.keep("gateway:" + zone_name, gateway[0]["id"])
+
+        for subnet in zone["subnets"]:
+            existing = named("subnets", subnet["name"], node="subnet:" + subnet["name"])
+            subnets[subnet["name"]] = existing
+            if existing is None:
+                plan.add("create", "subnets", subnet["name"], "subnet:" + subnet["name"], subnet["ipv4_cidr_block"])
+            else:
+                plan.keep("subnet:" + subnet["name"], existing["id"])
+
+            if subnet.get("publicGateway"):
+                if existing is None or "public_gateway" not in existing:
+                    plan.add("update" if existing is not None else "create", "subnets", subnet["name"],
+                             "attach:" + subnet["name"], "attach public gateway")
+                else:
+                    plan.keep("attach:" + subnet["name"], existing["public_gateway"])
+
+            for vpn in subnet.get("vpn", []):
+                vpns[vpn["name"]] = vpn
+                gateway = named("vpn_gateways", vpn["name"], node="vpn:" + vpn["name"])
+                if gateway is None:
+                    plan.add("create", "vpn_gateways", vpn["name"], "vpn:" + vpn["name"])
+                    continue
+                connections = [connection["name"] for connection in
+                               rias.collection('/v1/vpn_gateways/' + gateway["id"] + '/connections', "connections",
+                                               prefetch=False)]
+                missing = [connection["name"] for connection in vpn.get("connections", [])
+                           if connection["name"] not in connections]
+                if len(missing) > 0:
+                    plan.add("update", "vpn_gateways", vpn["name"], "vpn:" + vpn["name"],
+                             "add connections " + ", ".join(missing))
+                else:
+                    plan.keep("vpn:" + vpn["name"], gateway["id"])
+
+            for instance in subnet.get("instances", []):
+                for q in range(1, instance["quantity"] + 1):
+                    instance_name = (instance["name"] % q) + "-" + zone_name
+                    instances[instance_name] = instance
+                    found = None
+                    if existing is not None:
+                        found = named("instances", instance_name,
+                                      lambda i, s=existing["id"]: i["primary_network_interface"]["subnet"]["id"] == s,
+                                      "instance:" + instance_name)
+                    if found is None:
+                        plan.add("create", "instances", instance_name, "instance:" + instance_name)
+                    else:
+                        plan.keep("instance:" + instance_name, found["id"])
+                        addresses[instance_name] = found["primary_network_interface"]["primary_ipv4_address"]
+
+                    if instance.get('floating_ip'):
+                        fip = None
+                        if found is not None:
+                            nic = found["primary_network_interface"]["id"]
+                            fip = matching("floating_ips", lambda f, n=nic: f.get("target", {}).get("id") == n,
+                                           "fip:" + instance_name)
+                        if not fip:
+                            plan.add("update" if found is not None else "create", "floating_ips", instance_name,
+                                     "fip:" + instance_name, "assign floating ip")
+                        else:
+                            plan.keep("fip:" + instance_name, (fip[0]["id"], fip[0]["address"]))
+
+    pools = poolindex(topology)
+    for lb in topology.get("load_balancers", []):
+        existing = named("load_balancers", lb["lbInstance"], node="lb:" + lb["lbInstance"])
+        if existing is None:
+            plan.add("create", "load_balancers", lb["lbInstance"], "lb:" + lb["lbInstance"])
+            continue
+        # instances still to be created stand in by name, so each counts as a member to add
+        desired = dict((pool["name"], [(addresses.get(instance_name, instance_name), port) for instance_name, port in
+                                       pools.get((lb["lbInstance"], pool["name"]), [])]) for pool in lb["pools"])
+        adds, removes = delta(desired, livemembers(rias, existing["id"]))
+        if len(adds) > 0 or len(removes) > 0:
+            plan.add("update", "load_balancers", lb["lbInstance"], "lb:" + lb["lbInstance"],
+                     "add %s, remove %s pool members" % (len(adds), len(removes)))
+        else:
+            plan.keep("lb:" + lb["lbInstance"], existing["id"])
+
+    if vpc_id is not None and known is None:
+        deletes(plan, topology, inventory, vpc, subnets, instances, vpns, gateway_zones)
+    elif vpc_id is not None:
+        undescribed(plan, known)
+    return plan
+
+
+def undescribed(plan, known):
+    ################################################
+    ## Add the resources in the state file that the
+    ## topology no longer describes.  Only a run
+    ## without a state file scans the VPC for
+    ## resources created some other way.
+    ################################################
+
+    described = set(plan.existing) | set(change["node"] for change in plan.changes if change["node"] is not None)
+    for node in sorted(known):
+        if node not in described:
+            obj = known[node]
+            plan.add("delete", TYPES[node.split(":")[0]], node.split(":", 1)[-1], detail=obj.get("address", obj["id"]))
+
+
+def deletes(plan, topology, inventory, vpc, subnets, instances, vpns, gateway_zones):
+    ################################################
+    ## Add resources in the VPC that the topology
+    ## no longer describes
+    ################################################
+
+    vpc_id = vpc["id"]
+    subnet_ids = set(subnet["id"] for subnet in inventory.filter("subnets", lambda s: s["vpc"]["id"] == vpc_id))
+
+    for subnet in inventory.filter("subnets", lambda s: s["id"] in subnet_ids and s["name"] not in subnets):
+        plan.add("delete", "subnets", subnet["name"], detail=subnet["id"])
+
+    for instance in inventory.filter("instances",
+                                     lambda i: i["primary_network_interface"]["subnet"]["id"] in subnet_ids):
+        if instance["name"] in instances:
+            if not instances[instance["name"]].get("floating_ip"):
+                for fip in inventory.filter("floating_ips", lambda f, n=instance["primary_network_interface"]["id"]:
+                                            f.get("target", {}).get("id") == n):
+                    plan.add("delete", "floating_ips", instance["name"], detail=fip["address"])
+        else:
+            plan.add("delete", "instances", instance["name"], detail=instance["id"])
+
+    for gateway in inventory.filter("public_gateways", lambda gw: gw["vpc"]["id"] == vpc_id and
+                                    gw["zone"]["name"] not in gateway_zones):
+        plan.add("delete", "public_gateways", gateway["name"], detail=gateway["id"])
+
+    for gateway in inventory.filter("vpn_gateways", lambda gw: gw["subnet"]["id"] in subnet_ids and
+                                    gw["name"] not in vpns):
+        plan.add("delete", "vpn_gateways", gateway["name"], detail=gateway["id"])
+
+    load_balancers = [lb["lbInstance"] for lb in topology.get("load_balancers", [])]
+    for lb in inventory.filter("load_balancers", lambda lb: lb["name"] not in load_balancers and
+                               len([s for s in lb["subnets"] if s["id"] in subnet_ids]) > 0):
+        plan.add("delete", "load_balancers", lb["name"], detail=lb["id"])
+
+    security_groups = [sg["security_group"] for sg in topology["security_groups"]]
+    default_security_group = vpc.get("default_security_group", {}).get("id")
+    for sg in inventory.filter("security_groups", lambda sg: sg["vpc"]["id"] == vpc_id and
+                               sg["name"] not in security_groups and sg["id"] != default_security_group):
+        plan.add("delete", "security_groups", sg["name"], detail=sg["id"])
@@ -0,0 +1,262 @@
+## progress - JSON lines event stream and live progress summary, written off the provisioning threads.
+##
+
+import sys, json, time, queue, threading
+from collections import deque
+from tracing import current
+from statefile import TYPES
+from scheduler import NodeExit
+
+# what the scheduler reports for a node -> position in the reporter's states
+STATES = {"queued": 0, "start": 1, "done": 2, "fail": 3}
+
+
+class Reporter(object):
+    ################################################
+    ## Own all terminal and event file output on one
+    ## writer thread.  Worker threads only queue
+    ## events, so a slow terminal or log pipe never
+    ## holds up provisioning.  Every interval the
+    ## per-type counts, requests/sec and ETA are
+    ## written as a progress event, and shown in
+    ## place of the messages when live.
+    ################################################
+
+    def __init__(self, events=None, live=False, interval=2.0, states=("pending", "creating", "available", "failed"),
+                 governor=None):
+        self.events = events
+        self.live = live
+        self.interval = interval
+        self.states = states
+        self.governor = governor
+        self.terminal = sys.stdout
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # node -> [resource type, state]
+        self.nodes = {}
+        self.started = time.time()
+        self.sent = (self.started, 0)
+        # the last messages, shown if a live run fails
+        self.recent = deque(maxlen=10)
+        # node -> its last messages, to explain a failure
+        self.last = {}
+        self.reported = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def capture(self):
+        ################################################
+        ## Route print() from every thread through the
+        ## writer as log events
+        ################################################
+
+        sys.stdout = LineStream(self)
+
+    def emit(self, event, **fields):
+        fields["event"] = event
+        fields["ts"] = round(time.time(), 3)
+        self.queue.put(fields)
+
+    def log(self, message):
+        node = current.get()
+        if node is not None and message.strip():
+            self.last.setdefault(node, deque(maxlen=2)).append(message.strip())
+        self.emit("log", message=message, node=node)
+
+    def say(self, message):
+        ################################################
+        ## Log a message that is shown even when live
+        ################################################
+
+        self.emit("log", message=message, node=current.get(), show=True)
+
+    def track(self, sched, names):
+        ################################################
+        ## Count the resource nodes among names by type
+        ## and state as the scheduler runs them
+        ################################################
+
+        with self.lock:
+            for name in names:
+                resource_type = TYPES.get(name.split(":")[0])
+                if resource_type is not None:
+                    self.nodes[name] = [resource_type, STATES["queued"]]
+        sched.observe(self.node)
+
+    def node(self, name, state):
+        ################################################
+        ## Scheduler observer: a node started ("start"),
+        ## finished ("done") or raised ("fail")
+        ################################################
+
+        with self.lock:
+            entry = self.nodes.get(name)
+            if entry is None:
+                return
+            entry[1] = STATES[state]
+        self.emit("resource", node=name, type=entry[0], state=self.states[entry[1]])
+
+    def summary(self):
+        ################################################
+        ## Return the progress event fields: counts of
+        ## each state per type, requests/sec and ETA
+        ################################################
+
+        now = time.time()
+        counts = {}
+        with self.lock:
+            for resource_type, state in self.nodes.values():
+                counts.setdefault(resource_type, dict((label, 0) for label in self.states))[self.states[state]] += 1
+        finished = sum([count[self.states[2]] + count[self.states[3]] for count in counts.values()])
+        remaining = len(self.nodes) - finished
+
+        rate = None
+        if self.governor is not None:
+            sent = self.governor.sent
+            if now > self.sent[0]:
+                rate = round((sent - self.sent[1]) / (now - self.sent[0]), 1)
+            self.sent = (now, sent)
+
+        eta = None
+        if finished > 0:
+            eta = round((now - self.started) / finished * remaining)
+        return {"elapsed": round(now - self.started), "types": counts, "requests_per_second": rate, "eta": eta}
+
+    def show(self, fields):
+        ################################################
+        ## Print a progress event as one line
+        ################################################
+
+        parts = []
+        for resource_type in sorted(fields["types"]):
+            count = fields["types"][resource_type]
+            line = "%s %s/%s" % (resource_type, count[self.states[2]], sum(count.values()))
+            if count[self.states[1]] > 0:
+                line += " (%s %s)" % (count[self.states[1]], self.states[1])
+            if count[self.states[3]] > 0:
+                line += " (%s %s)" % (count[self.states[3]], self.states[3])
+            parts.append(line)
+        if fields["requests_per_second"] is not None:
+            parts.append("%s req/s" % fields["requests_per_second"])
+        if fields["eta"] is not None:
+            parts.append("ETA %ss" % fields["eta"])
+        self.terminal.write("[%4ss] %s\n" % (fields["elapsed"], ", ".join(parts)))
+        self.terminal.flush()
+
+    def run(self):
+        ################################################
+        ## Writer thread: drain the queue to the event
+        ## file and terminal until closed
+        ################################################
+
+        due = time.time() + self.interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0, due - time.time()))
+            except queue.Empty:
+                item = {}
+
+            if item is None or time.time() >= due:
+                fields = self.summary()
+                self.write(dict(fields, event="progress", ts=round(time.time(), 3)))
+                if self.live and len(self.nodes) > 0:
+                    self.show(fields)
+                due = time.time() + self.interval
+            if item is None:
+                return
+            if len(item) > 0:
+                self.write(item)
+                if item["event"] == "log" and (not self.live or item.get("show")):
+                    self.terminal.write(item["message"] + "\n")
+                elif item["event"] == "log":
+                    self.recent.append(item["message"])
+
+            if self.queue.empty():
+                self.terminal.flush()
+                if self.events is not None:
+                    self.events.flush()
+
+    def write(self, item):
+        if self.events is not None:
+            self.events.write(json.dumps(item) + "\n")
+
+    def failures(self, sched, hint):
+        ################################################
+        ## Report the nodes that failed with what they
+        ## last printed, the nodes each one blocked and
+        ## the resources left to retry
+        ################################################
+
+        failed = []
+        retry = []
+        for name in sched.order:
+            if name not in sched.failures:
+                continue
+            error = sched.failures[name]
+            if isinstance(error, (SystemExit, NodeExit)):
+                # quit() carries no message, the node printed the reason before calling it
+                message = "  ".join(self.last.get(name, ["quit()"]))
+            else:
+                message = "%s: %s" % (type(error).__name__, error)
+            blocked = sched.blocked(name)
+            failed.append({"node": name, "error": message, "blocked": blocked})
+            retry += [node for node in [name] + blocked if node not in retry and node.split(":")[0] in TYPES]
+        self.emit("failures", failed=failed, retry=retry)
+        self.reported = True
+
+        self.say("%s steps failed and %s steps depending on them were not run:" % (
+            len(failed), len(set([node for failure in failed for node in failure["blocked"]]))))
+        for failure in failed:
+            self.say("  %s: %s" % (failure["node"], failure["error"]))
+            if len(failure["blocked"]) > 0:
+                self.say("    blocked %s" % ", ".join(failure["blocked"][:5] + (
+                    ["and %s more" % (len(failure["blocked"]) - 5)] if len(failure["blocked"]) > 5 else [])))
+        counts = {}
+        for node in retry:
+            counts[TYPES[node.split(":")[0]]] = counts.get(TYPES[node.split(":")[0]], 0) + 1
+        self.say("Resources to retry: %s" % ", ".join(["%s %s" % (counts[resource_type], resource_type)
+                                                      for resource_type in sorted(counts)]))
+        # the full list is in the failures event
+        for node in retry[:20]:
+            self.say("  " + node)
+        if len(retry) > 20:
+            self.say("  and %s more" % (len(retry) - 20))
+        self.say(hint)
+
+    def close(self, failed=False):
+        ################################################
+        ## Write everything queued and the final counts,
+        ## and the last messages if a live run failed
+        ################################################
+
+        self.queue.put(None)
+        self.thread.join()
+        sys.stdout = self.terminal
+        if failed and self.live and not self.reported:
+            for message in self.recent:
+                self.terminal.write(message + "\n")
+        if self.events is not None:
+            self.events.close()
+
+
+class LineStream(object):
+    ################################################
+    ## Stand-in for sys.stdout that hands each
+    ## complete line to the reporter, so lines
+    ## printed by concurrent threads never mix
+    ################################################
+
+    def __init__(self, reporter):
+        self.reporter = reporter
+        self.local = threading.local()
+
+    def write(self, text):
+        lines = (getattr(self.local, "buffer", "") + text).split("\n")
+        self.local.buffer = lines.pop()
+        for line in lines:
+            self.reporter.log(line)
+        return len(text)
+
+    def flush(self):
+        pass
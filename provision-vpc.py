@@ -3,9 +3,26 @@
 ## Author: Jon Hall
 ##
 
-import requests, json, time, sys, yaml, argparse
+import re, json, sys, yaml, argparse
+from functools import partial, lru_cache
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from scheduler import Scheduler
+from progress import Reporter
+from tracing import Tracer, carry
+from riasclient import RiasClient
+from iamtoken import tokenprovider, IAM_ENDPOINT
+from governor import Governor
+from inventory import Inventory
+from waiter import Waiter
+from asyncrias import AsyncRiasClient
+from plan import diff
+from statefile import StateFile, statepath, TYPES
+from lbpool import poolindex, reconcile
+from journal import Journal, journalpath, fingerprints
+from validate import validate
 
 
 def main(region):
@@ -15,10 +32,6 @@ def main(region):
     for zone in zones:
         print("Zone %s is available in region %s" % (zone["name"], region))
 
-    # Create Network acls
-    for network_acl in topology["network_acls"]:
-        createnetworkacl(network_acl)
-
     # Create VPC
     vpc_name = topology["vpc"]
     region = topology["region"]
@@ -38,108 +51,398 @@ def main(region):
     else:
         default_network_acl = vpc_name + "-default-acl"
 
-    vpc_id = createvpc(vpc_name, region, classic_access, resource_group, default_network_acl)
+    #######################################################################
+    # Build dependency graph of resources in topology
+    # ACL -> VPC -> address prefix -> subnet -> gateway/VPN/instance -> floating IP -> load balancer
+    #######################################################################
+
+    sched = Scheduler(workers=args.workers, tracer=tracer, keep_going=args.keep_going)
 
+    # Create Network acls
+    for network_acl in topology["network_acls"]:
+        sched.add("acl:" + network_acl["network_acl"], lambda r, acl=network_acl: createnetworkacl(acl),
+                  spec=network_acl)
+
+    sched.add("vpc", lambda r: createvpc(vpc_name, region, classic_access, resource_group, default_network_acl),
+              deps=nodes(sched, "acl:" + default_network_acl),
+              spec=[vpc_name, region, classic_access, resource_group, default_network_acl])
 
-    # Create VPC's security groups
+    # Create VPC's security groups, after any security groups referenced by their rules
     for security_group in topology['security_groups']:
-        createsecuritygroup(security_group, vpc_id)
+        remotes = ["sg:" + rule["remote"]["security_group"] for rule in security_group["rules"]
+                   if "security_group" in rule["remote"]]
+        sched.add("sg:" + security_group["security_group"],
+                  lambda r, sg=security_group: createsecuritygroup(sg, r["vpc"]),
+                  deps=["vpc"] + nodes(sched, *remotes), spec=security_group)
 
     # Create sshKeys for VPC
     for sshkey in topology["sshkeys"]:
-        createsshkey(sshkey)
+        sched.add("key:" + sshkey["sshkey"], lambda r, key=sshkey: createsshkey(key), spec=sshkey)
+
+    # Resolve each instance template once into the spec every instance built from it is created with
+    used = [instance["template"] for zone in topology["zones"] for subnet in zone["subnets"]
+            for instance in subnet.get("instances", [])]
+    for template in [template for template in topology["instanceTemplates"] if template["template"] in used]:
+        sched.add("template:" + template["template"], lambda r, t=template: resolveinstancetemplate(t),
+                  deps=nodes(sched, "key:" + template["sshkey"]), spec=template)
 
     #######################################################################
     # Iterate through subnets in each zone and create subnets & instances
     #######################################################################
 
+    groups = {}
     for zone in topology["zones"]:
+        zone_name = zone["name"]
         # Create vpc-address-prefix for zone
         if "address_prefix_cidr" in zone:
-            createaddressprefix(vpc_id, zone['name'], zone['address_prefix_cidr'])
+            sched.add("prefix:" + zone_name,
+                      lambda r, z=zone: createaddressprefix(r["vpc"], z['name'], z['address_prefix_cidr']),
+                      deps=["vpc"], spec=zone["address_prefix_cidr"])
+
+        # A gateway is shared by all subnets in the zone, so create it once
+        if len([subnet for subnet in zone["subnets"] if subnet.get("publicGateway")]) > 0:
+            sched.add("gateway:" + zone_name,
+                      lambda r, z=zone_name: getpublicgateway(vpc_name, z, r["vpc"]),
+                      deps=["vpc"])
+
         # Create Subnets
         for subnet in zone["subnets"]:
-            ## Provision new Subnet
-            subnet_id = createsubnet(vpc_id, zone["name"], subnet)
+            subnet_node = sched.add("subnet:" + subnet["name"],
+                                    lambda r, z=zone_name, s=subnet: createsubnet(r["vpc"], z, s),
+                                    deps=["vpc"] + nodes(sched, "prefix:" + zone_name,
+                                                         "acl:" + subnet["network_acl"]),
+                                    spec=dict((key, value) for key, value in subnet.items()
+                                              if key not in ("instances", "vpn")))
 
             # Check if Public Gateway is required by Subnet
-            if 'publicGateway' in subnet:
-                if subnet["publicGateway"]:
-                    # A gateway is needed check if Public Gateway already exists in zone, if not create.
-                    resp = requests.get(rias_endpoint + '/v1/public_gateways' + version, headers=headers)
-                    if resp.status_code == 200:
-                        public_gateways = json.loads(resp.content)["public_gateways"]
-                        # Determine if gateway exists and use it.  First get Gateways for this VPC
-                        public_gateway = list(filter(lambda gw: gw['vpc']['id'] == vpc_id, public_gateways))
-                        # Determine if gateway exists in this vpc for this zone
-                        public_gateway = list(filter(lambda gw: gw['zone']['name'] == zone["name"], public_gateway))
-
-                        if len(public_gateway) > 0:
-                            # gateway already exists, get it's ID and attach to subnet.
-                            attachpublicgateway(public_gateway[0]["id"], subnet_id)
-                        else:
-                            # Does not exists, so need to create public gateway then attach
-                            gateway_name = vpc_name + "-" + zone["name"] + "-gw"
-                            public_gateway_id = createpublicgateway(gateway_name, zone["name"], vpc_id)
-                            attachpublicgateway(public_gateway_id, subnet_id)
-                    else:
-                        print("%s Error getting list of gateways for zone %z." % (resp.status_code, zone["name"]))
-                        print("Error Data:  %s" % json.loads(resp.content)['errors'])
-                        quit()
+            if subnet.get("publicGateway"):
+                sched.add("attach:" + subnet["name"],
+                          lambda r, z=zone_name, sn=subnet_node: attachpublicgateway(r["gateway:" + z], r[sn]),
+                          deps=[subnet_node, "gateway:" + zone_name])
+
             if "vpn" in subnet:
                 for vpn_instance in subnet["vpn"]:
                     # A VPN instance is needed
                     # local_CIDR derviced from the zone address block
-                    createvpn(vpn_instance, zone["address_prefix_cidr"], subnet_id)
+                    sched.add("vpn:" + vpn_instance["name"],
+                              lambda r, v=vpn_instance, c=zone["address_prefix_cidr"], sn=subnet_node:
+                              createvpn(v, c, r[sn]),
+                              deps=[subnet_node], spec=[vpn_instance, zone["address_prefix_cidr"]])
 
             # Build instances for this subnet (if defined in topology)
             if "instances" in subnet:
                 for instance in subnet["instances"]:
-                    template = getinstancetemplate(topology["instanceTemplates"], instance["template"])
-                    profile_name = template["profile_name"]
-                    sshkey_name = template["sshkey"]
-                    security_group = instance["security_group"]
-                    user_data = encodecloudinit(template["cloud-init-file"])
-
-                    image_id = getimageid(template["image"])
-                    if image_id == 0:
-                        print("Can't create instances.  The Image named %s does not exist." % image_name)
-                        quit()
-
-                    sshkey_id = getsshkeyid(template["sshkey"])
-                    if image_id == 0:
-                        print("Can't create instances.  The ssh key named %s does not exist." % sshkey_name)
-                        quit()
+                    # every missing instance of the group is created together
+                    group_node = sched.add("group:%s:%s" % (subnet["name"], instance["name"]),
+                                           partial(groupnode, zone_name, instance, "template:" + instance["template"],
+                                                   subnet_node),
+                                           deps=[subnet_node, "template:" + instance["template"]] +
+                                                nodes(sched, "sg:" + instance["security_group"]),
+                                           spec=instance)
+                    groups[group_node] = []
 
                     for q in range(1, instance["quantity"] + 1):
-                        instance_name = (instance["name"] % q) + "-" + zone["name"]
-                        instance_id = createinstance(zone["name"], instance_name, vpc_id, image_id, profile_name,
-                                                     sshkey_id,
-                                                     subnet_id,
-                                                     security_group,
-                                                     user_data)
+                        instance_name = (instance["name"] % q) + "-" + zone_name
+                        instance_node = sched.add("instance:" + instance_name,
+                                                  lambda r, g=group_node, i=instance_name: r[g][i],
+                                                  deps=[group_node])
+                        groups[group_node].append(instance_node)
                         # IF floating_ip = True assign
-                        if 'floating_ip' in instance:
-                            if instance['floating_ip']:
-                                floating_ip_id, floating_ip_address = assignfloatingip(instance_id)
+                        if instance.get('floating_ip'):
+                            if args.asynchronous:
+                                # returns a coroutine the scheduler awaits without holding a worker
+                                fip = lambda r, i=instance_node: assignfloatingipasync(r[i], r["vpc"])
+                            else:
+                                fip = lambda r, i=instance_node: assignfloatingip(r[i], r["vpc"])
+                            sched.add("fip:" + instance_name, fip, deps=[instance_node])
 
     #######################################################################
-    # Create load balancers specified
+    # Create load balancers specified once their subnets and members exist
     #######################################################################
 
     if "load_balancers" in topology:
+        pools = poolindex(topology)
         for lb in topology["load_balancers"]:
-            lb_id = createloadbalancer(lb)
-
+            members = [member for pool in lb["pools"] for member in pools.get((lb["lbInstance"], pool["name"]), [])]
+            deps = ["vpc"] + nodes(sched, *["subnet:" + subnet for subnet in lb["subnets"]])
+            deps += sorted(set(["instance:" + instance_name for instance_name, port in members]))
+            sched.add("lb:" + lb["lbInstance"], lambda r, l=lb: createloadbalancer(l, pools, r), deps=deps,
+                      spec=[lb, members])
+
+    resumed = None
+    if args.resume:
+        resumed = journal.resume(fingerprints(sched))
+    if resumed is not None:
+        # nodes the journal completed are not looked up again; those in flight run and re-check their resources
+        completed, inflight = resumed
+        print("Resuming: %s of %s steps complete, %s in flight." % (
+            len([name for name in completed if name in sched]), len(sched.order),
+            len([name for name in inflight if name in sched])))
+        existing = dict((name, restore(name, result)) for name, result in completed.items() if name in sched)
+        run = set(name for name in sched.order if name not in existing)
+        extras = []
+        sched.listen(lambda name, result: recordnode(sched, name, result))
+    else:
+        planned = planrun(sched, groups, vpc_name)
+        if planned is None:
+            return
+        run, existing, extras = planned
+        if args.scale is None:
+            journal.begin(fingerprints(sched))
+    for name in sched.order:
+        if name not in run:
+            sched.done(name, existing.get(name))
+    reporter.track(sched, run)
+    sched.observe(journal.started)
+    sched.listen(journal.finished)
+
+    try:
+        if args.asynchronous:
+            sched.runasync()
+        else:
+            sched.run()
+        if len(sched.failures) > 0:
+            reporter.failures(sched, "Fix the cause and run again with --resume to retry only these steps.")
+            sys.exit(1)
+        if len(extras) > 0:
+            removeinstances(extras, [sched.results[name] for name in run if name.startswith("lb:")],
+                            sched.results["vpc"])
+    finally:
+        state.save()
+    if args.scale is None:
+        # nothing left to resume; a scale run leaves the journal of an earlier full run alone
+        journal.remove()
     return
 
 
+def planrun(sched, groups, vpc_name):
+    ################################################
+    ## Read the current state in one pass and return
+    ## (nodes to run, results of the nodes already
+    ## in place, instances to remove), or None if
+    ## there is nothing to run
+    ################################################
+
+    plan = diff(topology, inventory, rias, args.workers, state)
+    plan.show()
+    if args.output is not None:
+        plan.dump(args.output)
+    if plan.count("delete") > 0:
+        print("Resources not in the topology are left in place and must be removed manually.")
+    if args.plan:
+        return
+
+    # Record every resource in the state file, replacing entries for resources that have since gone
+    for change in plan.changes:
+        if change["action"] == "create" and change["node"] is not None:
+            state.forget(change["node"])
+    sched.listen(lambda name, result: recordnode(sched, name, result))
+
+    if args.scale is not None:
+        # only the group, its floating ips and its load balancers run; the rest must already exist
+        run, extras = scalegroup(sched, groups, plan, args.scale)
+    elif plan.converged():
+        for node, result in plan.existing.items():
+            if node in sched:
+                recordnode(sched, node, result)
+        state.save()
+        journal.remove()
+        print("VPC %s already matches the topology." % vpc_name)
+        return
+    else:
+        run = set(name for name in sched.order if name not in plan.existing)
+        extras = []
+
+    # instance groups that are complete need no existence scan
+    existing = dict(plan.existing)
+    for group_node, members in groups.items():
+        if group_node in run and len([member for member in members if member not in plan.existing]) == 0:
+            existing[group_node] = dict((member.split(":", 1)[1], plan.existing[member]) for member in members)
+            run.discard(group_node)
+    return run, existing, extras
+
+
+def restore(name, result):
+    ################################################
+    ## Rebuild a node result read back from the
+    ## journal as JSON
+    ################################################
+
+    if name.startswith("template:") and result is not None:
+        return InstanceSpec(*result)
+    if name.startswith("fip:") and result is not None:
+        return tuple(result)
+    return result
+
+
+def recordnode(sched, name, result):
+    ################################################
+    ## Record a provisioned resource in the state file
+    ################################################
+
+    if name.startswith("fip:") and result is not None:
+        # floating ip nodes return (id, address)
+        result = result[0]
+
+    # depend on the resources behind template and group nodes rather than the nodes themselves
+    deps = []
+    pending = list(sched.nodes[name]["deps"])
+    while len(pending) > 0:
+        dep = pending.pop(0)
+        if dep.split(":")[0] in TYPES:
+            deps.append(dep)
+        else:
+            pending.extend(sched.nodes[dep]["deps"])
+    state.record(name, result, sorted(set(deps)))
+
+
+def groupnode(zone_name, instance, template_node, subnet_node, results):
+    ################################################
+    ## Create an instance group from its resolved
+    ## template
+    ################################################
+
+    security_group_id = results.get("sg:" + instance["security_group"])
+    if security_group_id is None:
+        # security group not defined in the topology
+        security_group_id = getsecuritygroupid(instance["security_group"], results["vpc"])
+    return createinstances(zone_name, instance, results["vpc"], results[template_node], results[subnet_node],
+                           security_group_id)
+
+
+def scalegroup(sched, groups, plan, group_name):
+    ################################################
+    ## Return the nodes --scale runs for an instance
+    ## group (its instances, floating ips and load
+    ## balancers, and any templates they need) and
+    ## the instances beyond its quantity to remove
+    ################################################
+
+    selected = [group_node for group_node in groups if group_node.split(":", 2)[2] == group_name]
+    if len(selected) == 0:
+        print("Instance group %s is not in the topology." % group_name)
+        quit()
+
+    run = set()
+    pending = list(selected)
+    while len(pending) > 0:
+        name = pending.pop()
+        if name in run or name in plan.existing:
+            continue
+        if name.split(":")[0] in TYPES:
+            print("%s does not exist.  Run provision-vpc.py before scaling instance group %s." % (name, group_name))
+            quit()
+        run.add(name)
+        pending.extend(sched.nodes[name]["deps"])
+
+    extras = []
+    for zone in topology["zones"]:
+        for subnet in zone["subnets"]:
+            for instance in subnet.get("instances", []):
+                if "group:%s:%s" % (subnet["name"], instance["name"]) not in selected:
+                    continue
+                members = groups["group:%s:%s" % (subnet["name"], instance["name"])]
+                run.update([member for member in members if member not in plan.existing])
+                run.update([fip for fip in ["fip:" + member.split(":", 1)[1] for member in members]
+                            if fip in sched and fip not in plan.existing])
+                # load balancers drain the instances being removed and add the new ones
+                run.update(["lb:" + in_lb_pool["lb_name"] for in_lb_pool in instance.get("in_lb_pool", [])
+                            if "lb:" + in_lb_pool["lb_name"] in sched])
+
+                # instances named by the group's pattern numbered beyond its quantity
+                parts = re.split(r"%0?\d*d", instance["name"])
+                numbered = re.compile(r"(\d+)".join([re.escape(part) for part in parts]) + "-" +
+                                      re.escape(zone["name"]) + "$")
+                subnet_id = plan.existing["subnet:" + subnet["name"]]
+                for found in inventory.filter("instances",
+                                              lambda i: i["primary_network_interface"]["subnet"]["id"] == subnet_id):
+                    match = numbered.match(found["name"])
+                    if match is not None and int(match.group(1)) > instance["quantity"]:
+                        extras.append(found)
+
+    print("Scaling instance group %s: %s instances to create, %s to remove." % (
+        group_name, len([name for name in run if name.startswith("instance:")]), len(extras)))
+    return run, extras
+
+
+def removeinstances(instances, lb_ids, vpc_id):
+    ################################################
+    ## Delete instances concurrently once the load
+    ## balancers have drained them, then release
+    ## their floating ips
+    ################################################
+
+    for lb_id in lb_ids:
+        drained, lb = waiter.wait("load_balancers", '/v1/load_balancers/' + lb_id,
+                                  lambda l: l is None or l["provisioning_status"] == "active",
+                                  "load balancer %s to remove pool members" % lb_id)
+        if not drained:
+            print("Load balancer %s did not finish removing pool members." % lb_id)
+            quit()
+
+    futures = [creator.submit(carry(removeinstance), instance, vpc_id) for instance in instances]
+    for future in futures:
+        # re-raises any error (including quit()) from the delete
+        future.result()
+    print("Removed %s instances." % len(instances))
+
+
+def removeinstance(instance, vpc_id):
+    ##############################################
+    # delete an instance and its floating ips
+    ##############################################
+
+    nic = instance["primary_network_interface"]["id"]
+    floating_ips = inventory.filter("floating_ips", lambda f: f.get("target", {}).get("id") == nic)
+
+    resp = rias.delete('/v1/instances/' + instance["id"])
+    if resp.status_code not in (204, 404):
+        print("%s Error deleting instance %s." % (resp.status_code, instance["name"]))
+        print("Error Data:  %s" % json.loads(resp.content)['errors'])
+        quit()
+    inventory.remove("instances", instance["id"])
+    state.forget("instance:" + instance["name"])
+    # every instance deletion in the VPC is watched by one list call
+    deleted, obj = waiter.monitor("instances", {"vpc.id": vpc_id}).wait(
+        instance["id"], lambda i: i is None, "deletion of instance %s to complete" % instance["name"])
+    if not deleted:
+        print("Instance %s was not deleted." % instance["name"])
+        quit()
+    print("Instance %s (%s) deleted successfully." % (instance["name"], instance["id"]))
+
+    for floating_ip in floating_ips:
+        detached, obj = waiter.wait("floating_ips", '/v1/floating_ips/' + floating_ip["id"],
+                                    lambda f: f is None or f.get("status") == "available",
+                                    "floating ip %s to detach" % floating_ip["address"])
+        if not detached:
+            print("Floating IP %s was not detached." % floating_ip["address"])
+            quit()
+        resp = rias.delete('/v1/floating_ips/' + floating_ip["id"])
+        if resp.status_code not in (204, 404):
+            print("%s Error deleting floating ip %s." % (resp.status_code, floating_ip["address"]))
+            print("Error Data:  %s" % json.loads(resp.content)['errors'])
+            quit()
+        inventory.remove("floating_ips", floating_ip["id"])
+        print("Floating IP %s released." % floating_ip["address"])
+    state.forget("fip:" + instance["name"])
+
+
+def nodes(sched, *names):
+    ################################################
+    ## Return the names that are nodes in the graph
+    ## (resources not defined in the topology must
+    ## already exist and are not dependencies)
+    ################################################
+
+    return [name for name in names if name in sched]
+
+
 def getzones(region):
     #############################
     # Get list of zones in Region
     #############################
 
-    resp = requests.get(rias_endpoint + '/v1/regions/' + region + '/zones' + version, headers=headers)
+    resp = rias.get('/v1/regions/' + region + '/zones')
     if resp.status_code == 200:
         zones = json.loads(resp.content)["zones"]
         if len(zones) > 0:
@@ -160,7 +463,7 @@ def getregionavailability(region):
     # Get Region Availability
     #############################
 
-    resp = requests.get(rias_endpoint + '/v1/regions/' + region + version, headers=headers)
+    resp = rias.get('/v1/regions/' + region)
 
     if resp.status_code == 200:
         region = json.loads(resp.content)
@@ -183,16 +486,9 @@ def getvpnid(vpn_name):
     ## LLookup VPN by name
     ################################################
 
-    resp = requests.get(rias_endpoint + '/v1/vpn_gateways' + version, headers=headers)
-    if resp.status_code == 200:
-        vpn_gateways = json.loads(resp.content)["vpn_gateways"]
-        vpn_gateway = \
-            list(filter(lambda vpn_gateway: vpn_gateway["name"] == vpn_name, vpn_gateways))
-
-        if len(vpn_gateway) > 0:
-            vpn_gateway_id = vpn_gateway[0]['id']
-        else:
-            vpn_gateway_id = 0
+    vpn_gateway = inventory.find("vpn_gateways", vpn_name)
+    if vpn_gateway is not None:
+        vpn_gateway_id = vpn_gateway['id']
     else:
         vpn_gateway_id = 0
 
@@ -203,16 +499,9 @@ def getnetworkaclid(network_acl_name):
     ## Lookup network acl id by name
     ################################################
 
-    resp = requests.get(rias_endpoint + '/v1/network_acls/' + version, headers=headers)
-    if resp.status_code == 200:
-        acls = json.loads(resp.content)["network_acls"]
-        default_network_acl = \
-            list(filter(lambda acl: acl['name'] == network_acl_name, acls))
-
-        if len(default_network_acl) > 0:
-            network_acl_id = default_network_acl[0]['id']
-        else:
-            network_acl_id = 0
+    network_acl = inventory.find("network_acls", network_acl_name)
+    if network_acl is not None:
+        network_acl_id = network_acl['id']
     else:
         network_acl_id = 0
 
@@ -224,16 +513,9 @@ def getsecuritygroupid(security_group, vpc_id):
     ## Lookup security group id by name
     ################################################
 
-    resp = requests.get(rias_endpoint + '/v1/security_groups/' + version + "&vpc.if=" + vpc_id, headers=headers)
-    if resp.status_code == 200:
-        sgs = json.loads(resp.content)["security_groups"]
-        default_security_group = \
-            list(filter(lambda acl: acl['name'] == security_group, sgs))
-
-        if len(default_security_group) > 0:
-            security_group_id = default_security_group[0]['id']
-        else:
-            security_group_id = 0
+    sg = inventory.find("security_groups", security_group, lambda sg: sg['vpc']['id'] == vpc_id)
+    if sg is not None:
+        security_group_id = sg['id']
     else:
         security_group_id = 0
 
@@ -246,7 +528,8 @@ def createnetworkacl(network_acl):
     ################################################
 
     # check if ACL already exists by checking for id
-    if getnetworkaclid(network_acl["network_acl"]) == 0:
+    network_acl_id = getnetworkaclid(network_acl["network_acl"])
+    if network_acl_id == 0:
         # Network ACLS does not exist create it
 
         rules = []
@@ -292,12 +575,12 @@ def createnetworkacl(network_acl):
             "rules": rules,
         }
 
-        resp = requests.post(rias_endpoint + '/v1/network_acls' + version, json=parms, headers=headers)
+        resp = rias.post('/v1/network_acls', json=parms)
 
         if resp.status_code == 201:
-            network_acl = resp.json()
+            network_acl = inventory.add("network_acls", resp.json())
             print("Network ACL %s (%s) was created successfully." % (network_acl["name"], network_acl["id"]))
-            return
+            return network_acl["id"]
         elif resp.status_code == 400:
             print("Invalid network_acl template provided.")
             print("template=%s" % json.dumps(parms, indent=4))
@@ -312,7 +595,7 @@ def createnetworkacl(network_acl):
     else:
         # Network ACL already exists.  do no recreate
         print("Network ACL %s already exists." % (network_acl["network_acl"]))
-        return
+        return network_acl_id
 
 
 def createsecuritygroup(security_group, vpc_id):
@@ -321,7 +604,8 @@ def createsecuritygroup(security_group, vpc_id):
     ################################################
 
     # check if security group already exists by checking for id
-    if getsecuritygroupid(security_group["security_group"], vpc_id) == 0:
+    security_group_id = getsecuritygroupid(security_group["security_group"], vpc_id)
+    if security_group_id == 0:
         # security group does not exist create it
 
         rules = []
@@ -357,12 +641,12 @@ def createsecuritygroup(security_group, vpc_id):
             "rules": rules,
             "vpc": {"id": vpc_id}
         }
-        resp = requests.post(rias_endpoint + '/v1/security_groups' + version, json=parms, headers=headers)
+        resp = rias.post('/v1/security_groups', json=parms)
 
         if resp.status_code == 201:
-            security_group = resp.json()
+            security_group = inventory.add("security_groups", resp.json())
             print("Security Group %s (%s) was created successfully." % (security_group["name"], security_group["id"]))
-            return
+            return security_group["id"]
         elif resp.status_code == 400:
             print("Invalid security_group template provided.")
             print("template=%s" % parms)
@@ -377,7 +661,26 @@ def createsecuritygroup(security_group, vpc_id):
     else:
         # Security group already exists.  do no recreate
         print("Security Group %s already exists." % (security_group["security_group"]))
-        return
+        return security_group_id
+
+
+def getpublicgateway(vpc_name, zone_name, vpc_id):
+    #################################
+    # Get or create zone public gateway
+    #################################
+
+    # A gateway is needed check if Public Gateway already exists in zone, if not create.
+    # Determine if gateway exists in this vpc for this zone
+    public_gateway = inventory.filter("public_gateways",
+                                      lambda gw: gw['vpc']['id'] == vpc_id and gw['zone']['name'] == zone_name)
+
+    if len(public_gateway) > 0:
+        # gateway already exists, get it's ID to attach to subnets.
+        return public_gateway[0]["id"]
+    else:
+        # Does not exists, so need to create public gateway
+        gateway_name = vpc_name + "-" + zone_name + "-gw"
+        return createpublicgateway(gateway_name, zone_name, vpc_id)
 
 
 def createpublicgateway(gateway_name, zone_name, vpc_id):
@@ -390,10 +693,10 @@ def createpublicgateway(gateway_name, zone_name, vpc_id):
         "zone": {"name": zone_name},
         "vpc": {"id": vpc_id}
     }
-    resp = requests.post(rias_endpoint + '/v1/public_gateways' + version, json=parms, headers=headers)
+    resp = rias.post('/v1/public_gateways', json=parms)
 
     if resp.status_code == 201:
-        gateway = resp.json()
+        gateway = inventory.add("public_gateways", resp.json())
         print("Public Gateway %s named %s was created successfully." % (gateway["id"], gateway_name))
         return (gateway["id"])
     elif resp.status_code == 400:
@@ -424,10 +727,10 @@ def createvpn(vpn, zone_address_prefix_cidr, subnet_id):
             "name": vpn["name"],
             "subnet": {"id": subnet_id}
         }
-        resp = requests.post(rias_endpoint + '/v1/vpn_gateways' + version, json=parms, headers=headers)
+        resp = rias.post('/v1/vpn_gateways', json=parms)
 
         if resp.status_code == 201:
-            vpn_id = resp.json()["id"]
+            vpn_id = inventory.add("vpn_gateways", resp.json())["id"]
             print("VPN %s was created successfully." % (vpn["name"]))
         elif resp.status_code == 400:
             print("Invalid VPN template provided.")
@@ -443,9 +746,16 @@ def createvpn(vpn, zone_address_prefix_cidr, subnet_id):
     else:
         print("VPN %s already exists in VPC." % (vpn["name"]))
 
-    # now Create Connections to VPN
+    # now Create Connections to VPN that don't already exist
     if "connections" in vpn:
+        resp = rias.get('/v1/vpn_gateways/' + vpn_id + "/connections")
+        existing = []
+        if resp.status_code == 200:
+            existing = [connection["name"] for connection in json.loads(resp.content)["connections"]]
         for connection in vpn["connections"]:
+            if connection["name"] in existing:
+                print("VPN connection %s already exists." % (connection["name"]))
+                continue
             parms = {
                 "name": connection["name"],
                 "peer_address": connection["peer_address"],
@@ -453,8 +763,7 @@ def createvpn(vpn, zone_address_prefix_cidr, subnet_id):
                 "local_cidrs": [zone_address_prefix_cidr],
                 "peer_cidrs": connection["peer_cidrs"]
             }
-            resp = requests.post(rias_endpoint + '/v1/vpn_gateways/' + vpn_id + "/connections" + version, json=parms,
-                                 headers=headers)
+            resp = rias.post('/v1/vpn_gateways/' + vpn_id + "/connections", json=parms)
 
             if resp.status_code == 201:
                 vpn_connection = resp.json()
@@ -470,7 +779,7 @@ def createvpn(vpn, zone_address_prefix_cidr, subnet_id):
                 print("template=%s" % parms)
                 print("Error Data:  %s" % json.loads(resp.content)['errors'])
                 quit()
-    return
+    return vpn_id
 
 
 def attachpublicgateway(gateway_id, subnet_id):
@@ -478,21 +787,12 @@ def attachpublicgateway(gateway_id, subnet_id):
     # Attach a public gateway
     #################################
 
-    # Check subnet status first...waiting up to 30 seconds
-    count = 0
-    while count < 12:
-        resp = requests.get(rias_endpoint + '/v1/subnets/' + subnet_id + version, headers=headers);
-        subnet_status = json.loads(resp.content)["status"]
-        if subnet_status == "available":
-            break
-        else:
-            print("Waiting for subnet creation before attaching public gateway.   Sleeping for 5 seconds...")
-            count += 1
-            time.sleep(5)
+    # Check subnet status first
+    waiter.wait("subnets", '/v1/subnets/' + subnet_id, lambda s: s is not None and s["status"] == "available",
+                "subnet creation before attaching public gateway")
 
     parms = {"id": gateway_id}
-    resp = requests.put(rias_endpoint + '/v1/subnets/' + subnet_id + '/public_gateway' + version, json=parms,
-                        headers=headers)
+    resp = rias.put('/v1/subnets/' + subnet_id + '/public_gateway', json=parms)
     if resp.status_code == 201:
         attach = resp.json()
         print("Public gateway attached to subnet %s." % attach["name"])
@@ -505,7 +805,7 @@ def attachpublicgateway(gateway_id, subnet_id):
     elif resp.status_code == 404:
         print("A subnet with the specified identifier could not be found.")
         print("template=%s" % parms)
-        print("Request: %s" % rias_endpoint + '/v1/subnets/' + subnet_id + '/public_gateway' + version)
+        print("Request: %s" % rias.endpoint + '/v1/subnets/' + subnet_id + '/public_gateway')
         print("Response:  %s" % json.loads(resp.content))
         quit()
     else:
@@ -523,70 +823,51 @@ def createvpc(vpc_name, region, classic_access, resource_group, default_network_
     # Create VPC in desired region
     ##################################
 
-    # get list of VPCs in region to check if VPC already exists
-    resp = requests.get(rias_endpoint + '/v1/vpcs/' + version, headers=headers)
-    if resp.status_code == 200:
-        vpcs = json.loads(resp.content)["vpcs"]
-        # Determine if network_acl name already exists and retreive id.
-        vpc = list(filter(lambda vpc: vpc['name'] == vpc_name, vpcs))
-        if len(vpc) > 0:
-            print("The VPC named %s (%s) already exists in region." % (vpc[0]["name"], vpc[0]['id']))
-            default_network_acl_id = getnetworkaclid(default_network_acl)
-            vpc = vpc[0]
-            return (vpc['id'])
+    # check VPCs in region to see if VPC already exists
+    vpc = inventory.find("vpcs", vpc_name)
+    if vpc is not None:
+        print("The VPC named %s (%s) already exists in region." % (vpc["name"], vpc['id']))
+        return (vpc['id'])
+
+    # VPC does not exist so proceed with creating it.
+    # Determine if network_acl name already exists and retreive id for use.
+    default_network_acl_id = getnetworkaclid(default_network_acl)
+
+    if default_network_acl_id != 0:
+        print("%s network_acl already exists.   Using network_acl_id %s as default." % (
+            default_network_acl, default_network_acl_id))
+
+        # create parameters for VPC creation
+
+        resource_group_id = getresourcegroupid(resource_group)
+
+        parms = {"name": vpc_name,
+                 "classic_access": classic_access,
+                 "default_network_acl": {"id": default_network_acl_id},
+                 "resource_group": {"id": resource_group_id}
+                 }
+
+        resp = rias.post('/v1/vpcs', json=parms)
+
+        if resp.status_code == 201:
+            vpc = inventory.add("vpcs", resp.json())
+            print("Created VPC named %s (%s) in region %s." % (vpc_name, vpc['id'], region))
+            return (vpc["id"])
+        elif resp.status_code == 400:
+            print("Invalid VPC template provided.")
+            print("template=%s" % parms)
+            print("Error Data:  %s" % json.loads(resp.content)['errors'])
+            quit()
         else:
-            # VPC does not exist so proceed with creating it.
-            # Determine if network_acl name already exists and retreive id for use.
-            resp = requests.get(rias_endpoint + '/v1/network_acls/' + version, headers=headers)
-            if resp.status_code == 200:
-                acls = json.loads(resp.content)["network_acls"]
-                default_network_acl = \
-                    list(filter(lambda acl: acl['name'] == default_network_acl, acls))
-
-                if len(default_network_acl) > 0:
-                    print("%s network_acl already exists.   Using network_acl_id %s as default." % (
-                        default_network_acl[0]["name"], default_network_acl[0]['id']))
-                    default_network_acl_id = default_network_acl[0]['id']
-
-                    # create parameters for VPC creation
-
-                    resource_group_id = getresourcegroupid(resource_group)
-
-                    parms = {"name": vpc_name,
-                             "classic_access": classic_access,
-                             "default_network_acl": {"id": default_network_acl_id},
-                             "resource_group": {"id": resource_group_id}
-                             }
-
-                    resp = requests.post(rias_endpoint + '/v1/vpcs' + version, json=parms, headers=headers)
-
-                    if resp.status_code == 201:
-                        vpc = resp.json()
-                        print("Created VPC named %s (%s) in region %s." % (vpc_name, vpc['id'], region))
-                        return (vpc["id"])
-                    elif resp.status_code == 400:
-                        print("Invalid VPC template provided.")
-                        print("template=%s" % parms)
-                        print("Error Data:  %s" % json.loads(resp.content)['errors'])
-                        quit()
-                    else:
-                        # error stop execution
-                        print(json.dumps(parms, indent=4))
-                        print("%s Error." % resp.status_code)
-                        print("Error Data:  %s" % json.loads(resp.content)['errors'])
-                        quit()
-                else:
-                    # *** need to create default ACL if it doesn't exist already per rules in topology file.
-                    print("%s network_acls does not exists.  Please manually implement and re-run." % (
-                        default_network_acl))
-                    quit()
-            else:
-                # error stop execution
-                print("%s Error getting acls for region %s." % (resp.status_code, region))
-                quit()
+            # error stop execution
+            print(json.dumps(parms, indent=4))
+            print("%s Error." % resp.status_code)
+            print("Error Data:  %s" % json.loads(resp.content)['errors'])
+            quit()
     else:
-        # error stop execution
-        print("%s Error getting list of vpcs for region %s." % (resp.status_code, region))
+        # *** need to create default ACL if it doesn't exist already per rules in topology file.
+        print("%s network_acls does not exists.  Please manually implement and re-run." % (
+            default_network_acl))
         quit()
     return
 
@@ -598,22 +879,17 @@ def createaddressprefix(vpc_id, zone, cidr):
 
     # get list of prefixes in VPC to check if prefix already exists
     name = zone + "-address-prefix"
-    resp = requests.get(rias_endpoint + '/v1/vpcs/' + vpc_id + '/address_prefixes' + version, headers=headers)
-    if resp.status_code == 200:
-        prefixlist = json.loads(resp.content)["address_prefixes"]
-        prefix_id = list(filter(lambda p: p['name'] == name, prefixlist))
-        if len(prefix_id) > 0:
-            if prefix_id[0]["id"] != 0:
-                print("Prefix named %s (%s) already exists in VPC." % (name, prefix_id[0]["id"]))
-                return prefix_id[0]["id"]
+    prefix = rias.find('/v1/vpcs/' + vpc_id + '/address_prefixes', "address_prefixes", name)
+    if prefix is not None:
+        print("Prefix named %s (%s) already exists in VPC." % (name, prefix["id"]))
+        return prefix["id"]
 
     parms = {"name": name,
              "zone": {"name": zone},
              "cidr": cidr
              }
 
-    resp = requests.post(rias_endpoint + '/v1/vpcs/' + vpc_id + '/address_prefixes' + version, json=parms,
-                         headers=headers)
+    resp = rias.post('/v1/vpcs/' + vpc_id + '/address_prefixes', json=parms)
 
     if resp.status_code == 201:
         prefix_id = resp.json()["id"]
@@ -647,14 +923,11 @@ def createsubnet(vpc_id, zone_name, subnet):
     ## Create new subnet is zone
     ################################################
 
-    # get list of subnets in region to check if subnet already exists
-    resp = requests.get(rias_endpoint + '/v1/subnets/' + version, headers=headers)
-    if resp.status_code == 200:
-        subnetlist = json.loads(resp.content)["subnets"]
-        subnet_id = list(filter(lambda s: s['name'] == subnet["name"], subnetlist))
-        if len(subnet_id) > 0:
-            print("Subnet named %s (%s) already exists in zone. " % (subnet["name"], subnet_id[0]["id"]))
-            return subnet_id[0]["id"]
+    # check subnets in region to see if subnet already exists
+    existing = inventory.find("subnets", subnet["name"])
+    if existing is not None:
+        print("Subnet named %s (%s) already exists in zone. " % (subnet["name"], existing["id"]))
+        return existing["id"]
 
     network_acl_id = getnetworkaclid(subnet['network_acl'])
 
@@ -668,22 +941,16 @@ def createsubnet(vpc_id, zone_name, subnet):
              "zone": {"name": zone_name},
              "vpc": {"id": vpc_id}
              }
-    resp = requests.post(rias_endpoint + '/v1/subnets' + version, json=parms, headers=headers)
+    resp = rias.post('/v1/subnets', json=parms)
 
     if resp.status_code == 201:
         print("Subnet named %s requested in zone %s." % (subnet["name"], zone_name))
-        newsubnet = resp.json()
-        count = 0
-        while count < 12:
-            resp = requests.get(rias_endpoint + '/v1/subnets/' + newsubnet["id"] + version, headers=headers);
-            subnet_status = json.loads(resp.content)["status"]
-            if subnet_status == "available":
-                break
-            else:
-                print(
-                    "Waiting for subnet creation to complete before proceeding.   Sleeping for 5 seconds...")
-                count += 1
-                time.sleep(5)
+        newsubnet = inventory.add("subnets", resp.json())
+        available, status = waiter.wait("subnets", '/v1/subnets/' + newsubnet["id"],
+                                        lambda s: s is not None and s["status"] == "available",
+                                        "subnet %s creation to complete" % subnet["name"])
+        if available:
+            inventory.add("subnets", status)
         print("Subnet %s named %s was created successfully in zone %s." % (
             newsubnet["id"], subnet["name"], zone_name))
         return newsubnet["id"]
@@ -705,41 +972,25 @@ def createsubnet(vpc_id, zone_name, subnet):
     return
 
 
-def createinstance(zone_name, instance_name, vpc_id, image_id, profile_name, sshkey_id, subnet_id, security_group,
-                   user_data):
+def createinstance(zone_name, instance_name, vpc_id, spec, subnet_id, security_group_id):
     ##############################################
-    # create new instance in desired vpc and zone
+    # create new instance in desired vpc and zone.
+    # createinstances has already checked that it
+    # doesn't exist.
     ##############################################
 
-    # get list of instances to check if instance already exists
-    resp = requests.get(rias_endpoint + '/v1/instances/' + version + "&network_interfaces.subnet.id=" + subnet_id,
-                        headers=headers)
-    if resp.status_code == 200:
-        instancelist = json.loads(resp.content)["instances"]
-        if len(instancelist) > 0:
-            instancelist = list(filter(lambda i: i['name'] == instance_name, instancelist))
-            if len(instancelist) > 0:
-                print('Instance named %s (%s) already exists in subnet.' % (
-                    instance_name, instancelist[0]["id"]))
-                return instancelist[0]["id"]
-    else:
-        # error stop execution
-        print("%s Error querying subnet API to find if instance already exists." % (resp.status_code))
-        print("Error Data:  %s" % json.loads(resp.content)['errors'])
-        quit()
-
     parms = {"zone": {"name": zone_name},
              "name": instance_name,
              "vpc": {"id": vpc_id},
-             "image": {"id": image_id},
-             "user_data": user_data,
-             "profile": {"name": profile_name},
-             "keys": [{"id": sshkey_id}],
+             "image": {"id": spec.image_id},
+             "user_data": spec.user_data,
+             "profile": {"name": spec.profile_name},
+             "keys": [{"id": spec.sshkey_id}],
              "primary_network_interface": {
                  "port_speed": 1000,
                  "name": "eth0",
                  "subnet": {"id": subnet_id},
-                 "security_groups": [{"id": getsecuritygroupid(security_group, vpc_id)}]},
+                 "security_groups": [{"id": security_group_id}]},
              "network_interfaces": [],
              "volume_attachments": [],
              "boot_volume_attachment": {
@@ -751,10 +1002,10 @@ def createinstance(zone_name, instance_name, vpc_id, image_id, profile_name, ssh
              }
              }
 
-    resp = requests.post(rias_endpoint + '/v1/instances' + version, json=parms, headers=headers)
+    resp = rias.post('/v1/instances', json=parms)
 
     if resp.status_code == 201:
-        instance = resp.json()
+        instance = inventory.add("instances", resp.json())
         print("Created %s (%s) instance successfully." % (instance["name"], instance["id"]))
         return (instance['id'])
     elif resp.status_code == 400:
@@ -771,30 +1022,77 @@ def createinstance(zone_name, instance_name, vpc_id, image_id, profile_name, ssh
     return
 
 
-def assignfloatingip(instance_id):
+def createinstances(zone_name, instance, vpc_id, spec, subnet_id, security_group_id):
+    ##############################################
+    # create every missing instance of a group
+    # concurrently.  Returns name -> instance id.
+    ##############################################
+
+    names = [(instance["name"] % q) + "-" + zone_name for q in range(1, instance["quantity"] + 1)]
+
+    # one existence scan for the subnet
+    existing = dict((i["name"], i["id"]) for i in inventory.filter(
+        "instances", lambda i: i["primary_network_interface"]["subnet"]["id"] == subnet_id))
+    ids = dict((name, existing[name]) for name in names if name in existing)
+    missing = [name for name in names if name not in existing]
+    if len(missing) == 0:
+        print("All %s instances of group %s in zone %s already exist." % (len(names), instance["name"], zone_name))
+        return ids
+
+    print("Creating %s of %s instances of group %s in zone %s." % (len(missing), len(names), instance["name"],
+                                                                   zone_name))
+    futures = dict((creator.submit(carry(createinstance), zone_name, name, vpc_id, spec, subnet_id,
+                                   security_group_id), name) for name in missing)
+    step = max(1, len(missing) // 10)
+    for count, future in enumerate(as_completed(futures), 1):
+        # re-raises any error (including quit()) from the create
+        ids[futures[future]] = future.result()
+        if count % step == 0 or count == len(missing):
+            print("Requested %s/%s instances of group %s in zone %s." % (count, len(missing), instance["name"],
+                                                                          zone_name))
+    return ids
+
+
+def assignfloatingip(instance_id, vpc_id):
     ##############################################
     # Assign Floating IP to instance
     ##############################################
 
-    # Verify instance provisioning complete
-    while True:
-        resp = requests.get(rias_endpoint + '/v1/instances/' + instance_id + version, headers=headers);
-        instance_status = json.loads(resp.content)
-        if "status" in instance_status:
-            if instance_status["status"] == "running":
-                network_interface = instance_status["primary_network_interface"]["id"]
-                break
-            else:
-                print("Waiting for instance creation to complete.   Sleeping for 10 seconds...")
-                time.sleep(10)
-        else:
-            print("Waiting for instance creation to complete.   Sleeping for 10 seconds...")
-            time.sleep(10)
+    # Verify instance provisioning complete, polling every instance in the VPC with one list call
+    running, instance_status = waiter.monitor("instances", {"vpc.id": vpc_id}).wait(
+        instance_id, lambda i: i is not None and i.get("status") == "running",
+        "instance %s creation to complete" % instance_id)
+    if not running:
+        print("Instance %s did not reach running status.  Can't assign floating ip." % instance_id)
+        quit()
+    return requestfloatingip(instance_status)
+
+
+async def assignfloatingipasync(instance_id, vpc_id):
+    ##############################################
+    # Assign Floating IP to instance, waiting on
+    # the event loop for it to be running
+    ##############################################
+
+    running, instance_status = await arias.wait("instances", {"vpc.id": vpc_id}, instance_id,
+                                                lambda i: i is not None and i.get("status") == "running",
+                                                "instance %s creation to complete" % instance_id)
+    if not running:
+        print("Instance %s did not reach running status.  Can't assign floating ip." % instance_id)
+        quit()
+    return await arias.call(requestfloatingip, instance_status)
+
+
+def requestfloatingip(instance_status):
+    ##############################################
+    # Request a Floating IP for a running instance
+    ##############################################
+
+    instance_id = instance_status["id"]
+    network_interface = instance_status["primary_network_interface"]["id"]
 
     # Check if floating IP already assigned
-    resp = requests.get(
-        rias_endpoint + "/v1/instances/" + instance_id + "/network_interfaces/" + network_interface + "/floating_ips" + version,
-        headers=headers)
+    resp = rias.get("/v1/instances/" + instance_id + "/network_interfaces/" + network_interface + "/floating_ips")
     if resp.status_code == 200:
         floating_ip = json.loads(resp.content)
         if "floating_ips" in floating_ip:
@@ -810,7 +1108,7 @@ def assignfloatingip(instance_id):
             "id": network_interface
         }
     }
-    resp = requests.post(rias_endpoint + '/v1/floating_ips' + version, json=parms, headers=headers)
+    resp = rias.post('/v1/floating_ips', json=parms)
 
     if resp.status_code == 201:
         floating_ip = resp.json()
@@ -829,27 +1127,41 @@ def assignfloatingip(instance_id):
     return
 
 
-def createloadbalancer(lb):
+def desiredmembers(lb, pools, results):
     ################################################
-    ## create LB instance
+    ## Return pool name -> [(address, port)] of the
+    ## instances marked for each pool of lb
     ################################################
 
-    # get list of load balancers to check if instance already exists
-    resp = requests.get(rias_endpoint + '/v1/load_balancers/' + version,
-                        headers=headers)
-    if resp.status_code == 200:
-        lblist = json.loads(resp.content)["load_balancers"]
-        if len(lblist) > 0:
-            lblist = list(filter(lambda i: i['name'] == lb["lbInstance"], lblist))
-            if len(lblist) > 0:
-                print('Load Balancer named %s (%s) already exists in subnet.' % (
-                    lb["lbInstance"], lblist[0]["id"]))
-                return lblist[0]["id"]
-    else:
-        # error stop execution
-        print("%s Error." % resp.status_code)
-        print("Error Data:  %s" % json.loads(resp.content)['errors'])
-        quit()
+    # one VPC wide instance listing gives the address of every member
+    addresses = dict((i["id"], i["primary_network_interface"]["primary_ipv4_address"]) for i in
+                     inventory.filter("instances", lambda i: i["vpc"]["id"] == results["vpc"]))
+
+    desired = {}
+    for pool in lb["pools"]:
+        desired[pool["name"]] = []
+        for instance_name, port in pools.get((lb["lbInstance"], pool["name"]), []):
+            address = addresses.get(results.get("instance:" + instance_name))
+            if address is not None:
+                desired[pool["name"]].append((address, port))
+    return desired
+
+
+def createloadbalancer(lb, pools, results):
+    ################################################
+    ## create LB instance, or bring the pool members
+    ## of an existing one up to date
+    ################################################
+
+    desired = desiredmembers(lb, pools, results)
+
+    # check load balancers to see if instance already exists
+    existing = inventory.find("load_balancers", lb["lbInstance"])
+    if existing is not None:
+        added, removed = reconcile(rias, waiter, existing["id"], desired)
+        print('Load Balancer named %s (%s) already exists.  Added %s and removed %s pool members.' % (
+            lb["lbInstance"], existing["id"], added, removed))
+        return existing["id"]
 
     # Create ListenerTemplate for use in creating load balancer
     listenerTemplate = []
@@ -876,34 +1188,10 @@ def createloadbalancer(lb):
                                  "url_path": pool["health_monitor"]["url_path"]
                                  }
 
-        # Determine whuch members are in this pool
-        memberTemplate = []
-        for zone in topology["zones"]:
-            for subnet in zone["subnets"]:
-                # get list of instances on subnet.
-                resp = requests.get(
-                    rias_endpoint + '/v1/instances/' + version + "&network_interfaces.subnet.name=" + subnet["name"],
-                    headers=headers)
-                if resp.status_code == 200:
-                    instancelist = json.loads(resp.content)["instances"]
-                for instance in subnet["instances"]:
-                    if "in_lb_pool" in instance:
-                        # Check if this instance is marked for this LB and pool and if so append instances to member template
-                        if len(instancelist) > 0:
-                            for in_lb_pool in instance["in_lb_pool"]:
-                                if (in_lb_pool["lb_name"] == lb["lbInstance"]) and (
-                                        in_lb_pool["lb_pool"] == pool["name"]):
-                                    # iterate through quantity to find each instance
-                                    for count in range(1, instance["quantity"] + 1):
-                                        name = (instance["name"] % count)
-                                        # search by instance name to get ipv4 address, and add as member.
-                                        instanceinfo = list(filter(lambda i: i['name'] == name, instancelist))
-                                        if len(instanceinfo) > 0:
-                                            memberTemplate.append({"port": in_lb_pool["listen_port"],
-                                                                   "target": {"address": instanceinfo[0][
-                                                                       "primary_network_interface"][
-                                                                       "primary_ipv4_address"]},
-                                                                   "weight": 100})
+        # Add every instance marked for this LB and pool as a member
+        memberTemplate = [{"port": port, "target": {"address": address}, "weight": 100}
+                          for address, port in desired[pool["name"]]]
+
         # sessions persistence specified for pool add to pool template.
         if "session_persistence" in pool:
             session_persistence = pool["session_persistence"]
@@ -919,17 +1207,17 @@ def createloadbalancer(lb):
             "members": memberTemplate
         })
 
-        # get subnet id's for load balancer creationer
-        subnet_list = []
-        for subnet in lb['subnets']:
-            # get list of subnets in region to check if subnet already exists
-            resp = requests.get(rias_endpoint + '/v1/subnets/' + version, headers=headers)
-            if resp.status_code == 200:
-                subnetlist = json.loads(resp.content)["subnets"]
-                subnet_id = list(filter(lambda s: s['name'] == subnet, subnetlist))
-                if len(subnet_id) > 0:
-                    subnet = {"id": subnet_id[0]["id"]}
-                    subnet_list.append(subnet)
+    # get subnet id's for load balancer creation
+    subnet_list = []
+    for subnet in lb['subnets']:
+        subnet_id = results.get("subnet:" + subnet)
+        if subnet_id is None:
+            # lookup subnet in region
+            existing = inventory.find("subnets", subnet)
+            if existing is not None:
+                subnet_id = existing["id"]
+        if subnet_id is not None:
+            subnet_list.append({"id": subnet_id})
 
     # Build load balancer using templates just created.
     parms = {"name": lb["lbInstance"],
@@ -939,10 +1227,10 @@ def createloadbalancer(lb):
              "pools": poolTemplate
              }
 
-    resp = requests.post(rias_endpoint + '/v1/load_balancers' + version, json=parms, headers=headers)
+    resp = rias.post('/v1/load_balancers', json=parms)
 
     if resp.status_code == 201:
-        load_balancer = resp.json()
+        load_balancer = inventory.add("load_balancers", resp.json())
         print("Created %s (%s) load balancer successfully." % (lb["lbInstance"], load_balancer["id"]))
         return (load_balancer["id"])
     elif resp.status_code == 400:
@@ -958,6 +1246,7 @@ def createloadbalancer(lb):
     return
 
 
+@lru_cache(maxsize=None)
 def encodecloudinit(filename):
     ################################################
     ## encode cloud-init.txt for use with user data
@@ -968,16 +1257,30 @@ def encodecloudinit(filename):
     sub_message = MIMEText(contents, "cloud-config", sys.getdefaultencoding())
     sub_message.add_header('Content-Disposition', 'inline; filename="%s"' % (filename))
     combined_message.attach(sub_message)
-    return str(combined_message).encode()
+    return str(combined_message)
+
+
+# everything an instance POST needs from its template, resolved once per template
+InstanceSpec = namedtuple("InstanceSpec", ["image_id", "sshkey_id", "profile_name", "user_data"])
 
 
-def getinstancetemplate(templates, search):
+def resolveinstancetemplate(template):
     ################################################
-    ## Find instance template in list
+    ## Lookup the image, sshkey and user_data used
+    ## by every instance built from a template
     ################################################
 
-    template = [d for d in templates if d['template'] == search]
-    return template[0]
+    image_id = getimageid(template["image"])
+    if image_id == 0:
+        print("Can't create instances.  The Image named %s does not exist." % template["image"])
+        quit()
+
+    sshkey_id = getsshkeyid(template["sshkey"])
+    if sshkey_id == 0:
+        print("Can't create instances.  The ssh key named %s does not exist." % template["sshkey"])
+        quit()
+
+    return InstanceSpec(image_id, sshkey_id, template["profile_name"], encodecloudinit(template["cloud-init-file"]))
 
 
 def getimageid(image_name):
@@ -985,14 +1288,11 @@ def getimageid(image_name):
     ## Return the image_id of an image name
     ################################################
 
-    resp = requests.get(rias_endpoint + '/v1/images/' + version, headers=headers)
-    if resp.status_code == 200:
-        imagelist = json.loads(resp.content)["images"]
-        image_id = list(filter(lambda i: i['name'] == image_name, imagelist))
-        if len(image_id) > 0:
-            return image_id[0]["id"]
-        else:
-            return 0
+    image = inventory.find("images", image_name)
+    if image is not None:
+        return image["id"]
+    else:
+        return 0
 
 
 def getresourcegroupid(resource_group):
@@ -1000,7 +1300,7 @@ def getresourcegroupid(resource_group):
     ## Return the resource group id of resource group
     ################################################
 
-    resp = requests.get(resource_controller_endpoint + '/v2/resource_groups', headers=headers)
+    resp = resource_controller.get('/v2/resource_groups')
     if resp.status_code == 200:
         resources = json.loads(resp.content)["resources"]
 
@@ -1035,14 +1335,11 @@ def getsshkeyid(sshkey_name):
     ## Return the sshkey_id of an sshkey name
     ################################################
 
-    resp = requests.get(rias_endpoint + '/v1/keys/' + version, headers=headers)
-    if resp.status_code == 200:
-        keylist = json.loads(resp.content)["keys"]
-        sshkey_id = list(filter(lambda k: k['name'] == sshkey_name, keylist))
-        if len(sshkey_id) > 0:
-            return sshkey_id[0]["id"]
-        else:
-            return 0
+    sshkey = inventory.find("keys", sshkey_name)
+    if sshkey is not None:
+        return sshkey["id"]
+    else:
+        return 0
 
 
 def createsshkey(sshkey):
@@ -1051,7 +1348,8 @@ def createsshkey(sshkey):
     ################################################
 
     # Check if key already exists
-    if getsshkeyid(sshkey["sshkey"]) == 0:
+    sshkey_id = getsshkeyid(sshkey["sshkey"])
+    if sshkey_id == 0:
         # create a new key
 
         parms = {"name": sshkey["sshkey"],
@@ -1059,11 +1357,12 @@ def createsshkey(sshkey):
                  "type": "rsa"
                  }
 
-        resp = requests.post(rias_endpoint + '/v1/keys' + version, json=parms, headers=headers)
+        resp = rias.post('/v1/keys', json=parms)
 
         if resp.status_code == 201:
+            sshkey_id = inventory.add("keys", resp.json())["id"]
             print("SSH Key named %s created." % (sshkey["sshkey"]))
-            return
+            return sshkey_id
         elif resp.status_code == 400:
             print("Invalid sshkey template provided.")
             print("template=%s" % parms)
@@ -1078,7 +1377,7 @@ def createsshkey(sshkey):
 
     else:
         print("SSH Key %s already exists.  Continueing" % sshkey["sshkey"])
-        return
+        return sshkey_id
 
 
 
@@ -1087,14 +1386,10 @@ def createsshkey(sshkey):
 #####################################
 
 
-# Create iam_token file by running gettoken.sh
-iam_file = open("iam_token", 'r')
-iam_token = iam_file.read()
-iam_token = iam_token[:-1]
 rias_endpoint = "https://us-south.iaas.cloud.ibm.com"
 resource_controller_endpoint = "https://resource-controller.cloud.ibm.com"
-version = "?version=2019-01-01"
-headers = {"Authorization": iam_token}
+version = "2019-01-01"
+headers = {}
 
 #####################################
 # Read desired topology YAML file
@@ -1102,21 +1397,100 @@ headers = {"Authorization": iam_token}
 
 parser = argparse.ArgumentParser(description="Destroy VPC topology.")
 parser.add_argument("-y", "--yaml", help="YAML based topology file to destroy")
+parser.add_argument("-i", "--index", type=int, default=0, help="Entry of the YAML file's topology list to use")
+parser.add_argument("-e", "--endpoint", default=rias_endpoint, help="RIAS API endpoint used to look up the region")
+parser.add_argument("--apikey", help="IBM Cloud API key to exchange for IAM tokens (default IBMCLOUD_API_KEY, or else "
+                                     "the token in iam_token written by gettoken)")
+parser.add_argument("--iam-endpoint", default=IAM_ENDPOINT, help="IAM endpoint the API key is exchanged with")
+parser.add_argument("--resource-controller", default=resource_controller_endpoint,
+                    help="Resource controller endpoint used to look up resource groups")
+parser.add_argument("-w", "--workers", type=int, default=8, help="Number of resources to provision concurrently")
+parser.add_argument("-r", "--rate", type=float, default=10.0,
+                    help="Maximum API requests per second to each resource type")
+parser.add_argument("-s", "--state", help="State file recording provisioned resource ids (default <yaml>.state.json)")
+parser.add_argument("--plan", action="store_true",
+                    help="Show the resources that would be created, updated or deleted and exit")
+parser.add_argument("-o", "--output", help="Write the plan to this file as JSON")
+parser.add_argument("--async", dest="asynchronous", action="store_true",
+                    help="Run the graph on an asyncio event loop and wait for instances to start before "
+                         "assigning floating ips without holding a worker thread each")
+parser.add_argument("--resume", action="store_true",
+                    help="Continue an interrupted run from its journal without looking up the steps it completed")
+parser.add_argument("--scale", metavar="GROUP",
+                    help="Only add or remove instances of this instance group (its name in the topology) to match "
+                         "its quantity, with their floating ips and load balancer pool membership")
+parser.add_argument("-k", "--keep-going", action="store_true",
+                    help="When a resource fails, carry on with everything that doesn't depend on it and report "
+                         "the failures at the end")
+parser.add_argument("--events", metavar="FILE",
+                    help="Write a JSON lines stream of messages, resource states and progress to FILE")
+parser.add_argument("--progress", action="store_true",
+                    help="Show a progress summary every few seconds in place of the individual messages")
+parser.add_argument("--trace", metavar="FILE",
+                    help="Write a Chrome trace of every request, wait and resource to FILE and print a summary")
 args = parser.parse_args()
+if args.resume and args.scale is not None:
+    parser.error("--resume continues a full run and can't be combined with --scale")
 if args.yaml is None:
     filename = "topology.yaml"
 else:
     filename = args.yaml
 
 with open(filename, 'r') as stream:
-    topology = yaml.load(stream)[0]
-
-# Determine if region identified is available and get endpoint
-region = getregionavailability(topology["region"])
-
-if region["status"] == "available":
-    rias_endpoint = region["endpoint"]
-    main(region["name"])
-else:
-    print("Region %s is not currently available." % region["name"])
-    quit()
+    topology = yaml.safe_load(stream)[args.index]
+
+# Catch topology errors before any resource is created
+errors, warnings = validate(topology)
+for warning in warnings:
+    print("Warning: " + warning)
+if len(errors) > 0:
+    for error in errors:
+        print(error)
+    print("%s errors in %s, nothing was provisioned." % (len(errors), filename))
+    sys.exit(1)
+
+# Time every request and wait when tracing
+tracer = Tracer() if args.trace is not None else None
+# Every API call shares one pooled keep-alive session, sized for the worker threads
+# Requests are paced per resource type, and rate limited or transient errors are retried with backoff
+# Tokens are exchanged from the API key and refreshed before they expire, once for all the workers
+auth = tokenprovider(args.apikey, args.iam_endpoint)
+rias = RiasClient(args.endpoint, headers, version=version, pool_size=args.workers,
+                  governor=Governor(rate=args.rate, burst=2 * args.rate, tracer=tracer), auth=auth)
+resource_controller = RiasClient(args.resource_controller, headers, version=None, session=rias.session,
+                                 governor=rias.governor, auth=auth)
+# Each resource collection is listed once per run and kept up to date from create responses
+inventory = Inventory(rias)
+waiter = Waiter(rias, tracer=tracer)
+# All output is written from one thread so printing never holds up a worker
+reporter = Reporter(open(args.events, 'w') if args.events is not None else None, live=args.progress,
+                    states=("pending", "creating", "available", "failed"), governor=rias.governor)
+reporter.capture()
+state = StateFile(args.state or statepath(filename, args.index))
+# completed steps are journaled so an interrupted run can --resume
+journal = Journal(journalpath(filename, args.index))
+# instance creates from every group share one bounded pool
+creator = ThreadPoolExecutor(max_workers=args.workers)
+if args.asynchronous:
+    arias = AsyncRiasClient(rias, waiter, concurrency=args.workers)
+
+try:
+    # Determine if region identified is available and get endpoint
+    region = getregionavailability(topology["region"])
+
+    if region["status"] == "available":
+        rias.endpoint = region["endpoint"]
+        main(region["name"])
+    else:
+        print("Region %s is not currently available." % region["name"])
+        quit()
+except SystemExit as e:
+    # quit() exits with status 0, but it only ever ends a failed run
+    if e.code is None:
+        sys.exit(1)
+    raise
+finally:
+    reporter.close(failed=sys.exc_info()[0] is not None)
+    if tracer is not None:
+        tracer.export(args.trace)
+        tracer.report()
@@ -0,0 +1,152 @@
+## riasclient - Shared RIAS API client using a pooled keep-alive HTTP session.
+##
+
+import json, requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse, parse_qs
+from governor import Governor
+
+
+class RiasClient(object):
+    ################################################
+    ## Route every API call through one session so
+    ## TCP/TLS connections are reused across calls
+    ## and worker threads, and through a governor
+    ## that paces and retries them.  With an auth
+    ## provider every request carries its current
+    ## token, and one rejected as expired (401) is
+    ## resent once with a fresh token.
+    ################################################
+
+    def __init__(self, endpoint, headers, version="2019-01-01", pool_size=10, timeout=60, session=None,
+                 page_limit=100, governor=None, auth=None):
+        self.endpoint = endpoint
+        self.version = version
+        self.timeout = timeout
+        self.page_limit = page_limit
+        # threads are only started when a page is first prefetched
+        self.prefetcher = ThreadPoolExecutor(max_workers=4)
+        if session is None:
+            session = requests.Session()
+            # one pool per host, sized so every worker thread can hold a connection
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Connection": "keep-alive"})
+        self.session = session
+        self.headers = dict(headers)
+        self.governor = governor or Governor()
+        self.auth = auth
+
+    def request(self, method, path, params=None, json=None):
+        ################################################
+        ## Issue a request against the endpoint
+        ################################################
+
+        query = {}
+        if self.version is not None:
+            query["version"] = self.version
+        if params is not None:
+            query.update(params)
+
+        if self.auth is None:
+            return self.send(method, path, query, json, self.headers)
+        token = self.auth.authorization()
+        resp = self.send(method, path, query, json, dict(self.headers, Authorization=token))
+        if resp.status_code == 401:
+            self.auth.invalidate(token)
+            fresh = self.auth.authorization()
+            if fresh != token:
+                resp = self.send(method, path, query, json, dict(self.headers, Authorization=fresh))
+        return resp
+
+    def send(self, method, path, query, json, headers):
+        return self.governor.send(method, path,
+                                  lambda: self.session.request(method, self.endpoint + path, params=query, json=json,
+                                                               headers=headers, timeout=self.timeout))
+
+    def get(self, path, params=None):
+        return self.request("GET", path, params=params)
+
+    def post(self, path, json=None, params=None):
+        return self.request("POST", path, params=params, json=json)
+
+    def put(self, path, json=None, params=None):
+        return self.request("PUT", path, params=params, json=json)
+
+    def patch(self, path, json=None, params=None):
+        return self.request("PATCH", path, params=params, json=json)
+
+    def delete(self, path, params=None):
+        return self.request("DELETE", path, params=params)
+
+    def collection(self, path, key, params=None, limit=None, prefetch=True):
+        ################################################
+        ## Generator over every item of a paginated list,
+        ## following next links.  With prefetch the next
+        ## page is requested while the current one is
+        ## being consumed.
+        ################################################
+
+        query = dict(params or {})
+        query["limit"] = limit or self.page_limit
+
+        page = self.fetchpage(path, key, query)
+        while True:
+            start = nextstart(page)
+            upcoming = None
+            if start is not None and prefetch:
+                upcoming = self.prefetcher.submit(self.fetchpage, path, key, dict(query, start=start))
+
+            for item in page[key]:
+                yield item
+
+            if start is None:
+                return
+            if upcoming is not None:
+                page = upcoming.result()
+            else:
+                page = self.fetchpage(path, key, dict(query, start=start))
+
+    def fetchpage(self, path, key, query):
+        ################################################
+        ## Get one page of a list
+        ################################################
+
+        resp = self.get(path, params=query)
+        if resp.status_code != 200:
+            print("%s Error getting list of %s." % (resp.status_code, key))
+            print("Error Data:  %s" % json.loads(resp.content)['errors'])
+            quit()
+        return json.loads(resp.content)
+
+    def find(self, path, key, name, params=None):
+        ################################################
+        ## Return the first item named name, stopping at
+        ## the page where it is found
+        ################################################
+
+        for item in self.collection(path, key, params=params):
+            if item.get("name") == name:
+                return item
+        return
+
+    def close(self):
+        self.prefetcher.shutdown(wait=False)
+        self.session.close()
+
+
+def nextstart(page):
+    ################################################
+    ## Extract the start token from a page's next link
+    ################################################
+
+    if "next" not in page:
+        return
+    if "start" in page["next"]:
+        return page["next"]["start"]
+    start = parse_qs(urlparse(page["next"]["href"]).query).get("start")
+    if start is None:
+        return
+    return start[0]
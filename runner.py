@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+## runner - Provision or destroy every topology in one or more YAML files concurrently under one budget.
+##
+
+import os, sys, time, yaml, argparse, subprocess, threading
+from validate import validate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def topologies(filenames):
+    ################################################
+    ## Return (file, index, vpc, region, errors) for
+    ## every entry of every topology file
+    ################################################
+
+    entries = []
+    for filename in filenames:
+        with open(filename, 'r') as stream:
+            for index, topology in enumerate(yaml.safe_load(stream)):
+                # each script prints its own warnings
+                errors, warnings = validate(topology)
+                entries.append((filename, index, topology.get("vpc"), topology.get("region"), errors))
+    return entries
+
+
+def runtopology(script, entry, workers, rate, extra, lock, results):
+    ################################################
+    ## Run the script for one topology entry with
+    ## its share of the budget, prefixing its output
+    ## with the VPC and region
+    ################################################
+
+    filename, index, vpc, region, errors = entry
+    command = [sys.executable, os.path.join(HERE, script), "-y", filename, "-i", str(index), "-w", str(workers),
+               "-r", str(rate)] + extra
+    prefix = "[%s %s] " % (vpc, region)
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    for line in process.stdout:
+        with lock:
+            sys.stdout.write(prefix + line)
+            sys.stdout.flush()
+    process.wait()
+    with lock:
+        results.append({"vpc": vpc, "region": region, "file": filename, "index": index,
+                        "seconds": round(time.time() - start, 1), "status": process.returncode})
+
+
+def run(script, entries, workers, rate, extra):
+    ################################################
+    ## Run every entry at once, splitting the workers
+    ## and request rate evenly between them
+    ################################################
+
+    share_workers = max(1, workers // len(entries))
+    share_rate = rate / len(entries)
+    print("Running %s for %s topologies with %s workers and %.1f requests/sec each." % (
+        script, len(entries), share_workers, share_rate))
+
+    lock = threading.Lock()
+    results = []
+    threads = [threading.Thread(target=runtopology, args=(script, entry, share_workers, share_rate, extra, lock,
+                                                          results)) for entry in entries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+if __name__ == "__main__":
+    # everything after -- is passed to each script unchanged
+    argv = sys.argv[1:]
+    passed = []
+    if "--" in argv:
+        passed = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser(description="Provision or destroy several VPC topologies concurrently.",
+                                     epilog="Options after -- are passed to provision-vpc.py or destroy-vpc.py.")
+    parser.add_argument("files", nargs="+", help="YAML topology files; every entry of each file is run")
+    parser.add_argument("-d", "--destroy", action="store_true", help="Destroy the topologies instead")
+    parser.add_argument("-w", "--workers", type=int, default=16, help="Workers shared by all the topologies")
+    parser.add_argument("-r", "--rate", type=float, default=20.0,
+                        help="Requests per second to each resource type, shared by all the topologies")
+    args = parser.parse_args(argv)
+
+    entries = topologies(args.files)
+    if len(entries) == 0:
+        print("No topologies found in %s." % ", ".join(args.files))
+        sys.exit(1)
+    # provision nothing unless every topology is valid
+    invalid = [entry for entry in entries if len(entry[4]) > 0]
+    if len(invalid) > 0 and not args.destroy:
+        for filename, index, vpc, region, errors in invalid:
+            for error in errors:
+                print("[%s %s] %s" % (vpc, region, error))
+        print("%s of %s topologies have errors, nothing was provisioned." % (len(invalid), len(entries)))
+        sys.exit(1)
+
+    start = time.time()
+    results = run("destroy-vpc.py" if args.destroy else "provision-vpc.py", entries, args.workers, args.rate, passed)
+    for result in sorted(results, key=lambda result: (result["file"], result["index"])):
+        print("%-30s %-12s %8.1fs  %s" % (result["vpc"], result["region"], result["seconds"],
+                                         "ok" if result["status"] == 0 else "FAILED (%s)" % result["status"]))
+    print("Completed in %.1f seconds." % (time.time() - start))
+    # a child killed by a signal has a negative status
+    sys.exit(1 if any(result["status"] != 0 for result in results) else 0)
@@ -0,0 +1,254 @@
+## scheduler - Dependency graph scheduler used to provision and destroy VPC resources concurrently.
+##
+
+import time, asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tracing import current
+
+
+class NodeExit(Exception):
+    ################################################
+    ## quit() from an async node, carried as an
+    ## ordinary error because asyncio re-raises
+    ## SystemExit straight out of the event loop
+    ################################################
+    pass
+
+
+class Scheduler(object):
+    ################################################
+    ## Run a DAG of named nodes on a bounded worker pool.
+    ## Each node is called as func(results) once all of
+    ## its dependencies have completed, and its return
+    ## value is stored in results[name].  Normally the
+    ## first error ends the run; with keep_going a
+    ## failed node only stops its descendants and is
+    ## recorded in failures.
+    ################################################
+
+    def __init__(self, workers=8, tracer=None, keep_going=False):
+        self.workers = workers
+        self.keep_going = keep_going
+        # node -> error, when keep_going
+        self.failures = {}
+        self.nodes = {}
+        self.order = []
+        self.results = {}
+        self.listeners = []
+        self.observers = []
+        # records a span for every node when set
+        self.tracer = tracer
+
+    def __contains__(self, name):
+        return name in self.nodes
+
+    def add(self, name, func, deps=(), spec=None):
+        ################################################
+        ## Add a node to the graph.  spec is the part of
+        ## the topology the node is built from, used to
+        ## tell whether a journaled result still holds.
+        ################################################
+
+        if name in self.nodes:
+            raise ValueError("Node %s is already defined." % name)
+        self.nodes[name] = {"func": func, "deps": list(deps), "spec": spec}
+        self.order.append(name)
+        return name
+
+    def done(self, name, result):
+        ################################################
+        ## Record the result of a node that needs no work
+        ################################################
+
+        self.nodes[name]["func"] = lambda results: result
+
+    def listen(self, func):
+        ################################################
+        ## Call func(name, result) as each node completes
+        ################################################
+
+        self.listeners.append(func)
+
+    def observe(self, func):
+        ################################################
+        ## Call func(name, state) as each node starts
+        ## ("start") and as it finishes ("done") or
+        ## raises ("fail"), from the thread running it
+        ################################################
+
+        self.observers.append(func)
+
+    def graph(self):
+        ################################################
+        ## Return the dependency counts and dependents
+        ## of every node
+        ################################################
+
+        waiting = {}
+        dependents = {}
+        for name in self.order:
+            for dep in self.nodes[name]["deps"]:
+                if dep not in self.nodes:
+                    raise ValueError("Node %s depends on undefined node %s." % (name, dep))
+                dependents.setdefault(dep, []).append(name)
+            waiting[name] = len(set(self.nodes[name]["deps"]))
+        return waiting, dependents
+
+    def run(self):
+        ################################################
+        ## Execute every node, running each as soon as
+        ## its dependencies are satisfied.
+        ################################################
+
+        waiting, dependents = self.graph()
+        ready = [name for name in self.order if waiting[name] == 0]
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while ready or running:
+                for name in ready:
+                    running[executor.submit(self.timed, name)] = name
+                ready = []
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    ready += self.complete(running.pop(future), future, waiting, dependents)
+
+        self.checkcomplete()
+        return self.results
+
+    def runasync(self, loop=None):
+        ################################################
+        ## Execute every node on an asyncio event loop.
+        ## A node may return a coroutine, which is
+        ## awaited on the loop without holding a worker
+        ## thread; blocking work runs on the pool.
+        ## Without a loop a new one is made for the run.
+        ################################################
+
+        if loop is not None:
+            return loop.run_until_complete(self.arun(loop))
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.arun(loop))
+        finally:
+            loop.close()
+
+    async def arun(self, loop):
+        waiting, dependents = self.graph()
+        ready = [name for name in self.order if waiting[name] == 0]
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while ready or running:
+                for name in ready:
+                    running[asyncio.ensure_future(self.anode(loop, executor, name))] = name
+                ready = []
+
+                done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    ready += self.complete(running.pop(future), future, waiting, dependents)
+
+        self.checkcomplete()
+        return self.results
+
+    def complete(self, name, future, waiting, dependents):
+        ################################################
+        ## Store a finished node's result and return the
+        ## dependents that are now ready.  A failed node
+        ## releases none of its dependents.
+        ################################################
+
+        try:
+            # re-raises any error (including quit()) from the node in the calling thread
+            result = future.result()
+        except (Exception, SystemExit) as e:
+            if not self.keep_going:
+                if isinstance(e, NodeExit):
+                    raise e.__cause__
+                raise
+            self.failures[name] = e
+            return []
+
+        self.results[name] = result
+        for listener in self.listeners:
+            listener(name, result)
+        ready = []
+        for dependent in set(dependents.get(name, [])):
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                ready.append(dependent)
+        return ready
+
+    def blocked(self, name):
+        ################################################
+        ## Return the descendants of a failed node, which
+        ## were never run
+        ################################################
+
+        waiting, dependents = self.graph()
+        found = []
+        pending = list(dependents.get(name, []))
+        while len(pending) > 0:
+            dependent = pending.pop(0)
+            if dependent not in found and dependent not in self.results:
+                found.append(dependent)
+                pending.extend(dependents.get(dependent, []))
+        return found
+
+    async def anode(self, loop, executor, name):
+        start = self.started(name)
+        finished = False
+        try:
+            result = await loop.run_in_executor(executor, self.call, name)
+            if asyncio.iscoroutine(result):
+                token = current.set(name)
+                try:
+                    result = await result
+                finally:
+                    current.reset(token)
+            finished = True
+            return result
+        except SystemExit as e:
+            raise NodeExit(e.code) from e
+        finally:
+            self.finished(name, start, finished)
+
+    def call(self, name):
+        ################################################
+        ## Run a node with it as the current node that
+        ## requests and waits are attributed to
+        ################################################
+
+        token = current.set(name)
+        try:
+            return self.nodes[name]["func"](self.results)
+        finally:
+            current.reset(token)
+
+    def timed(self, name):
+        start = self.started(name)
+        finished = False
+        try:
+            result = self.call(name)
+            finished = True
+            return result
+        finally:
+            self.finished(name, start, finished)
+
+    def started(self, name):
+        for observer in self.observers:
+            observer(name, "start")
+        return time.time()
+
+    def finished(self, name, start, finished):
+        for observer in self.observers:
+            observer(name, "done" if finished else "fail")
+        if self.tracer is not None:
+            self.tracer.record("node", name, start, time.time(), node=name, deps=self.nodes[name]["deps"])
+
+    def checkcomplete(self):
+        # the descendants of failed nodes are the only ones expected not to run
+        if len(self.results) < len(self.nodes) and len(self.failures) == 0:
+            blocked = [name for name in self.order if name not in self.results]
+            raise ValueError("Dependency cycle detected between nodes %s." % ", ".join(blocked))
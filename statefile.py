@@ -0,0 +1,121 @@
+## statefile - Local record of the resources provisioned from a topology, keyed by graph node.
+##
+
+import json, os, time, threading
+
+# graph node prefix -> resource collection
+TYPES = {
+    "acl": "network_acls",
+    "vpc": "vpcs",
+    "sg": "security_groups",
+    "key": "keys",
+    "prefix": "address_prefixes",
+    "gateway": "public_gateways",
+    "subnet": "subnets",
+    "vpn": "vpn_gateways",
+    "instance": "instances",
+    "fip": "floating_ips",
+    "lb": "load_balancers",
+}
+
+
+class StateFile(object):
+    ################################################
+    ## Map each graph node (the resource's path in
+    ## the topology, e.g. subnet:webtier-us-south-1)
+    ## to its type, id and dependencies so later runs
+    ## can go straight to the ids.  Written at most
+    ## once per interval while a run is in progress.
+    ################################################
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.resources = {}
+        self.saved = 0
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path, 'r') as stream:
+                self.resources = json.load(stream)["resources"]
+
+    def id(self, node):
+        ################################################
+        ## Return the recorded id of node or None
+        ################################################
+
+        with self.lock:
+            entry = self.resources.get(node)
+        if entry is None:
+            return
+        return entry["id"]
+
+    def entries(self):
+        ################################################
+        ## Return a copy of node -> entry
+        ################################################
+
+        with self.lock:
+            return dict(self.resources)
+
+    def record(self, node, id, deps=()):
+        ################################################
+        ## Record the resource created for node.  Nodes
+        ## that aren't resources are ignored.
+        ################################################
+
+        resource_type = TYPES.get(node.split(":")[0])
+        if resource_type is None or id is None or id == 0:
+            return
+        with self.lock:
+            self.resources[node] = {"type": resource_type, "name": node.split(":", 1)[-1], "id": id,
+                                    "deps": [dep for dep in deps if TYPES.get(dep.split(":")[0]) is not None]}
+            self.dirty = True
+        self.flush()
+
+    def forget(self, node):
+        ################################################
+        ## Drop node's entry.  Returns True if there
+        ## was one.
+        ################################################
+
+        with self.lock:
+            entry = self.resources.pop(node, None)
+            if entry is not None:
+                self.dirty = True
+        self.flush()
+        return entry is not None
+
+    def flush(self, force=False):
+        ################################################
+        ## Write the file if it changed and the interval
+        ## has passed (or force)
+        ################################################
+
+        with self.lock:
+            if not self.dirty or (not force and time.time() - self.saved < self.interval):
+                return
+            if len(self.resources) == 0:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+            else:
+                # write a new file and swap it in so an interrupted run never leaves a partial file
+                with open(self.path + ".tmp", 'w') as stream:
+                    json.dump({"resources": self.resources}, stream, indent=2, sort_keys=True)
+                os.replace(self.path + ".tmp", self.path)
+            self.saved = time.time()
+            self.dirty = False
+
+    def save(self):
+        self.flush(force=True)
+
+
+def statepath(topology_file, index=0):
+    ################################################
+    ## Default state file for an entry of a topology
+    ## file
+    ################################################
+
+    if index == 0:
+        return os.path.splitext(topology_file)[0] + ".state.json"
+    return os.path.splitext(topology_file)[0] + ".%d.state.json" % index
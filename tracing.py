@@ -0,0 +1,181 @@
+## tracing - Record timed spans for API requests, waits and graph nodes and report where a run spent its time.
+##
+
+import os, json, math, time, threading, contextvars
+
+# the graph node that requests and waits are made on behalf of
+current = contextvars.ContextVar("node", default=None)
+
+
+class Tracer(object):
+    ################################################
+    ## Collect spans of every request attempt, retry
+    ## backoff, throttle delay, wait and graph node.
+    ## Spans are attributed to the graph node running
+    ## when they started.
+    ################################################
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.origin = time.time()
+
+    def record(self, category, name, start, end, **args):
+        ################################################
+        ## Add a finished span
+        ################################################
+
+        span = {"cat": category, "name": name, "start": start, "end": end, "tid": threading.get_ident(),
+                "node": args.pop("node", current.get()), "args": args}
+        with self.lock:
+            self.spans.append(span)
+
+    def select(self, category):
+        with self.lock:
+            return [span for span in self.spans if span["cat"] == category]
+
+    def export(self, filename):
+        ################################################
+        ## Write the spans in the Chrome trace event
+        ## format (chrome://tracing, Perfetto)
+        ################################################
+
+        with self.lock:
+            spans = list(self.spans)
+        threads = {}
+        events = []
+        for span in spans:
+            args = dict(span["args"])
+            if span["node"] is not None:
+                args["node"] = span["node"]
+            events.append({"name": span["name"], "cat": span["cat"], "ph": "X", "pid": os.getpid(),
+                           "tid": threads.setdefault(span["tid"], len(threads) + 1),
+                           "ts": round((span["start"] - self.origin) * 1e6),
+                           "dur": round((span["end"] - span["start"]) * 1e6), "args": args})
+        with open(filename, 'w') as stream:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, stream)
+
+    def endpoints(self):
+        ################################################
+        ## Return endpoint -> request statistics
+        ################################################
+
+        stats = {}
+        for span in self.select("request"):
+            entry = stats.setdefault(span["name"], {"calls": 0, "errors": 0, "retries": 0, "bytes": 0,
+                                                    "latencies": []})
+            entry["calls"] += 1
+            entry["latencies"].append(span["end"] - span["start"])
+            entry["bytes"] += span["args"].get("bytes", 0)
+            if span["args"].get("attempt", 0) > 0:
+                entry["retries"] += 1
+            if not isinstance(span["args"].get("status"), int) or span["args"]["status"] >= 400:
+                entry["errors"] += 1
+        return stats
+
+    def waits(self):
+        ################################################
+        ## Return resource type -> wait durations
+        ################################################
+
+        waits = {}
+        for span in self.select("wait"):
+            waits.setdefault(span["name"], []).append(span["end"] - span["start"])
+        return waits
+
+    def criticalpath(self):
+        ################################################
+        ## Return the chain of node spans that ended
+        ## last, following from each node the
+        ## dependency that finished latest
+        ################################################
+
+        nodes = dict((span["name"], span) for span in self.select("node"))
+        if len(nodes) == 0:
+            return []
+        path = [max(nodes.values(), key=lambda span: span["end"])]
+        while True:
+            deps = [nodes[dep] for dep in path[-1]["args"].get("deps", []) if dep in nodes]
+            if len(deps) == 0:
+                return list(reversed(path))
+            path.append(max(deps, key=lambda span: span["end"]))
+
+    def report(self):
+        ################################################
+        ## Print request latency per endpoint, time
+        ## spent waiting per resource type and the
+        ## critical path through the graph
+        ################################################
+
+        stats = self.endpoints()
+        print("%-60s %6s %6s %7s %8s %8s %8s %9s" % ("Endpoint", "Calls", "Errors", "Retries", "p50 ms",
+                                                      "p95 ms", "max ms", "KB"))
+        for name in sorted(stats, key=lambda name: -sum(stats[name]["latencies"])):
+            entry = stats[name]
+            print("%-60s %6d %6d %7d %8.1f %8.1f %8.1f %9.1f" % (
+                name, entry["calls"], entry["errors"], entry["retries"], percentile(entry["latencies"], 50) * 1000,
+                percentile(entry["latencies"], 95) * 1000, max(entry["latencies"]) * 1000, entry["bytes"] / 1024.0))
+
+        waits = self.waits()
+        if len(waits) > 0:
+            print("%-60s %6s %9s %8s %8s %8s" % ("Wait", "Count", "Total s", "p50 s", "p95 s", "max s"))
+            for name in sorted(waits):
+                print("%-60s %6d %9.1f %8.1f %8.1f %8.1f" % (name, len(waits[name]), sum(waits[name]),
+                                                             percentile(waits[name], 50),
+                                                             percentile(waits[name], 95), max(waits[name])))
+
+        path = self.criticalpath()
+        if len(path) > 0:
+            # time inside each node spent on requests, retry backoff and throttling, and waits
+            spent = {}
+            with self.lock:
+                spans = list(self.spans)
+            for span in spans:
+                if span["cat"] != "node" and span["node"] is not None:
+                    key = (span["node"], "request" if span["cat"] == "request" else
+                           "wait" if span["cat"] == "wait" else "delay")
+                    spent[key] = spent.get(key, 0) + span["end"] - span["start"]
+            print("Critical path: %.1f seconds" % (path[-1]["end"] - self.origin))
+            print("%8s %8s %9s %9s %9s %9s  %s" % ("Start s", "Queued s", "Elapsed s", "Request s", "Delay s",
+                                                  "Wait s", "Node"))
+            previous = None
+            for span in path:
+                # time between the dependency finishing and a worker picking the node up
+                queued = span["start"] - previous["end"] if previous is not None else 0
+                print("%8.1f %8.1f %9.1f %9.1f %9.1f %9.1f  %s" % (
+                    span["start"] - self.origin, max(0, queued), span["end"] - span["start"],
+                    spent.get((span["name"], "request"), 0), spent.get((span["name"], "delay"), 0),
+                    spent.get((span["name"], "wait"), 0), span["name"]))
+                previous = span
+
+
+def endpoint(method, path):
+    ################################################
+    ## Name a request by method and path with the
+    ## ids replaced (/v1/instances/<id>/...)
+    ################################################
+
+    parts = path.split("/")
+    # paths alternate collection and id after the version: /v1/<collection>/<id>/<collection>/<id>
+    return method + " " + "/".join(["{id}" if n > 2 and n % 2 == 1 else part for n, part in enumerate(parts)])
+
+
+def percentile(values, percent):
+    ################################################
+    ## Nearest rank percentile
+    ################################################
+
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(percent / 100.0 * len(ordered))) - 1)]
+
+
+def carry(func):
+    ################################################
+    ## Wrap func to run in a copy of the caller's
+    ## context, so work handed to another pool stays
+    ## attributed to the calling node.  Each wrapper
+    ## is for a single call.
+    ################################################
+
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+## validate - Check a topology for errors the API would only report part way through a run, without any API calls.
+##
+
+import sys, yaml, argparse, ipaddress
+
+# addresses IBM Cloud reserves in every subnet
+RESERVED = 5
+
+
+class CidrIndex(object):
+    ################################################
+    ## CIDR blocks as address intervals sorted by
+    ## start.  Two blocks either nest or don't meet,
+    ## so a block overlaps one that starts before it
+    ## only if that one is still open, and one sweep
+    ## finds every overlap.
+    ################################################
+
+    def __init__(self):
+        # (first address, -last address, name, network), so a block sorts before the blocks inside it
+        self.blocks = []
+
+    def add(self, network, name):
+        self.blocks.append((int(network.network_address), -int(network.broadcast_address), name, network))
+
+    def overlaps(self):
+        ################################################
+        ## Return (outer name, outer network, inner name,
+        ## inner network) for every block inside the
+        ## innermost earlier block that holds it
+        ################################################
+
+        found = []
+        # blocks containing the current address, outermost first
+        open_blocks = []
+        for first, last, name, network in sorted(self.blocks):
+            while len(open_blocks) > 0 and -open_blocks[-1][1] < first:
+                open_blocks.pop()
+            if len(open_blocks) > 0:
+                found.append((open_blocks[-1][2], open_blocks[-1][3], name, network))
+            open_blocks.append((first, last, name, network))
+        return found
+
+
+# keys the scripts read from each part of a topology
+REQUIRED = {
+    "topology": ("vpc", "region", "zones", "instanceTemplates", "network_acls", "security_groups", "sshkeys"),
+    "template": ("template", "image", "profile_name", "sshkey", "cloud-init-file"),
+    "network_acl": ("network_acl", "rules"),
+    "security_group": ("security_group", "rules"),
+    "sshkey": ("sshkey", "public_key"),
+    "zone": ("name", "subnets"),
+    "subnet": ("name", "ipv4_cidr_block", "network_acl"),
+    "instance": ("name", "quantity", "template", "security_group"),
+    "load_balancer": ("lbInstance", "subnets", "listeners", "pools"),
+}
+
+
+def parse(cidr, what, errors):
+    try:
+        return ipaddress.ip_network(cidr)
+    except (TypeError, ValueError) as e:
+        errors.append("%s: %s is not a valid CIDR block (%s)." % (what, cidr, e))
+
+
+def label(kind, obj, key, n):
+    ################################################
+    ## Name a part of the topology by its name, or
+    ## by its position if it has none
+    ################################################
+
+    if isinstance(obj, dict) and key in obj:
+        return "%s %s" % (kind, obj[key])
+    return "%s %s" % (kind, n + 1)
+
+
+def missing(obj, kind, what, errors):
+    ################################################
+    ## Report the required keys obj lacks.  Returns
+    ## True if any are missing.
+    ################################################
+
+    if not isinstance(obj, dict):
+        errors.append("%s is not a mapping." % what)
+        return True
+    absent = [key for key in REQUIRED[kind] if key not in obj]
+    if len(absent) > 0:
+        errors.append("%s is missing %s." % (what, ", ".join(absent)))
+    return len(absent) > 0
+
+
+def validate(topology):
+    ################################################
+    ## Return (errors, warnings) for a topology.
+    ## Errors are missing keys, overlapping or
+    ## misplaced CIDR blocks, undefined templates
+    ## and subnets too small for their instances.
+    ## Security groups and network ACLs may already
+    ## exist outside the topology, so references to
+    ## undefined ones are only warnings.
+    ################################################
+
+    errors = []
+    warnings = []
+    if missing(topology, "topology", "Topology", errors):
+        return errors, warnings
+
+    def defined(key, kind, name):
+        names = set()
+        for n, obj in enumerate(topology[key]):
+            missing(obj, kind, label(name, obj, kind, n), errors)
+            if isinstance(obj, dict) and kind in obj:
+                names.add(obj[kind])
+        return names
+
+    templates = defined("instanceTemplates", "template", "Instance template")
+    security_groups = defined("security_groups", "security_group", "Security group")
+    network_acls = defined("network_acls", "network_acl", "Network ACL")
+    for n, sshkey in enumerate(topology["sshkeys"]):
+        missing(sshkey, "sshkey", label("SSH key", sshkey, "sshkey", n), errors)
+    for n, lb in enumerate(topology.get("load_balancers", [])):
+        missing(lb, "load_balancer", label("Load balancer", lb, "lbInstance", n), errors)
+
+    def external(kind, name, what):
+        warnings.append("%s: %s %s is not defined in the topology and must already exist." % (what, kind, name))
+
+    if "default_network_acl" in topology and topology["default_network_acl"] not in network_acls:
+        external("network_acl", topology["default_network_acl"], "default_network_acl")
+    for sg in topology["security_groups"]:
+        for rule in sg.get("rules", []) if isinstance(sg, dict) else []:
+            remote = rule.get("remote", {}).get("security_group")
+            if remote is not None and remote not in security_groups:
+                external("security_group", remote, "Security group %s rule" % sg.get("security_group"))
+
+    prefixes = CidrIndex()
+    subnets = CidrIndex()
+    for n, zone in enumerate(topology["zones"]):
+        if missing(zone, "zone", label("Zone", zone, "name", n), errors):
+            continue
+        prefix = None
+        if "address_prefix_cidr" in zone:
+            prefix = parse(zone["address_prefix_cidr"], "Zone %s" % zone["name"], errors)
+            if prefix is not None:
+                prefixes.add(prefix, "zone " + zone["name"])
+
+        for m, subnet in enumerate(zone["subnets"]):
+            if missing(subnet, "subnet", label("Subnet", subnet, "name", m), errors):
+                continue
+            what = "Subnet %s" % subnet["name"]
+            block = parse(subnet["ipv4_cidr_block"], what, errors)
+            if block is not None:
+                subnets.add(block, "subnet " + subnet["name"])
+                if prefix is not None and (block.version != prefix.version or not block.subnet_of(prefix)):
+                    errors.append("%s: %s is outside zone %s's address prefix %s." % (
+                        what, block, zone["name"], prefix))
+            if len(subnet.get("vpn", [])) > 0 and "address_prefix_cidr" not in zone:
+                errors.append("%s: a VPN needs zone %s's address_prefix_cidr." % (what, zone["name"]))
+
+            if subnet["network_acl"] not in network_acls:
+                external("network_acl", subnet["network_acl"], what)
+
+            wanted = 0
+            for k, instance in enumerate(subnet.get("instances", [])):
+                group = "%s %s" % (what, label("instance", instance, "name", k))
+                if missing(instance, "instance", group, errors):
+                    continue
+                if instance["template"] not in templates:
+                    errors.append("%s: template %s is not defined." % (group, instance["template"]))
+                if instance["security_group"] not in security_groups:
+                    external("security_group", instance["security_group"], group)
+                if not isinstance(instance["quantity"], int) or instance["quantity"] < 0:
+                    errors.append("%s: quantity %s is not a whole number." % (group, instance["quantity"]))
+                    continue
+                wanted += instance["quantity"]
+            if block is not None and wanted > block.num_addresses - RESERVED:
+                errors.append("%s: %s instances don't fit in %s, which holds %s." % (
+                    what, wanted, block, max(0, block.num_addresses - RESERVED)))
+
+    for index in (prefixes, subnets):
+        for outer, outer_network, inner, inner_network in index.overlaps():
+            errors.append("%s %s overlaps %s %s." % (inner.capitalize(), inner_network, outer, outer_network))
+    return errors, warnings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check topology files without calling the API.")
+    parser.add_argument("files", nargs="+", help="YAML topology files; every entry of each file is checked")
+    args = parser.parse_args()
+
+    failed = False
+    for filename in args.files:
+        with open(filename, 'r') as stream:
+            for index, topology in enumerate(yaml.safe_load(stream)):
+                errors, warnings = validate(topology)
+                for error in errors:
+                    print("%s[%s] %s" % (filename, index, error))
+                for warning in warnings:
+                    print("%s[%s] warning: %s" % (filename, index, warning))
+                failed = failed or len(errors) > 0
+    sys.exit(1 if failed else 0)
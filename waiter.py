@@ -0,0 +1,267 @@
+## waiter - Poll RIAS resources until they reach a state, backing off exponentially with jitter.
+##
+
+import json, time, random, threading
+
+# seconds to wait for each resource type before giving up
+DEADLINES = {
+    "subnets": 300,
+    "instances": 1200,
+    "floating_ips": 300,
+    "public_gateways": 300,
+    "vpn_gateways": 1200,
+    "load_balancers": 1800,
+}
+DEFAULT_DEADLINE = 600
+
+
+class Waiter(object):
+    ################################################
+    ## Poll with a short first interval that doubles
+    ## (with jitter) up to maximum, until the
+    ## resource type's deadline passes.
+    ################################################
+
+    def __init__(self, rias, initial=1.0, maximum=30.0, factor=2.0, jitter=0.5, deadlines=None, tracer=None):
+        self.rias = rias
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.deadlines = dict(DEADLINES)
+        if deadlines is not None:
+            self.deadlines.update(deadlines)
+        # records the time spent in every wait when set
+        self.tracer = tracer
+        self.lock = threading.Lock()
+        self.monitors = {}
+
+    def monitor(self, resource_type, params=None):
+        ################################################
+        ## Return the shared StatusMonitor for a
+        ## resource type and list filter
+        ################################################
+
+        key = (resource_type, tuple(sorted((params or {}).items())))
+        with self.lock:
+            if key not in self.monitors:
+                self.monitors[key] = StatusMonitor(self, resource_type, params)
+            return self.monitors[key]
+
+    def intervals(self, resource_type):
+        ################################################
+        ## Generate sleep intervals until the deadline
+        ################################################
+
+        deadline = time.time() + self.deadlines.get(resource_type, DEFAULT_DEADLINE)
+        interval = self.initial
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            # spread pollers out so concurrent waits don't hit the API in lock step
+            delay = interval * (1 - self.jitter * random.random())
+            yield min(delay, remaining)
+            interval = min(interval * self.factor, self.maximum)
+
+    def wait(self, resource_type, path, done, description):
+        ################################################
+        ## Poll path until done(obj) is true, where obj
+        ## is None once the resource no longer exists.
+        ## Returns (True, obj), or (False, obj) if the
+        ## deadline passed first.
+        ################################################
+
+        start = time.time()
+        result = self.poll(resource_type, path, done, description)
+        self.traced(resource_type, start, description, result[0])
+        return result
+
+    def poll(self, resource_type, path, done, description):
+        obj = self.fetch(path)
+        if done(obj):
+            return True, obj
+        for delay in self.intervals(resource_type):
+            print("Waiting for %s.  Sleeping for %.1f seconds..." % (description, delay))
+            time.sleep(delay)
+            obj = self.fetch(path)
+            if done(obj):
+                return True, obj
+        print("Timed out waiting for %s." % description)
+        return False, obj
+
+    def traced(self, resource_type, start, description, finished):
+        ################################################
+        ## Record a finished wait with the tracer
+        ################################################
+
+        if self.tracer is not None:
+            self.tracer.record("wait", resource_type, start, time.time(), description=description,
+                               finished=finished)
+
+    def fetch(self, path):
+        ################################################
+        ## Get the resource, or None if it is gone
+        ################################################
+
+        resp = self.rias.get(path)
+        if resp.status_code == 404:
+            return
+        if resp.status_code != 200:
+            print("%s Error getting %s." % (resp.status_code, path))
+            print("Error Data:  %s" % json.loads(resp.content)['errors'])
+            quit()
+        return json.loads(resp.content)
+
+
+class StatusMonitor(object):
+    ################################################
+    ## Multiplex waits on many resources of one type
+    ## onto a single periodic list call.  Callers
+    ## register an id and a done(obj) condition and
+    ## one poller thread resolves them all.
+    ################################################
+
+    def __init__(self, waiter, resource_type, params=None):
+        self.waiter = waiter
+        self.rias = waiter.rias
+        self.resource_type = resource_type
+        self.params = params
+        self.lock = threading.Lock()
+        self.watches = []
+        self.thread = None
+        self.interval = waiter.initial
+
+    def watch(self, id, done, notify=None):
+        ################################################
+        ## Register a wait and return its event and
+        ## result holder.  notify, if given, is called
+        ## with the result from the poller thread.
+        ################################################
+
+        watch = {"id": id, "done": done, "event": threading.Event(), "result": (False, None), "notify": notify,
+                 "deadline": time.time() + self.waiter.deadlines.get(self.resource_type, DEFAULT_DEADLINE)}
+        with self.lock:
+            self.watches.append(watch)
+            # poll soon for new work rather than waiting out a backed off interval
+            self.interval = self.waiter.initial
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        return watch
+
+    def wait(self, id, done, description):
+        ################################################
+        ## Block until done(obj) is true for id, where obj
+        ## is None once the resource no longer exists.
+        ## Returns (True, obj), or (False, obj) if the
+        ## deadline passed first.
+        ################################################
+
+        start = time.time()
+        watch = self.watch(id, done)
+        print("Waiting for %s." % description)
+        watch["event"].wait()
+        if not watch["result"][0]:
+            print("Timed out waiting for %s." % description)
+        self.waiter.traced(self.resource_type, start, description, watch["result"][0])
+        return watch["result"]
+
+    def waitall(self, ids, done, description):
+        ################################################
+        ## Block until done(obj) is true for every id,
+        ## waiting on them all at once from the calling
+        ## thread.  Returns a (finished, obj) result
+        ## for each id, in order.
+        ################################################
+
+        start = time.time()
+        watches = [self.watch(id, done) for id in ids]
+        print("Waiting for %s." % description)
+        for watch in watches:
+            watch["event"].wait()
+        results = [watch["result"] for watch in watches]
+        finished = all(result[0] for result in results)
+        if not finished:
+            print("Timed out waiting for %s." % description)
+        self.waiter.traced(self.resource_type, start, description, finished)
+        return results
+
+    def run(self):
+        ################################################
+        ## Poll the collection until nothing is watched.
+        ## If polling itself fails, every remaining
+        ## watch is released as unsuccessful so no
+        ## caller is left waiting on a dead thread.
+        ################################################
+
+        try:
+            self.poll()
+        except BaseException as e:
+            print("Error polling %s: %s" % (self.resource_type, e))
+        finally:
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+                failed = self.watches if self.thread is None else []
+                if self.thread is None:
+                    self.watches = []
+            for watch in failed:
+                self.release(watch, (False, None))
+
+    def poll(self):
+        while True:
+            try:
+                listed = dict((obj["id"], obj) for obj in
+                              self.rias.collection('/v1/' + self.resource_type, self.resource_type,
+                                               params=self.params))
+            except BaseException as e:
+                # a failed list (or quit()) releases every waiter as unsuccessful
+                print("Error polling %s: %s" % (self.resource_type, e))
+                listed = None
+
+            now = time.time()
+            finished = []
+            with self.lock:
+                for watch in list(self.watches):
+                    if listed is None:
+                        result = (False, None)
+                    else:
+                        obj = listed.get(watch["id"])
+                        if watch["done"](obj):
+                            result = (True, obj)
+                        elif watch["deadline"] <= now:
+                            result = (False, obj)
+                        else:
+                            continue
+                    finished.append((watch, result))
+                for watch, result in finished:
+                    self.watches.remove(watch)
+
+                idle = len(self.watches) == 0
+                if idle:
+                    self.thread = None
+                delay = self.interval * (1 - self.waiter.jitter * random.random())
+                self.interval = min(self.interval * self.waiter.factor, self.waiter.maximum)
+            # outside the lock, so a slow or failing notify can't hold up other watches
+            for watch, result in finished:
+                self.release(watch, result)
+            if idle:
+                return
+            time.sleep(delay)
+
+    def release(self, watch, result):
+        ################################################
+        ## Hand a watch its result.  A notify that
+        ## raises (say its event loop has closed) only
+        ## loses that one result.
+        ################################################
+
+        watch["result"] = result
+        watch["event"].set()
+        if watch["notify"] is not None:
+            try:
+                watch["notify"](result)
+            except Exception as e:
+                print("Error reporting %s %s: %s" % (self.resource_type, watch["id"], e))